@@ -0,0 +1,86 @@
+# python -m benchmarks.bench_download
+import argparse
+import asyncio
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from scraper import download_file, remove_file
+
+RANGE_PATTERN = re.compile(r"bytes=(\d+)-(\d+)")
+
+
+def make_handler(payload: bytes, bandwidth_kbps: int, chunk_size: int = 16 * 1024):
+    delay = chunk_size / (bandwidth_kbps * 1024)
+
+    class ThrottledRangeHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send_headers(self, status, start, end):
+            self.send_response(status)
+            self.send_header("Content-Type", "video/mp4")
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(end - start + 1))
+            if status == 206:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{len(payload)}")
+            self.end_headers()
+
+        def do_HEAD(self):
+            self._send_headers(200, 0, len(payload) - 1)
+
+        def do_GET(self):
+            match = RANGE_PATTERN.match(self.headers.get("Range", ""))
+            if match:
+                start, end = int(match.group(1)), int(match.group(2))
+                self._send_headers(206, start, end)
+            else:
+                start, end = 0, len(payload) - 1
+                self._send_headers(200, start, end)
+            # per connection throttling
+            for offset in range(start, end + 1, chunk_size):
+                self.wfile.write(payload[offset : min(offset + chunk_size, end + 1)])
+                time.sleep(delay)
+
+    return ThrottledRangeHandler
+
+
+async def measure(url: str, chunks: int) -> float:
+    started = time.perf_counter()
+    filename = await download_file(url, chunks=chunks, range_min_size_mb=0)
+    elapsed = time.perf_counter() - started
+    remove_file(filename)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Ranged vs single stream download from a throttled server"
+    )
+    parser.add_argument("--size-mb", type=int, default=16)
+    parser.add_argument("--bandwidth-kbps", type=int, default=2048)
+    parser.add_argument("--chunks", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+    payload = os.urandom(args.size_mb * 1024 * 1024)
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), make_handler(payload, args.bandwidth_kbps)
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/video.mp4"
+    print(f"{args.size_mb} MB at {args.bandwidth_kbps} KB/s per connection")
+    try:
+        for chunks in args.chunks:
+            elapsed = asyncio.run(measure(url, chunks))
+            print(
+                f"chunks={chunks}: {elapsed:.2f}s ({args.size_mb / elapsed:.2f} MB/s)"
+            )
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# python -m benchmarks.bench_encode
+import argparse
+import asyncio
+import contextlib
+import os
+import subprocess
+import tempfile
+import time
+
+import converter
+from converter import CPUAllocator, EncodeBudget, convert2MP4, get_cpus
+
+
+class UnboundedAllocator(CPUAllocator):
+    # what encodes used to get: every ffmpeg sizes itself to the whole machine
+    @contextlib.contextmanager
+    def allocate(self, preset: str):
+        yield EncodeBudget(0, preset, None)
+
+
+def make_fixture(path: str, duration: int, size: str) -> None:
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-v",
+            "error",
+            "-f",
+            "lavfi",
+            "-i",
+            f"testsrc2=size={size}:rate=30:duration={duration}",
+            "-f",
+            "lavfi",
+            "-i",
+            f"sine=frequency=440:duration={duration}",
+            "-c:v",
+            "mpeg4",
+            "-q:v",
+            "3",
+            "-c:a",
+            "pcm_s16le",
+            path,
+        ],
+        check=True,
+    )
+
+
+async def _encode(path: str) -> float:
+    started = time.perf_counter()
+    converted = await convert2MP4(path)
+    elapsed = time.perf_counter() - started
+    os.remove(converted.filename)
+    if converted.thumbnail:
+        os.remove(converted.thumbnail)
+    return elapsed
+
+
+async def measure(allocator, path: str, concurrency: int) -> tuple[float, float]:
+    converter.get_cpu_allocator = lambda: allocator
+    started = time.perf_counter()
+    latencies = await asyncio.gather(*[_encode(path) for _ in range(concurrency)])
+    return time.perf_counter() - started, sum(latencies) / len(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="convert2MP4 throughput with and without the CPU allocator"
+    )
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 2, 4, 8])
+    parser.add_argument("--duration", type=int, default=10)
+    parser.add_argument("--size", default="1280x720")
+    parser.add_argument("--pin", action="store_true")
+    args = parser.parse_args()
+    cpus = get_cpus()
+    variants = {
+        "ffmpeg auto threads": UnboundedAllocator(cpus),
+        "cpu allocator": CPUAllocator(cpus, pin=args.pin),
+    }
+    print(f"{len(cpus)} cpus, {args.duration}s {args.size} clips")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "clip.mkv")
+        make_fixture(path, args.duration, args.size)
+        for concurrency in args.concurrency:
+            print(f"{concurrency} concurrent encodes")
+            for name, allocator in variants.items():
+                wall, latency = asyncio.run(measure(allocator, path, concurrency))
+                print(
+                    f"  {name:<20} {wall:7.2f} s wall {latency:7.2f} s per clip"
+                    f" {concurrency / wall * 60:7.1f} clips/min"
+                )
+
+
+if __name__ == "__main__":
+    main()
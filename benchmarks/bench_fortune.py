@@ -0,0 +1,71 @@
+# python -m benchmarks.bench_fortune
+import argparse
+import asyncio
+import os
+import struct
+import tempfile
+import time
+
+import randomizer
+from utils import run_command
+
+FORTUNE_CMD = "/usr/games/fortune"
+COWSAY_CMD = "/usr/games/cowsay"
+
+
+def write_fixture(fortunes_dir: str, count: int = 5000) -> None:
+    # strfile compatible database for machines without fortunes package
+    path = os.path.join(fortunes_dir, "fixture")
+    text = b""
+    offsets = []
+    for i in range(count):
+        offsets.append(len(text))
+        text += f"Fortune number {i} says hello to the benchmark".encode() + b"\n%\n"
+    offsets.append(len(text))
+    with open(path, "wb") as text_file:
+        text_file.write(text)
+    with open(f"{path}.dat", "wb") as index_file:
+        index_file.write(struct.pack(">5Ic3x", 2, count, 50, 40, 0, b"%"))
+        index_file.write(struct.pack(f">{len(offsets)}I", *offsets))
+
+
+async def subprocess_fortune() -> str:
+    fortune_line = await run_command(FORTUNE_CMD, "-s")
+    return await run_command(
+        COWSAY_CMD, "-W", str(randomizer.LINE_WIDTH), fortune_line.strip()
+    )
+
+
+async def measure(name: str, rounds: int, concurrency: int) -> None:
+    call = subprocess_fortune if name == "subprocess" else randomizer.fortune
+    args = () if name == "subprocess" else ("user",)
+    started = time.perf_counter()
+    for _ in range(rounds // concurrency):
+        await asyncio.gather(*[call(*args) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    print(f"{name}: {elapsed / rounds * 1000:.3f} ms per fortune")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="In-process vs subprocess fortune")
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if os.path.isdir(randomizer.FORTUNES_DIR):
+            started = time.perf_counter()
+            randomizer.load_fortunes()
+        else:
+            write_fixture(tmp_dir)
+            started = time.perf_counter()
+            randomizer.load_fortunes(tmp_dir)
+        print(f"databases loaded in {(time.perf_counter() - started) * 1000:.1f} ms")
+        asyncio.run(measure("in-process", args.rounds, args.concurrency))
+        if os.path.exists(FORTUNE_CMD) and os.path.exists(COWSAY_CMD):
+            asyncio.run(measure("subprocess", args.rounds, args.concurrency))
+        else:
+            print("subprocess: fortune or cowsay is not installed")
+
+
+if __name__ == "__main__":
+    main()
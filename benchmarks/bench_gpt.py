@@ -0,0 +1,111 @@
+# python -m benchmarks.bench_gpt
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import AsyncMock, MagicMock
+
+
+def make_handler(tokens: int, token_delay_sec: float):
+    class FakeCompletionsHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        requests = 0
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            FakeCompletionsHandler.requests += 1
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            for i in range(tokens):
+                chunk = {
+                    "id": "1",
+                    "object": "chat.completion.chunk",
+                    "created": 0,
+                    "model": "fake",
+                    "choices": [{"index": 0, "delta": {"content": f"token{i} "}}],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+                time.sleep(token_delay_sec)
+            self.wfile.write(b"data: [DONE]\n\n")
+
+    return FakeCompletionsHandler
+
+
+async def measure(edit_interval_sec: float) -> tuple[float, float]:
+    import main
+
+    main.GPT_EDIT_INTERVAL_SEC = edit_interval_sec
+    update = MagicMock()
+    update.message.text = "/gpt benchmark"
+    update.message.chat.type = "private"
+    context = MagicMock()
+    context.bot = AsyncMock()
+    answer_message = AsyncMock()
+    context.bot.send_message.return_value = answer_message
+    edits = []
+    answer_message.edit_text.side_effect = lambda *args, **kwargs: edits.append(
+        time.perf_counter()
+    )
+    started = time.perf_counter()
+    await main.ask_gpt(update, context)
+    return edits[0] - started, edits[-1] - started
+
+
+async def measure_burst(users: int, questions: int) -> list[float]:
+    from gpt import GPTGateway
+
+    gateway = GPTGateway()
+
+    async def ask(user):
+        started = time.perf_counter()
+        async for _ in gateway.ask(user, "role", f"question {user % questions}"):
+            pass
+        return time.perf_counter() - started
+
+    latencies = await asyncio.gather(*(ask(user) for user in range(users)))
+    print(f"gateway metrics: {dict(gateway.metrics)}")
+    return sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="/gpt time to first visible token")
+    parser.add_argument("--tokens", type=int, default=100)
+    parser.add_argument("--token-delay", type=float, default=0.05)
+    parser.add_argument("--edit-interval", type=float, default=1)
+    parser.add_argument(
+        "--burst", type=int, default=0, help="concurrent /gpt users to simulate"
+    )
+    parser.add_argument("--questions", type=int, default=5)
+    args = parser.parse_args()
+    handler = make_handler(args.tokens, args.token_delay)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_port}/v1"
+    if args.burst:
+        try:
+            latencies = asyncio.run(measure_burst(args.burst, args.questions))
+        finally:
+            server.shutdown()
+        print(f"upstream requests: {handler.requests} for {args.burst} users")
+        print(f"p50 answer: {latencies[len(latencies) // 2]:.2f}s")
+        print(f"max answer: {latencies[-1]:.2f}s")
+        return
+    try:
+        first_edit, last_edit = asyncio.run(measure(args.edit_interval))
+    finally:
+        server.shutdown()
+    print(f"first visible answer: {first_edit:.2f}s")
+    print(f"complete answer:      {last_edit:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+# python -m benchmarks.bench_import
+import argparse
+import re
+import statistics
+import subprocess
+import sys
+
+IMPORT_TIME_PATTERN = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+RSS_SNIPPET = (
+    "import resource, {module};"
+    "print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)"
+)
+
+
+def import_times(module: str) -> dict[str, int]:
+    # cumulative microseconds of top level imports of the module
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_PATTERN.match(line)
+        if match and len(match.group(3)) <= 2:
+            times[match.group(4)] = int(match.group(2))
+    return times
+
+
+def baseline_rss(module: str) -> int:
+    result = subprocess.run(
+        [sys.executable, "-c", RSS_SNIPPET.format(module=module)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return int(result.stdout.strip())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start import time and RSS")
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+    runs = [import_times(args.module) for _ in range(args.rounds)]
+    total = statistics.median(run[args.module] for run in runs)
+    print(f"import {args.module}: {total / 1000:.1f} ms (median of {args.rounds})")
+    heaviest = sorted(
+        (name for name in runs[-1] if name != args.module),
+        key=lambda name: runs[-1][name],
+        reverse=True,
+    )
+    for name in heaviest[: args.top]:
+        print(f"  {name:<24} {runs[-1][name] / 1000:8.1f} ms")
+    print(f"baseline RSS: {baseline_rss(args.module) / 1024:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
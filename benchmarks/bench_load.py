@@ -0,0 +1,524 @@
+# python -m benchmarks.bench_load
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs
+
+from PIL import Image
+from telegram import Update
+from telegram.ext import ApplicationBuilder, ExtBot, JobQueue
+from telegram.request import HTTPXRequest
+
+from benchmarks.bench_gpt import make_handler as make_gpt_handler
+
+TOKEN = "123456:LOAD"
+DEFAULT_MIX = "image=4,video=2,youtube=1,sword=1,fortune=1,gpt=1"
+FFMPEG_KINDS = {"video", "youtube"}
+# pipeline steps of main timed on every call
+STAGES = (
+    "check_link",
+    "download_file",
+    "download_image",
+    "dhash_image",
+    "dhash_video",
+    "is_animation",
+    "convert2MP4",
+    "convert2Animation",
+    "convert2JPG",
+    "get_youtube_media",
+)
+MULTIPART_CHAT_ID = re.compile(rb'name="chat_id"\r\n(?:[^\r\n]+\r\n)*\r\n(-?\d+)')
+
+
+class Stats:
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self.running = Counter()
+        self.peak = Counter()
+        self.submitted = {}
+        self.pending = Counter()
+        self.finished = {}
+        self.failed = set()
+
+    def record(self, stage: str, seconds: float) -> None:
+        self.durations[stage].append(seconds)
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        self.running[name] += 1
+        self.peak[name] = max(self.peak[name], self.running[name])
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+            self.running[name] -= 1
+
+    # a chat is done when its handler and every job it scheduled are over
+    def start_work(self, chat_id: int) -> None:
+        self.pending[chat_id] += 1
+
+    def end_work(self, chat_id: int) -> None:
+        self.pending[chat_id] -= 1
+        if not self.pending[chat_id]:
+            self.finished[chat_id] = time.perf_counter()
+
+
+# replaced at every rate step, startup calls land in a throwaway one
+stats = Stats()
+
+
+class TimedBot(ExtBot):
+    __slots__ = ()
+
+    async def _post(self, endpoint, *args, **kwargs):
+        with stats.stage("bot api"):
+            return await super()._post(endpoint, *args, **kwargs)
+
+
+class TimedJobQueue(JobQueue):
+    __slots__ = ()
+
+    def run_once(self, callback, when, *args, chat_id=None, **kwargs):
+        step = stats
+        scheduled = time.perf_counter() + (when if isinstance(when, int | float) else 0)
+        step.start_work(chat_id)
+
+        async def timed(context):
+            step.record("job queue", time.perf_counter() - scheduled)
+            try:
+                with step.stage(callback.__name__):
+                    return await callback(context)
+            finally:
+                step.end_work(chat_id)
+
+        timed.__name__ = callback.__name__
+        return super().run_once(timed, when, *args, chat_id=chat_id, **kwargs)
+
+
+def timed_handler(callback):
+    async def wrapper(update, context):
+        step = stats
+        chat_id = update.effective_chat.id
+        _, submitted = step.submitted[chat_id]
+        step.record("update queue", time.perf_counter() - submitted)
+        step.start_work(chat_id)
+        try:
+            with step.stage(callback.__name__):
+                return await callback(update, context)
+        finally:
+            step.end_work(chat_id)
+
+    return wrapper
+
+
+def timed_stage(name: str, func):
+    async def wrapper(*args, **kwargs):
+        with stats.stage(name):
+            return await func(*args, **kwargs)
+
+    return wrapper
+
+
+async def track_error(update, context) -> None:
+    job = getattr(context, "job", None)
+    chat_id = job.chat_id if job else getattr(update.effective_chat, "id", None)
+    stats.failed.add(chat_id)
+
+
+def _get_chat_id(content_type: str, body: bytes) -> int:
+    if content_type.startswith("multipart/"):
+        match = MULTIPART_CHAT_ID.search(body)
+        return int(match.group(1)) if match else 0
+    values = parse_qs(body.decode()).get("chat_id") or ["0"]
+    return int(values[0])
+
+
+def _fake_message(method: str, chat_id: int, message_id: int) -> dict:
+    message = {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+    }
+    media = {
+        "file_id": f"file-{message_id}",
+        "file_unique_id": f"unique-{message_id}",
+        "width": 640,
+        "height": 360,
+        "duration": 10,
+    }
+    if method == "sendVideo":
+        message["video"] = media
+    elif method == "sendAnimation":
+        message["animation"] = media
+    elif method == "sendPhoto":
+        message["photo"] = [{**media, "duration": None}]
+    elif method == "sendAudio":
+        message["audio"] = media
+    elif method == "sendDocument":
+        message["document"] = media
+    else:
+        message["text"] = "ok"
+    return message
+
+
+def make_bot_api(latency_sec: float, upload_mbps: float):
+    class FakeBotAPI(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        message_ids = itertools.count(1)
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            method = self.path.rsplit("/", 1)[-1]
+            chat_id = _get_chat_id(self.headers.get("Content-Type", ""), body)
+            # uploads cost their size over the configured bandwidth
+            delay = latency_sec
+            if upload_mbps:
+                delay += len(body) / (upload_mbps * 125_000)
+            time.sleep(delay)
+            message_id = next(FakeBotAPI.message_ids)
+            if method == "getMe":
+                result = {
+                    "id": 1,
+                    "is_bot": True,
+                    "first_name": "load",
+                    "username": "memes2telegram_bot",
+                }
+            elif method in ("deleteMessage", "answerInlineQuery"):
+                result = True
+            elif method == "sendMediaGroup":
+                result = [_fake_message("sendDocument", chat_id, message_id)]
+            else:
+                result = _fake_message(method, chat_id, message_id)
+            payload = json.dumps({"ok": True, "result": result}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    return FakeBotAPI
+
+
+def make_media_server(image: bytes, video: bytes, latency_sec: float):
+    class FakeMedia(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send_headers(self) -> bytes:
+            time.sleep(latency_sec)
+            content, content_type = image, "image/jpeg"
+            if self.path.startswith("/video/"):
+                content, content_type = video, "video/mp4"
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            return content
+
+        def do_HEAD(self):
+            self._send_headers()
+
+        def do_GET(self):
+            self.wfile.write(self._send_headers())
+
+    return FakeMedia
+
+
+def serve(handler) -> tuple[ThreadingHTTPServer, str]:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def make_image() -> bytes:
+    with BytesIO() as image:
+        noise = Image.effect_noise((320, 180), 64).convert("RGB")
+        noise.resize((1280, 720)).save(image, "JPEG", quality=90)
+        return image.getvalue()
+
+
+def make_video(path: str, duration: int) -> None:
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-v",
+            "error",
+            "-f",
+            "lavfi",
+            "-i",
+            f"testsrc2=size=640x360:rate=25:duration={duration}",
+            "-f",
+            "lavfi",
+            "-i",
+            f"sine=frequency=440:duration={duration}",
+            "-c:v",
+            "mpeg4",
+            "-c:a",
+            "mp3",
+            path,
+        ],
+        check=True,
+    )
+
+
+def make_update(update_id: int, kind: str, media_url: str) -> dict:
+    chat_id = 1_000_000 + update_id
+    text = {
+        "image": f"{media_url}/image/{update_id}.jpg",
+        "video": f"{media_url}/video/{update_id}.mp4",
+        "youtube": f"https://www.youtube.com/watch?v=load{update_id}",
+        "sword": "/sword",
+        "fortune": "/fortune",
+        "gpt": f"/gpt question {update_id % 5}",
+    }[kind]
+    entity = "bot_command" if text.startswith("/") else "url"
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"},
+            "text": text,
+            "entities": [{"type": entity, "offset": 0, "length": len(text.split()[0])}],
+        },
+    }
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run_step(application, rate, duration, mix, media_url, drain_sec, ids, rng):
+    global stats
+    stats = step = Stats()
+    kinds, weights = zip(*mix.items())
+    started = time.perf_counter()
+    while time.perf_counter() - started < duration:
+        kind = rng.choices(kinds, weights)[0]
+        data = make_update(next(ids), kind, media_url)
+        step.submitted[data["message"]["chat"]["id"]] = (kind, time.perf_counter())
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        # poisson arrivals, like independent chats
+        await asyncio.sleep(rng.expovariate(rate))
+    drain_until = time.perf_counter() + drain_sec
+    while len(step.finished) < len(step.submitted):
+        if time.perf_counter() > drain_until:
+            break
+        await asyncio.sleep(0.1)
+    return step
+
+
+def summarize(rate: float, step: Stats) -> dict:
+    latencies = defaultdict(list)
+    for chat_id, (kind, submitted) in step.submitted.items():
+        if chat_id in step.finished:
+            latencies[kind].append(step.finished[chat_id] - submitted)
+    done = sum(len(values) for values in latencies.values())
+    total = len(step.submitted)
+    unfinished = step.submitted.keys() - step.finished.keys()
+    submits = [submitted for _, submitted in step.submitted.values()]
+    first = min(submits)
+    last = max(step.finished.values(), default=first)
+    everything = [value for values in latencies.values() for value in values]
+    return dict(
+        rate=rate,
+        total=total,
+        # poisson arrivals drift from the nominal rate on short steps
+        offered=total / (max(submits) - first) if total > 1 else 0.0,
+        throughput=done / (last - first) if last > first else 0.0,
+        errors=len(step.failed | unfinished) / total if total else 0.0,
+        p50=percentile(everything, 0.5),
+        p95=percentile(everything, 0.95),
+        kinds={kind: percentile(values, 0.95) for kind, values in latencies.items()},
+        stages={
+            stage: (
+                len(values),
+                percentile(values, 0.5),
+                percentile(values, 0.95),
+                step.peak[stage],
+            )
+            for stage, values in sorted(step.durations.items())
+        },
+    )
+
+
+def print_summary(summary: dict) -> None:
+    print(
+        f"rate {summary['rate']:g}/s: {summary['total']} updates"
+        f" at {summary['offered']:.2f}/s,"
+        f" {summary['throughput']:.2f}/s done, {summary['errors']:.1%} errors,"
+        f" latency p50 {summary['p50']:.2f}s p95 {summary['p95']:.2f}s"
+    )
+    kinds = ", ".join(f"{kind} {p95:.2f}s" for kind, p95 in summary["kinds"].items())
+    print(f"  p95 by kind: {kinds}")
+    print(f"  {'stage':<28} {'calls':>6} {'p50':>8} {'p95':>8} {'peak':>5}")
+    for stage, (calls, p50, p95, peak) in summary["stages"].items():
+        print(f"  {stage:<28} {calls:>6} {p50:>7.3f}s {p95:>7.3f}s {peak:>5}")
+
+
+# the lightest step is the baseline, errors it already has are not load.
+# throughput is only reported: the drain tail skews it on short steps, while
+# a growing backlog shows up in latency or as undrained updates anyway
+def is_saturated(summary: dict, baseline: dict) -> bool:
+    max_p95 = 3 * max(baseline["p95"], 0.1)
+    return summary["errors"] > baseline["errors"] + 0.05 or summary["p95"] > max_p95
+
+
+def find_bottleneck(summary: dict, baseline: dict) -> tuple[str, float]:
+    # the stage whose tail grew the most since the lightest load, ignoring
+    # millisecond stages whose ratios are noise
+    growth = {
+        stage: p95 / max(baseline["stages"][stage][2], 0.001)
+        for stage, (_, _, p95, _) in summary["stages"].items()
+        if stage in baseline["stages"] and p95 - baseline["stages"][stage][2] > 0.05
+    }
+    return max(growth.items(), key=lambda item: item[1], default=("none", 1.0))
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    return {
+        kind: float(weight)
+        for kind, weight in (item.split("=") for item in mix.split(","))
+    }
+
+
+async def run(args, mix, media_url) -> list[dict]:
+    import main
+
+    request = HTTPXRequest(
+        connection_pool_size=256,
+        read_timeout=30,
+        write_timeout=30,
+        connect_timeout=30,
+        pool_timeout=30,
+    )
+    bot = TimedBot(TOKEN, base_url=f"{args.bot_api_url}/bot", request=request)
+    application = (
+        ApplicationBuilder()
+        .bot(bot)
+        .job_queue(TimedJobQueue())
+        .concurrent_updates(True)
+        .build()
+    )
+    main.add_handlers(application)
+    application.add_error_handler(track_error)
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = timed_handler(handler.callback)
+    for stage in STAGES:
+        setattr(main, stage, timed_stage(stage, getattr(main, stage)))
+    if not args.countdown:
+        main.get_countdown = lambda *args, **kwargs: 0
+    ids = itertools.count(1)
+    rng = random.Random(args.seed)
+    summaries = []
+    async with application:
+        await application.start()
+        for rate in args.rates:
+            step = await run_step(
+                application, rate, args.duration, mix, media_url, args.drain, ids, rng
+            )
+            summaries.append(summarize(rate, step))
+            print_summary(summaries[-1])
+        await application.stop()
+    return summaries
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Ramp synthetic updates through the real handler stack"
+        " against a fake Bot API and report where it saturates"
+    )
+    parser.add_argument("--rates", nargs="+", type=float, default=[0.5, 1, 2, 4, 8])
+    parser.add_argument("--duration", type=float, default=30, help="seconds per rate")
+    parser.add_argument("--drain", type=float, default=120)
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--video-sec", type=int, default=10)
+    parser.add_argument("--api-latency-ms", type=float, default=50)
+    parser.add_argument("--upload-mbps", type=float, default=50)
+    parser.add_argument("--media-latency-ms", type=float, default=100)
+    parser.add_argument("--ytdlp-sec", type=float, default=2)
+    parser.add_argument(
+        "--countdown", action="store_true", help="keep random job delays of the bot"
+    )
+    args = parser.parse_args()
+    mix = parse_mix(args.mix)
+    if not shutil.which("ffmpeg") and FFMPEG_KINDS & mix.keys():
+        print("no ffmpeg - dropping video and youtube updates")
+        mix = {kind: weight for kind, weight in mix.items() if kind not in FFMPEG_KINDS}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.environ["SOURCE_CACHE_DIR"] = os.path.join(tmp_dir, "sources")
+        video_path = os.path.join(tmp_dir, "video.mp4")
+        video = b""
+        if FFMPEG_KINDS & mix.keys():
+            make_video(video_path, args.video_sec)
+            with open(video_path, "rb") as file:
+                video = file.read()
+        servers = []
+        server, args.bot_api_url = serve(
+            make_bot_api(args.api_latency_ms / 1000, args.upload_mbps)
+        )
+        servers.append(server)
+        server, media_url = serve(
+            make_media_server(make_image(), video, args.media_latency_ms / 1000)
+        )
+        servers.append(server)
+        server, gpt_url = serve(make_gpt_handler(50, 0.02))
+        servers.append(server)
+        os.environ["OPENAI_BASE_URL"] = f"{gpt_url}/v1"
+        os.environ.setdefault("OPENAI_API_KEY", "load")
+
+        import main as bot_main
+        from scraper import MEDIA_VIDEO
+
+        async def get_youtube_media(link, deadline=None):
+            # yt-dlp stand-in: extraction wait, then a file to convert
+            await asyncio.sleep(args.ytdlp_sec)
+            filename = os.path.join(tempfile.gettempdir(), f"{uuid.uuid4().hex}.mp4")
+            shutil.copyfile(video_path, filename)
+            return filename, "load test", MEDIA_VIDEO
+
+        bot_main.get_youtube_media = get_youtube_media
+        try:
+            summaries = asyncio.run(run(args, mix, media_url))
+        finally:
+            for server in servers:
+                server.shutdown()
+    baseline = summaries[0]
+    for previous, summary in zip(summaries, summaries[1:]):
+        if not is_saturated(summary, baseline):
+            continue
+        stage, growth = find_bottleneck(summary, baseline)
+        print(f"saturated at {summary['rate']:g}/s, sustained {previous['rate']:g}/s")
+        print(f"first stage to saturate: {stage} (p95 x{growth:.1f})")
+        return
+    print(f"not saturated up to {summaries[-1]['rate']:g}/s")
+
+
+if __name__ == "__main__":
+    main()
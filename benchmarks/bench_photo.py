@@ -0,0 +1,92 @@
+# python -m benchmarks.bench_photo
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from io import BytesIO
+
+from PIL import Image
+
+from converter import PHOTO_MAX_SIDE, PHOTO_QUALITY, _prepare_photo
+
+
+def _full_decode(content: bytes) -> bytes:
+    # what sending a big image used to cost: full decode and re-encode
+    with BytesIO(content) as source, BytesIO() as converted:
+        with Image.open(source) as image:
+            image.load()
+            image.convert("RGB").save(converted, "JPEG", quality=95)
+        return converted.getvalue()
+
+
+def _full_decode_resize(content: bytes) -> bytes:
+    with BytesIO(content) as source, BytesIO() as converted:
+        with Image.open(source) as image:
+            image = image.convert("RGB")
+            image.thumbnail((PHOTO_MAX_SIDE, PHOTO_MAX_SIDE), reducing_gap=None)
+            image.save(converted, "JPEG", quality=PHOTO_QUALITY, optimize=True)
+        return converted.getvalue()
+
+
+VARIANTS = {
+    "full decode": _full_decode,
+    "full decode + resize": _full_decode_resize,
+    "draft + reduce": _prepare_photo,
+}
+
+
+def make_fixture(path: str, width: int, height: int) -> None:
+    # noise defeats JPEG compression and looks like a photo to the encoder
+    noise = Image.effect_noise((width // 4, height // 4), 64).convert("RGB")
+    noise.resize((width, height)).save(path, "JPEG", quality=92)
+
+
+def _measure(name: str, path: str, queue) -> None:
+    with open(path, "rb") as file:
+        content = file.read()
+    started = time.perf_counter()
+    converted = VARIANTS[name](content)
+    elapsed = time.perf_counter() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((elapsed, peak, len(converted)))
+
+
+def measure(name: str, path: str) -> tuple[float, int, int]:
+    # fresh process per run so peak RSS is not shared between variants
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_measure, args=(name, path, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Photo preparation time and peak memory on large JPEGs"
+    )
+    parser.add_argument(
+        "--sizes", nargs="+", default=["4000x3000", "8000x6000", "12000x8000"]
+    )
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in args.sizes:
+            width, height = map(int, size.split("x"))
+            path = os.path.join(tmp_dir, f"{size}.jpg")
+            make_fixture(path, width, height)
+            source_size = os.path.getsize(path) / 1024
+            print(f"{size} ({source_size:.0f} KB)")
+            for name in VARIANTS:
+                elapsed, peak_kb, output_size = measure(name, path)
+                print(
+                    f"  {name:<22} {elapsed * 1000:8.1f} ms"
+                    f" {peak_kb / 1024:8.1f} MB peak RSS"
+                    f" {output_size / 1024:8.0f} KB out"
+                )
+
+
+if __name__ == "__main__":
+    main()
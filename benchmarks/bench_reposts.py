@@ -0,0 +1,35 @@
+# python -m benchmarks.bench_reposts
+import argparse
+import random
+import time
+
+from reposts import Repost, RepostIndex
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Repost index lookup latency")
+    parser.add_argument("--entries", type=int, default=300_000)
+    parser.add_argument("--lookups", type=int, default=10_000)
+    args = parser.parse_args()
+    rng = random.Random(42)
+    index = RepostIndex(maxsize=args.entries)
+    hashes = [rng.getrandbits(64) for _ in range(args.entries)]
+    started = time.perf_counter()
+    for position, value in enumerate(hashes):
+        index.add(value, Repost("photo", f"file-{position}", position))
+    print(f"built {len(index)} entries in {time.perf_counter() - started:.2f}s")
+    # near duplicates are known hashes with a few flipped bits
+    hits = [
+        rng.choice(hashes) ^ (1 << rng.randrange(64)) ^ (1 << rng.randrange(64))
+        for _ in range(args.lookups)
+    ]
+    misses = [rng.getrandbits(64) for _ in range(args.lookups)]
+    for name, queries in (("hit", hits), ("miss", misses)):
+        started = time.perf_counter()
+        found = sum(index.find(query) is not None for query in queries)
+        elapsed = (time.perf_counter() - started) / len(queries)
+        print(f"{name}: {elapsed * 1_000_000:.1f} us per lookup, {found} found")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+# python -m benchmarks.bench_segments
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import converter
+from benchmarks.bench_encode import make_fixture
+from converter import MP4_ENCODE_ARGS, get_cpus
+
+
+async def _single(path: str, preset: str):
+    return await converter._encode_video(path, MP4_ENCODE_ARGS, True, preset)
+
+
+async def _segmented(path: str, preset: str):
+    return await converter._encode_segmented(path, MP4_ENCODE_ARGS, preset)
+
+
+VARIANTS = {"single ffmpeg": _single, "segmented": _segmented}
+
+
+async def measure(name: str, path: str, preset: str) -> tuple[float, int | None]:
+    started = time.perf_counter()
+    converted = await VARIANTS[name](path, preset)
+    elapsed = time.perf_counter() - started
+    size = os.path.getsize(converted.filename)
+    os.remove(converted.filename)
+    if converted.thumbnail:
+        os.remove(converted.thumbnail)
+    return elapsed, size
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Single process vs segment-parallel encoding of a long clip"
+    )
+    parser.add_argument("--duration", type=int, default=600)
+    parser.add_argument("--size", default="1280x720")
+    parser.add_argument(
+        "--segment-sec", type=int, default=converter.SEGMENT_DURATION_SEC
+    )
+    parser.add_argument("--preset", default="slow")
+    args = parser.parse_args()
+    converter.SEGMENT_DURATION_SEC = args.segment_sec
+    print(f"{len(get_cpus())} cpus, {args.duration}s {args.size} clip")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "clip.mkv")
+        make_fixture(path, args.duration, args.size)
+        baseline = None
+        for name in VARIANTS:
+            elapsed, size = asyncio.run(measure(name, path, args.preset))
+            baseline = baseline or elapsed
+            print(
+                f"  {name:<14} {elapsed:8.2f} s {baseline / elapsed:5.2f}x"
+                f" {size / 1024:8.0f} KB out"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+# python -m benchmarks.bench_tiles
+import argparse
+import asyncio
+import resource
+import time
+from io import BytesIO
+
+from PIL import Image
+
+from converter import tile_photo
+
+
+def make_fixture(width: int, height: int) -> bytes:
+    # noise defeats JPEG compression like real screenshots and comics do
+    noise = Image.effect_noise((width // 4, height // 4), 64).convert("RGB")
+    with BytesIO() as buffer:
+        noise.resize((width, height)).save(buffer, "JPEG", quality=90)
+        return buffer.getvalue()
+
+
+async def measure(content: bytes, rounds: int) -> tuple[float, int, int]:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        tiles = await tile_photo(content)
+    elapsed = (time.perf_counter() - started) / rounds
+    return elapsed, len(tiles), sum(len(tile) for tile in tiles)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Longpost tiling throughput")
+    parser.add_argument("--sizes", nargs="+", default=["800x20000", "2000x20000"])
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+    for size in args.sizes:
+        width, height = map(int, size.split("x"))
+        content = make_fixture(width, height)
+        elapsed, tiles_count, tiles_size = asyncio.run(measure(content, args.rounds))
+        print(
+            f"{size} ({len(content) / 1024:.0f} KB): {elapsed * 1000:.1f} ms,"
+            f" {tiles_count} tiles ({tiles_count / elapsed:.1f} tiles/s),"
+            f" {tiles_size / 1024:.0f} KB out"
+        )
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"peak RSS {peak_rss:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
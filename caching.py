@@ -0,0 +1,206 @@
+import asyncio
+import functools
+import logging
+import pickle
+import sqlite3
+import sys
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+CACHES: dict[str, "Cache"] = {}
+_MISSING = object()
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    coalesced: int = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.0
+
+
+class Cache:
+    def __init__(
+        self,
+        name: str,
+        maxsize: int = 128,
+        ttl: float | None = None,
+        max_bytes: int | None = None,
+        sizeof=sys.getsizeof,
+        path: str | None = None,
+    ):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.path = path
+        self.bytes = 0
+        self.stats = CacheStats()
+        self._data: OrderedDict = OrderedDict()
+        self._pending: dict = {}
+        self._db = None
+        CACHES[name] = self
+
+    def __len__(self) -> int:
+        self._open()
+        return len(self._data)
+
+    def __contains__(self, key) -> bool:
+        self._open()
+        entry = self._data.get(key)
+        return entry is not None and not self._is_expired(entry)
+
+    def persist(self, path: str | None) -> None:
+        if path and path != self.path:
+            self.path = path
+            self._db = None
+            self._open()
+
+    def _open(self) -> None:
+        # the database mirrors memory, it is read once so restarts keep entries
+        if not self.path or self._db is not None:
+            return
+        self._db = sqlite3.connect(self.path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cache"
+            " (name TEXT, key BLOB, value BLOB, expires REAL,"
+            " PRIMARY KEY (name, key))"
+        )
+        self._db.execute(
+            "DELETE FROM cache WHERE name = ? AND expires <= ?",
+            (self.name, time.time()),
+        )
+        rows = self._db.execute(
+            "SELECT key, value, expires FROM cache WHERE name = ? ORDER BY rowid",
+            (self.name,),
+        )
+        for key, value, expires in rows.fetchall():
+            self._put(pickle.loads(key), pickle.loads(value), expires)
+        self._db.commit()
+        logger.info(
+            "Loaded %d %s cache entries from %s", len(self._data), self.name, self.path
+        )
+
+    @staticmethod
+    def _is_expired(entry) -> bool:
+        _, expires, _ = entry
+        return expires is not None and expires <= time.time()
+
+    def get(self, key, default=None):
+        self._open()
+        entry = self._data.get(key)
+        if entry is not None:
+            if not self._is_expired(entry):
+                self._data.move_to_end(key)
+                self.stats.hits += 1
+                return entry[0]
+            self.stats.expirations += 1
+            self.delete(key)
+        self.stats.misses += 1
+        return default
+
+    def set(self, key, value) -> None:
+        self._open()
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        if not self._put(key, value, expires):
+            return
+        if self._db is not None:
+            self._db.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                (self.name, pickle.dumps(key), pickle.dumps(value), expires),
+            )
+            self._db.commit()
+
+    def _put(self, key, value, expires) -> bool:
+        size = self.sizeof(value) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes:
+            return False
+        self._discard(key)
+        self._data[key] = (value, expires, size)
+        self.bytes += size
+        while len(self._data) > self.maxsize or (
+            self.max_bytes and self.bytes > self.max_bytes
+        ):
+            evicted = next(iter(self._data))
+            self.stats.evictions += 1
+            self.delete(evicted)
+        return True
+
+    def _discard(self, key) -> bool:
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return False
+        self.bytes -= entry[2]
+        return True
+
+    def delete(self, key) -> None:
+        if self._discard(key) and self._db is not None:
+            self._db.execute(
+                "DELETE FROM cache WHERE name = ? AND key = ?",
+                (self.name, pickle.dumps(key)),
+            )
+            self._db.commit()
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.bytes = 0
+        if self._db is not None:
+            self._db.execute("DELETE FROM cache WHERE name = ?", (self.name,))
+            self._db.commit()
+
+    async def get_or_set(self, key, factory):
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        # concurrent misses of the same key wait for a single factory call
+        task = self._pending.get(key)
+        if task is None:
+            task = self._pending[key] = asyncio.ensure_future(self._fill(key, factory))
+        else:
+            self.stats.coalesced += 1
+        return await asyncio.shield(task)
+
+    async def _fill(self, key, factory):
+        try:
+            value = await factory()
+            self.set(key, value)
+            return value
+        finally:
+            self._pending.pop(key, None)
+
+
+def cached(name: str | None = None, key=None, **cache_kwargs):
+    def decorator(func):
+        cache = Cache(name or func.__qualname__, **cache_kwargs)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            cache_key = key(*args, **kwargs) if key else (args, tuple(kwargs.items()))
+            return await cache.get_or_set(cache_key, lambda: func(*args, **kwargs))
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
+
+
+def get_cache_stats() -> dict[str, dict]:
+    return {
+        name: dict(
+            size=len(cache._data),
+            bytes=cache.bytes,
+            hit_ratio=round(cache.stats.hit_ratio, 3),
+            **vars(cache.stats),
+        )
+        for name, cache in CACHES.items()
+    }
@@ -1,13 +1,236 @@
 import asyncio
+import contextlib
+import functools
+import json
 import logging
+import math
+import os
+import shutil
+import struct
 import tempfile
+from collections import Counter
 from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import NamedTuple
 
 from PIL import Image
 
-from utils import run_command, which
+from caching import cached
+from utils import (
+    CMDException,
+    deadline_exceeded,
+    gather_or_cancel,
+    run_command,
+    which,
+)
 
 logger = logging.getLogger(__name__)
+# telegram stores photos downscaled to this size anyway
+PHOTO_MAX_SIDE = 2560
+PHOTO_QUALITY = 87
+# longposts are sliced into overlapping tiles of width x (width * ratio)
+TILE_MAX_WIDTH = 1280
+TILE_RATIO = 2
+TILE_OVERLAP = 0.1
+MAX_TILES = 30
+# decoded source pixels, enough for MAX_TILES tiles of the widest size
+TILE_MAX_SOURCE_PIXELS = TILE_MAX_WIDTH * TILE_MAX_WIDTH * TILE_RATIO * MAX_TILES
+REQUIRED_ENCODERS = ("libx264", "aac")
+PROBE_TIMEOUT_SEC = 30
+# the same file is probed for animation, streamability and duration
+PROBE_CACHE_TTL_SEC = 600
+# RIFF size, WEBP tag, VP8X chunk header and its flags byte
+WEBP_HEADER_SIZE = 21
+# what telegram clients play without server side re-encoding
+STREAMABLE_VIDEO = {("h264", "yuv420p")}
+STREAMABLE_AUDIO = {"aac", "mp3"}
+EVEN_SCALE = "scale=trunc(iw/2)*2:trunc(ih/2)*2"
+# telegram wants video thumbnails as JPEG up to 320px
+THUMBNAIL_FILTER = (
+    r"scale=min(320\,iw):min(320\,ih):force_original_aspect_ratio=decrease,"
+    "thumbnail=25"
+)
+MP4_ENCODE_ARGS = [
+    "-profile:v",
+    "main",
+    "-level",
+    "3.1",
+    "-movflags",
+    "+faststart",
+    "-crf",
+    "29",
+    "-c:a",
+    "aac",
+    "-b:v",
+    "500k",
+    "-pix_fmt",
+    "yuv420p",
+    "-c:v",
+    "libx264",
+    "-fps_mode",
+    "auto",
+]
+ANIMATION_ENCODE_ARGS = [
+    "-profile:v",
+    "main",
+    "-level",
+    "3.1",
+    "-movflags",
+    "+faststart",
+    "-crf",
+    "28",
+    "-pix_fmt",
+    "yuv420p",
+    "-c:v",
+    "libx264",
+    "-tune",
+    "animation",
+]
+# long videos are cut at keyframes and their segments are encoded in parallel
+SEGMENTED_MIN_DURATION_SEC = 180
+SEGMENT_DURATION_SEC = 30
+# smaller files encode fast enough without even probing their duration
+SEGMENTED_MIN_SIZE = 4 * 1024 * 1024
+# x264 presets from the fastest to the slowest
+X264_PRESETS = (
+    "ultrafast",
+    "superfast",
+    "veryfast",
+    "faster",
+    "fast",
+    "medium",
+    "slow",
+    "slower",
+    "veryslow",
+)
+# encodes per core -> slowest preset that still keeps the queue moving
+PRESETS_BY_LOAD = ((0.5, "slow"), (1, "medium"), (2, "fast"), (math.inf, "veryfast"))
+# pillow releases GIL while decoding, resizing and encoding
+photo_executor = ThreadPoolExecutor(
+    max_workers=os.cpu_count(), thread_name_prefix="photo"
+)
+
+
+async def check_ffmpeg() -> None:
+    ffmpeg_cmd = await which("ffmpeg")
+    encoders = await run_command(ffmpeg_cmd, "-hide_banner", "-encoders")
+    missing = [
+        encoder for encoder in REQUIRED_ENCODERS if f" {encoder} " not in encoders
+    ]
+    if missing:
+        raise CMDException(f"{ffmpeg_cmd} has no {', '.join(missing)} encoders")
+    ffprobe_cmd = await which("ffprobe")
+    await run_command(ffprobe_cmd, "-version")
+
+
+class ConvertedVideo(NamedTuple):
+    filename: str
+    width: int | None
+    height: int | None
+    duration: int | None
+    thumbnail: str | None
+
+
+def _iter_boxes(file, end: int):
+    while file.tell() + 8 <= end:
+        start = file.tell()
+        size, kind = struct.unpack(">I4s", file.read(8))
+        if size == 1:
+            (size,) = struct.unpack(">Q", file.read(8))
+        elif size == 0:
+            size = end - start
+        if size < 8:
+            return
+        yield kind, file.tell(), start + size
+        file.seek(start + size)
+
+
+def read_mp4_metadata(filename: str) -> tuple[int | None, int | None, int | None]:
+    # faststart puts moov first, so this reads a few kilobytes at most
+    width = height = duration = None
+    with open(filename, "rb") as file:
+        end = os.fstat(file.fileno()).st_size
+        for kind, start, box_end in _iter_boxes(file, end):
+            if kind != b"moov":
+                continue
+            file.seek(start)
+            for kind, start, trak_end in _iter_boxes(file, box_end):
+                if kind == b"mvhd":
+                    file.seek(start)
+                    version = file.read(1)[0]
+                    file.seek(start + (20 if version else 12))
+                    timescale, length = struct.unpack(
+                        ">IQ" if version else ">II", file.read(12 if version else 8)
+                    )
+                    duration = round(length / timescale) if timescale else None
+                elif kind == b"trak" and width is None:
+                    file.seek(start)
+                    for kind, start, _ in _iter_boxes(file, trak_end):
+                        if kind != b"tkhd":
+                            continue
+                        file.seek(start)
+                        version = file.read(1)[0]
+                        file.seek(start + (88 if version else 76))
+                        track_width, track_height = struct.unpack(">II", file.read(8))
+                        # 16.16 fixed point, audio tracks have zero size
+                        if track_width and track_height:
+                            width, height = track_width >> 16, track_height >> 16
+                    file.seek(trak_end)
+            break
+    return width, height, duration
+
+
+def get_cpus() -> tuple[int, ...]:
+    if hasattr(os, "sched_getaffinity"):
+        return tuple(sorted(os.sched_getaffinity(0)))
+    return tuple(range(os.cpu_count() or 1))
+
+
+class EncodeBudget(NamedTuple):
+    threads: int
+    preset: str
+    cpus: tuple[int, ...] | None
+
+
+class CPUAllocator:
+    def __init__(self, cpus: tuple[int, ...], pin: bool = False):
+        self.cpus = cpus
+        self.pin = pin
+        self.active = 0
+        self.threads = 0
+        self._pinned = Counter(dict.fromkeys(cpus, 0))
+
+    def get_preset(self, requested: str) -> str:
+        load = self.active / len(self.cpus)
+        preset = next(preset for limit, preset in PRESETS_BY_LOAD if load <= limit)
+        # load only ever speeds an encode up, never slows it down
+        return min(preset, requested, key=X264_PRESETS.index)
+
+    @contextlib.contextmanager
+    def allocate(self, preset: str):
+        self.active += 1
+        cores = len(self.cpus)
+        # running encodes keep their threads, a newcomer gets the idle cores
+        # or at least a fair share of the machine
+        threads = min(cores, max(cores // self.active, cores - self.threads))
+        cpus = None
+        if self.pin:
+            least_busy = sorted(self.cpus, key=self._pinned.__getitem__)
+            cpus = tuple(sorted(least_busy[:threads]))
+            self._pinned.update(cpus)
+        self.threads += threads
+        try:
+            yield EncodeBudget(threads, self.get_preset(preset), cpus)
+        finally:
+            self.active -= 1
+            self.threads -= threads
+            if cpus:
+                self._pinned.subtract(cpus)
+
+
+@functools.cache
+def get_cpu_allocator() -> CPUAllocator:
+    return CPUAllocator(get_cpus(), pin=os.getenv("FFMPEG_PIN_CPUS") == "1")
 
 
 def _get_converted_name(ext: str) -> str:
@@ -15,63 +238,452 @@ def _get_converted_name(ext: str) -> str:
         return tmp_file.name
 
 
-async def convert2MP4(filename: str) -> str:
+async def _run_ffmpeg(
+    ffmpeg_args: list,
+    outputs: list,
+    timeout: float | None,
+    cpus: tuple[int, ...] | None = None,
+):
+    ffmpeg_cmd = await which("ffmpeg")
+    try:
+        await run_command(ffmpeg_cmd, *ffmpeg_args, timeout=timeout, cpus=cpus)
+    except BaseException:
+        # killed or failed ffmpeg leaves truncated outputs behind
+        for output in outputs:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(output)
+        raise
+
+
+def _get_encode_args(
+    filename: str,
+    converted_name: str,
+    thumbnail_name: str | None,
+    encode_args: list,
+    audio: bool,
+    budget: EncodeBudget,
+) -> list:
+    threads = str(budget.threads)
+    filters = f"[0:v]{EVEN_SCALE}[video]"
+    thumbnail_args = []
+    if thumbnail_name:
+        # one decode feeds both the encoder and the thumbnail picker
+        filters = (
+            f"[0:v]{EVEN_SCALE},split=2[video][frames];"
+            f"[frames]{THUMBNAIL_FILTER}[thumbnail]"
+        )
+        thumbnail_args = [
+            "-map",
+            "[thumbnail]",
+            "-frames:v",
+            "1",
+            "-update",
+            "1",
+            "-q:v",
+            "5",
+            thumbnail_name,
+        ]
+    return [
+        "-filter_complex_threads",
+        threads,
+        "-i",
+        filename,
+        "-filter_complex",
+        filters,
+        "-map",
+        "[video]",
+        *(["-map", "0:a:0?"] if audio else ["-an"]),
+        *encode_args,
+        "-preset",
+        budget.preset,
+        "-threads",
+        threads,
+        converted_name,
+        *thumbnail_args,
+    ]
+
+
+def _get_converted_video(converted_name: str, thumbnail_name: str) -> ConvertedVideo:
+    if not os.path.exists(thumbnail_name):
+        thumbnail_name = None
+    return ConvertedVideo(
+        converted_name, *read_mp4_metadata(converted_name), thumbnail_name
+    )
+
+
+async def _encode_video(
+    filename: str,
+    encode_args: list,
+    audio: bool,
+    preset: str,
+    timeout: float | None = None,
+) -> ConvertedVideo:
     converted_name = _get_converted_name("mp4")
+    thumbnail_name = _get_converted_name("jpg")
+    with get_cpu_allocator().allocate(preset) as budget:
+        logger.info(
+            "Encoding %s with %d threads and %s preset",
+            filename,
+            budget.threads,
+            budget.preset,
+        )
+        ffmpeg_args = _get_encode_args(
+            filename, converted_name, thumbnail_name, encode_args, audio, budget
+        )
+        outputs = [converted_name, thumbnail_name]
+        await _run_ffmpeg(ffmpeg_args, outputs, timeout, budget.cpus)
+    return _get_converted_video(converted_name, thumbnail_name)
+
+
+async def _split_video(
+    filename: str,
+    directory: str,
+    segment_sec: float,
+    cpus: tuple[int, ...] | None = None,
+) -> list:
+    # stream copy can only cut at keyframes, so segments start with one
     ffmpeg_args = [
         "-i",
         filename,
-        "-profile:v",
-        "main",
-        "-level",
-        "3.1",
-        "-movflags",
-        "+faststart",
-        "-crf",
-        "29",
+        "-map",
+        "0:v:0",
+        "-c",
+        "copy",
+        "-f",
+        "segment",
+        "-segment_time",
+        str(segment_sec),
+        "-reset_timestamps",
+        "1",
+        os.path.join(directory, "%05d.mkv"),
+    ]
+    await _run_ffmpeg(ffmpeg_args, [], None, cpus)
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.endswith(".mkv")
+    )
+
+
+async def _join_segments(
+    segments: list,
+    filename: str,
+    converted_name: str,
+    directory: str,
+    cpus: tuple[int, ...] | None = None,
+) -> None:
+    concat_list = os.path.join(directory, "segments.txt")
+    with open(concat_list, "w") as file:
+        file.writelines(f"file '{segment}'\n" for segment in segments)
+    # audio is encoded once from the source, per segment AAC priming
+    # would put a gap at every join and drift away from the video
+    ffmpeg_args = [
+        "-f",
+        "concat",
+        "-safe",
+        "0",
+        "-i",
+        concat_list,
+        "-i",
+        filename,
+        "-map",
+        "0:v:0",
+        "-map",
+        "1:a:0?",
+        "-c:v",
+        "copy",
         "-c:a",
         "aac",
-        "-b:v",
-        "500k",
-        "-pix_fmt",
-        "yuv420p",
-        "-c:v",
-        "libx264",
-        "-preset",
-        "slow",
-        "-fps_mode",
-        "auto",
-        "-vf",
-        "scale=trunc(iw/2)*2:trunc(ih/2)*2",
+        "-movflags",
+        "+faststart",
         converted_name,
     ]
-    ffmpeg_cmd = await which("ffmpeg")
-    await run_command(ffmpeg_cmd, *ffmpeg_args)
-    return converted_name
+    await _run_ffmpeg(ffmpeg_args, [converted_name], None, cpus)
 
 
-def _convert2JPG(filename: str) -> str:
-    converted_name = _get_converted_name("jpg")
-    with Image.open(filename) as im:
-        im.save(converted_name, "JPEG")
+async def _encode_segmented(
+    filename: str,
+    encode_args: list,
+    preset: str,
+    timeout: float | None = None,
+) -> ConvertedVideo:
+    converted_name = _get_converted_name("mp4")
+    thumbnail_name = _get_converted_name("jpg")
+    directory = tempfile.mkdtemp(prefix="segments-")
+    try:
+        async with asyncio.timeout(timeout):
+            with get_cpu_allocator().allocate(preset) as budget:
+                segments = await _split_video(
+                    filename, directory, SEGMENT_DURATION_SEC, budget.cpus
+                )
+                encoded = [f"{segment}.mp4" for segment in segments]
+                logger.info(
+                    "Encoding %d segments of %s, %d at once with %s preset",
+                    len(segments),
+                    filename,
+                    budget.threads,
+                    budget.preset,
+                )
+                # the job's threads go to segments, x264 scales worse than that
+                semaphore = asyncio.Semaphore(budget.threads)
+                segment_budget = budget._replace(threads=1)
+
+                async def encode_segment(index: int) -> None:
+                    ffmpeg_args = _get_encode_args(
+                        segments[index],
+                        encoded[index],
+                        thumbnail_name if index == 0 else None,
+                        encode_args,
+                        False,
+                        segment_budget,
+                    )
+                    async with semaphore:
+                        await _run_ffmpeg(ffmpeg_args, [], None, budget.cpus)
+
+                await gather_or_cancel(
+                    encode_segment(index) for index in range(len(segments))
+                )
+                await _join_segments(
+                    encoded, filename, converted_name, directory, budget.cpus
+                )
+    except BaseException as exc:
+        for output in (converted_name, thumbnail_name):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(output)
+        if isinstance(exc, TimeoutError):
+            raise deadline_exceeded("ffmpeg") from None
+        raise
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return _get_converted_video(converted_name, thumbnail_name)
+
+
+async def get_duration(filename: str, timeout: float | None = None) -> float | None:
+    try:
+        media_info = await probe(filename, timeout=timeout)
+    except CMDException:
+        logger.exception("Can't probe duration of %s", filename)
+        return None
+    return float(media_info.get("format", {}).get("duration") or 0) or None
+
+
+async def convert2MP4(filename: str, timeout: float | None = None) -> ConvertedVideo:
+    # on a single core segments only add the split and join passes
+    parallel = len(get_cpu_allocator().cpus) > 1
+    if parallel and os.path.getsize(filename) >= SEGMENTED_MIN_SIZE:
+        duration = await get_duration(filename, timeout)
+    else:
+        duration = None
+    if duration and duration >= SEGMENTED_MIN_DURATION_SEC:
+        return await _encode_segmented(filename, MP4_ENCODE_ARGS, "slow", timeout)
+    return await _encode_video(filename, MP4_ENCODE_ARGS, True, "slow", timeout)
+
+
+async def remux2MP4(
+    video: str, audio: str | None = None, timeout: float | None = None
+) -> str:
+    converted_name = _get_converted_name("mp4")
+    inputs = ["-i", video]
+    maps = ["-map", "0:v:0", "-map", "0:a:0?"]
+    if audio:
+        inputs += ["-i", audio]
+        maps = ["-map", "0:v:0", "-map", "1:a:0"]
+    ffmpeg_args = [
+        *inputs,
+        *maps,
+        "-c",
+        "copy",
+        "-movflags",
+        "+faststart",
+        converted_name,
+    ]
+    await _run_ffmpeg(ffmpeg_args, [converted_name], timeout)
     return converted_name
 
 
-async def convert2JPG(filename: str) -> str:
+def is_animated_image(filename: str) -> bool:
+    with open(filename, "rb") as file:
+        header = file.read(WEBP_HEADER_SIZE)
+    if header[:6] in (b"GIF87a", b"GIF89a"):
+        return True
+    # extended WebP header carries animation flag, truncated files are not one
+    return (
+        len(header) == WEBP_HEADER_SIZE
+        and header[:4] == b"RIFF"
+        and header[8:16] == b"WEBPVP8X"
+        and bool(header[20] & 0x02)
+    )
+
+
+def _probe_key(filename: str, timeout: float | None = None) -> tuple:
+    stat = os.stat(filename)
+    return filename, stat.st_size, stat.st_mtime_ns
+
+
+@cached("probe", key=_probe_key, maxsize=64, ttl=PROBE_CACHE_TTL_SEC)
+async def probe(filename: str, timeout: float | None = None) -> dict:
+    ffprobe_args = [
+        "-v",
+        "error",
+        "-show_entries",
+        "format=duration:stream=codec_type,codec_name,pix_fmt",
+        "-of",
+        "json",
+        filename,
+    ]
+    ffprobe_cmd = await which("ffprobe")
+    if timeout is None or timeout > PROBE_TIMEOUT_SEC:
+        timeout = PROBE_TIMEOUT_SEC
+    output = await run_command(ffprobe_cmd, *ffprobe_args, timeout=timeout)
+    return json.loads(output or "{}")
+
+
+async def is_animation(filename: str, max_duration_sec: int = 60) -> bool:
+    if is_animated_image(filename):
+        return True
+    try:
+        media_info = await probe(filename)
+    except CMDException:
+        logger.exception("Can't probe %s - assuming it's a video", filename)
+        return False
+    has_audio = any(
+        stream.get("codec_type") == "audio" for stream in media_info.get("streams", [])
+    )
+    duration = float(media_info.get("format", {}).get("duration") or 0)
+    return not has_audio and 0 < duration <= max_duration_sec
+
+
+async def is_streamable(filename: str) -> bool:
+    try:
+        media_info = await probe(filename)
+    except CMDException:
+        logger.exception("Can't probe %s - assuming it needs conversion", filename)
+        return False
+    has_video = False
+    for stream in media_info.get("streams", []):
+        codec_type = stream.get("codec_type")
+        if codec_type == "video":
+            has_video = True
+            if (
+                stream.get("codec_name"),
+                stream.get("pix_fmt"),
+            ) not in STREAMABLE_VIDEO:
+                return False
+        elif codec_type == "audio" and stream.get("codec_name") not in STREAMABLE_AUDIO:
+            return False
+    return has_video
+
+
+async def convert2Animation(
+    filename: str, timeout: float | None = None
+) -> ConvertedVideo:
+    return await _encode_video(
+        filename, ANIMATION_ENCODE_ARGS, False, "veryfast", timeout
+    )
+
+
+def _save_photo(image: Image.Image, fp, max_side: int, quality: int) -> None:
+    width, height = image.size
+    if max(width, height) > max_side:
+        # JPEG decoder can scale DCT by 1/2, 1/4 and 1/8 without full decode
+        image.draft("RGB", (max_side, max_side))
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image.thumbnail((max_side, max_side), reducing_gap=2.0)
+    image.save(fp, "JPEG", quality=quality, optimize=True)
+
+
+def _prepare_photo(
+    content: bytes, max_side: int = PHOTO_MAX_SIDE, quality: int = PHOTO_QUALITY
+) -> bytes:
+    with BytesIO(content) as source, BytesIO() as converted:
+        with Image.open(source) as image:
+            _save_photo(image, converted, max_side, quality)
+        return converted.getvalue()
+
+
+async def prepare_photo(content: bytes) -> bytes:
     loop = asyncio.get_event_loop()
-    # io operation here using threads
-    with ThreadPoolExecutor(max_workers=1) as executor:
-        return await loop.run_in_executor(executor, _convert2JPG, filename)
+    return await loop.run_in_executor(photo_executor, _prepare_photo, content)
 
 
-def _convert2LOG(content: str) -> str:
-    converted_name = _get_converted_name("log")
-    with open(converted_name, "w") as tmp_file:
-        tmp_file.write(content)
+def get_tile_boxes(
+    width: int, height: int, tile_height: int, overlap: int
+) -> list[tuple[int, int, int, int]]:
+    if height <= tile_height:
+        return [(0, 0, width, height)]
+    tops = list(range(0, height - tile_height, tile_height - overlap))
+    # align the last tile to the bottom instead of sending a thin sliver
+    tops.append(height - tile_height)
+    return [(0, top, width, top + tile_height) for top in tops]
+
+
+def _load_tile_source(
+    content: bytes, max_width: int, max_pixels: int
+) -> Image.Image | None:
+    image = Image.open(BytesIO(content))
+    width, height = image.size
+    if width > max_width:
+        image.draft("RGB", (max_width, math.ceil(height * max_width / width)))
+    # only JPEG decodes at a draft size, anything else is decoded in full
+    if image.width * image.height > max_pixels:
+        image.close()
+        return None
+    image.load()
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if image.width > max_width:
+        size = (max_width, round(image.height * max_width / image.width))
+        image = image.resize(size, reducing_gap=2.0)
+    return image
+
+
+def _encode_tile(image: Image.Image, box: tuple, quality: int) -> bytes:
+    with BytesIO() as converted:
+        image.crop(box).save(converted, "JPEG", quality=quality, optimize=True)
+        return converted.getvalue()
+
+
+async def tile_photo(content: bytes) -> list[bytes]:
+    loop = asyncio.get_event_loop()
+    # decode once, tiles are cropped from the same decoded image
+    image = await loop.run_in_executor(
+        photo_executor,
+        _load_tile_source,
+        content,
+        TILE_MAX_WIDTH,
+        TILE_MAX_SOURCE_PIXELS,
+    )
+    if image is None:
+        logger.warning("Image is too big to decode - won't tile it")
+        return []
+    try:
+        tile_height = image.width * TILE_RATIO
+        boxes = get_tile_boxes(
+            image.width, image.height, tile_height, int(tile_height * TILE_OVERLAP)
+        )
+        if len(boxes) > MAX_TILES:
+            logger.warning("Image needs %d tiles - won't tile it", len(boxes))
+            return []
+        return await asyncio.gather(
+            *[
+                loop.run_in_executor(
+                    photo_executor, _encode_tile, image, box, PHOTO_QUALITY
+                )
+                for box in boxes
+            ]
+        )
+    finally:
+        image.close()
+
+
+def _convert2JPG(filename: str) -> str:
+    converted_name = _get_converted_name("jpg")
+    with Image.open(filename) as image:
+        _save_photo(image, converted_name, PHOTO_MAX_SIDE, PHOTO_QUALITY)
     return converted_name
 
 
-async def convert2LOG(content: str) -> str:
+async def convert2JPG(filename: str) -> str:
     loop = asyncio.get_event_loop()
-    # io operation here using threads
-    with ThreadPoolExecutor(max_workers=1) as executor:
-        return await loop.run_in_executor(executor, _convert2LOG, content)
+    return await loop.run_in_executor(photo_executor, _convert2JPG, filename)
@@ -0,0 +1,105 @@
+import gzip
+import hashlib
+import json
+import os
+import traceback
+from dataclasses import dataclass
+
+ERROR_WINDOW_SEC = 300
+MAX_REPORTS_PER_WINDOW = 3
+COMPRESS_LOG_SIZE = 256 * 1024
+
+
+def get_error_fingerprint(error: BaseException) -> str:
+    digest = hashlib.sha1(type(error).__qualname__.encode())
+    for frame in traceback.extract_tb(error.__traceback__):
+        filename = os.path.basename(frame.filename)
+        digest.update(f"{filename}:{frame.name}:{frame.lineno}".encode())
+    return digest.hexdigest()[:12]
+
+
+@dataclass
+class ErrorRecord:
+    traceback: str
+    message_data: dict | None
+    count: int = 1
+    reported: int = 0
+    fingerprint: str = ""
+
+
+class ErrorAggregator:
+    def __init__(
+        self,
+        window_sec: int = ERROR_WINDOW_SEC,
+        max_reports: int = MAX_REPORTS_PER_WINDOW,
+    ):
+        self.window_sec = window_sec
+        self.max_reports = max_reports
+        self._records: dict[int, dict[str, ErrorRecord]] = {}
+        self._reports: dict[int, int] = {}
+
+    def is_window_open(self, chat_id: int) -> bool:
+        return chat_id in self._records
+
+    def add(
+        self, chat_id: int, error: BaseException, message_data: dict | None
+    ) -> ErrorRecord | None:
+        records = self._records.setdefault(chat_id, {})
+        fingerprint = get_error_fingerprint(error)
+        # keep formatted traceback only, frames keep downloaded media alive
+        tb_str = "".join(traceback.format_exception(None, error, error.__traceback__))
+        record = records.get(fingerprint)
+        if record:
+            record.count += 1
+            record.traceback = tb_str
+            record.message_data = message_data
+            return None
+        record = records[fingerprint] = ErrorRecord(
+            tb_str, message_data, fingerprint=fingerprint
+        )
+        if self._reports.get(chat_id, 0) >= self.max_reports:
+            return None
+        self._reports[chat_id] = self._reports.get(chat_id, 0) + 1
+        record.reported = 1
+        return record
+
+    def flush(self, chat_id: int) -> list[ErrorRecord]:
+        records = self._records.pop(chat_id, {})
+        self._reports.pop(chat_id, None)
+        return [record for record in records.values() if record.count > record.reported]
+
+
+def _dump_message_data(message_data: dict) -> str:
+    # job data may carry objects such as deadlines
+    return json.dumps(message_data, indent=2, ensure_ascii=False, default=repr)
+
+
+def _compress_logs(logs: dict[str, bytes]) -> dict[str, bytes]:
+    for name, content in list(logs.items()):
+        if len(content) > COMPRESS_LOG_SIZE:
+            del logs[name]
+            logs[f"{name}.gz"] = gzip.compress(content)
+    return logs
+
+
+def get_error_logs(record: ErrorRecord) -> dict[str, bytes]:
+    logs = {}
+    if record.message_data:
+        logs["message.json.txt"] = _dump_message_data(record.message_data).encode()
+    if record.traceback:
+        logs["traceback.txt"] = record.traceback.encode()
+    return _compress_logs(logs)
+
+
+def get_error_summary(records: list[ErrorRecord]) -> dict[str, bytes]:
+    # every postponed error of a window goes into a single file
+    sections = []
+    for record in records:
+        section = (
+            f"{record.fingerprint}: {record.count} time(s),"
+            f" {record.count - record.reported} not reported\n\n{record.traceback}"
+        )
+        if record.message_data:
+            section += f"\n{_dump_message_data(record.message_data)}\n"
+        sections.append(section)
+    return _compress_logs({"errors.txt": "\n\n".join(sections).encode()})
@@ -0,0 +1,288 @@
+import asyncio
+import functools
+import logging
+import os
+import time
+import weakref
+from collections import Counter, OrderedDict, deque
+from typing import NamedTuple
+
+from caching import Cache
+
+GPT_MODEL = "gpt-4o-mini"
+# rough average for english and russian text, good enough for budgeting
+CHARS_PER_TOKEN = 4
+HISTORY_TOKENS = 2000
+HISTORY_MAX_TURNS = 16
+HISTORY_TURN_TOKENS = 500
+HISTORY_SUMMARY_TOKENS = 200
+HISTORY_TOTAL_TOKENS = 1_000_000
+HISTORY_MAX_CHATS = 2048
+HISTORY_IDLE_SEC = 3600
+
+logger = logging.getLogger(__name__)
+
+
+class GPTBusy(Exception):
+    pass
+
+
+@functools.cache
+def get_gpt_client():
+    # openai is the heaviest import and only /gpt needs it
+    from openai import AsyncOpenAI
+
+    return AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY", "fake"))
+
+
+class Completion:
+    def __init__(self):
+        self.text = ""
+        self.done = False
+        self.error = None
+        self.task = None
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        # each change gets a fresh event, so every follower wakes up once
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def append(self, delta: str) -> None:
+        self.text += delta
+        self._notify()
+
+    def finish(self, error: BaseException | None = None) -> None:
+        self.done = True
+        self.error = error
+        self._notify()
+
+    async def follow(self):
+        seen = 0
+        while True:
+            changed = self._changed
+            if len(self.text) > seen:
+                seen = len(self.text)
+                yield self.text
+                continue
+            if self.done:
+                if self.error:
+                    raise self.error
+                return
+            await changed.wait()
+
+
+class GPTGateway:
+    def __init__(
+        self,
+        model: str = GPT_MODEL,
+        max_concurrency: int = 4,
+        max_chat_concurrency: int = 1,
+        max_queue: int = 32,
+        cache_size: int = 256,
+        cache_ttl_sec: int = 3600,
+        client_factory=get_gpt_client,
+    ):
+        self.model = model
+        self.max_chat_concurrency = max_chat_concurrency
+        self.max_queue = max_queue
+        self.client_factory = client_factory
+        self.metrics = Counter()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        # a semaphore lives while a question of its chat holds or waits for it
+        self._chat_semaphores = weakref.WeakValueDictionary()
+        self._cache = Cache("gpt_answers", maxsize=cache_size, ttl=cache_ttl_sec)
+        self._in_flight: dict[tuple, Completion] = {}
+        self._waiting = 0
+
+    def _get_chat_semaphore(self, chat_id: int) -> asyncio.Semaphore:
+        semaphore = self._chat_semaphores.get(chat_id)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_chat_concurrency)
+            self._chat_semaphores[chat_id] = semaphore
+        return semaphore
+
+    def ask(self, chat_id: int, role: str, question: str, history: tuple = ()):
+        self.metrics["requests"] += 1
+        key = (self.model, role, history, question)
+        answer = self._cache.get(key)
+        if answer is not None:
+            self.metrics["cache_hits"] += 1
+            completion = Completion()
+            completion.append(answer)
+            completion.finish()
+            return completion.follow()
+        completion = self._in_flight.get(key)
+        if completion is not None:
+            self.metrics["coalesced"] += 1
+            return completion.follow()
+        if self._waiting >= self.max_queue:
+            self.metrics["rejected"] += 1
+            raise GPTBusy(f"{self._waiting} questions are already waiting")
+        # counted before the task runs, so a burst in one tick is limited too
+        self._waiting += 1
+        completion = self._in_flight[key] = Completion()
+        completion.task = asyncio.create_task(self._complete(key, chat_id, completion))
+        return completion.follow()
+
+    async def _complete(self, key, chat_id, completion):
+        queued = time.perf_counter()
+        waiting = True
+        try:
+            async with self._get_chat_semaphore(chat_id), self._semaphore:
+                started = time.perf_counter()
+                self._waiting -= 1
+                waiting = False
+                self.metrics["queue_ms"] += int((started - queued) * 1000)
+                await self._stream(*key, completion)
+                self.metrics["completion_ms"] += int(
+                    (time.perf_counter() - started) * 1000
+                )
+        except Exception as exc:
+            self.metrics["errors"] += 1
+            completion.finish(exc)
+        except asyncio.CancelledError:
+            completion.finish(GPTBusy("Question was cancelled"))
+            raise
+        else:
+            self._cache.set(key, completion.text)
+            completion.finish()
+        finally:
+            if waiting:
+                self._waiting -= 1
+            self._in_flight.pop(key, None)
+        logger.info(
+            "GPT answer for chat %s in %.2fs, %d/%d tokens total",
+            chat_id,
+            time.perf_counter() - queued,
+            self.metrics["prompt_tokens"],
+            self.metrics["completion_tokens"],
+        )
+
+    async def _stream(self, model, role, history, question, completion):
+        messages = [{"role": "system", "content": role}]
+        messages += [{"role": author, "content": text} for author, text in history]
+        messages.append({"role": "user", "content": question})
+        stream = await self.client_factory().chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        async for chunk in stream:
+            if chunk.usage:
+                self.metrics["prompt_tokens"] += chunk.usage.prompt_tokens
+                self.metrics["completion_tokens"] += chunk.usage.completion_tokens
+            if chunk.choices and chunk.choices[0].delta.content:
+                completion.append(chunk.choices[0].delta.content)
+                # let followers render the delta before the next chunk lands
+                await asyncio.sleep(0)
+
+
+def count_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def truncate_tokens(text: str, tokens: int) -> str:
+    return text[: tokens * CHARS_PER_TOKEN]
+
+
+class Turn(NamedTuple):
+    question: str
+    answer: str
+    tokens: int
+
+
+class Conversation:
+    def __init__(self, role: str, max_tokens: int = HISTORY_TOKENS):
+        self.role = role
+        self.max_tokens = max_tokens
+        self.turns: deque[Turn] = deque()
+        self.summary = ""
+        self.tokens = 0
+        self.used = time.monotonic()
+
+    def add(self, question: str, answer: str) -> None:
+        question = truncate_tokens(question, HISTORY_TURN_TOKENS)
+        answer = truncate_tokens(answer, HISTORY_TURN_TOKENS)
+        turn = Turn(question, answer, count_tokens(question) + count_tokens(answer))
+        self.turns.append(turn)
+        self.tokens += turn.tokens
+        self.used = time.monotonic()
+        while self.turns and (
+            self.tokens > self.max_tokens or len(self.turns) > HISTORY_MAX_TURNS
+        ):
+            self._summarize(self.turns.popleft())
+
+    def _summarize(self, turn: Turn) -> None:
+        # answers are the bulk of the tokens, older turns keep only the question
+        summary = f"{self.summary}; {turn.question}" if self.summary else turn.question
+        summary = summary[-HISTORY_SUMMARY_TOKENS * CHARS_PER_TOKEN :]
+        self.tokens += count_tokens(summary) - turn.tokens
+        if self.summary:
+            self.tokens -= count_tokens(self.summary)
+        self.summary = summary
+
+    def history(self) -> tuple:
+        history = []
+        if self.summary:
+            history.append(("system", f"Earlier the user asked about: {self.summary}"))
+        for turn in self.turns:
+            history += [("user", turn.question), ("assistant", turn.answer)]
+        return tuple(history)
+
+
+class Conversations:
+    def __init__(
+        self,
+        max_chats: int = HISTORY_MAX_CHATS,
+        max_tokens: int = HISTORY_TOTAL_TOKENS,
+        chat_max_tokens: int = HISTORY_TOKENS,
+        max_idle_sec: int = HISTORY_IDLE_SEC,
+    ):
+        self.max_chats = max_chats
+        self.max_tokens = max_tokens
+        self.chat_max_tokens = chat_max_tokens
+        self.max_idle_sec = max_idle_sec
+        self.tokens = 0
+        self._chats: OrderedDict[int, Conversation] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._chats)
+
+    def _get(self, chat_id: int, role: str) -> Conversation | None:
+        conversation = self._chats.get(chat_id)
+        if conversation is None:
+            return None
+        idle = time.monotonic() - conversation.used > self.max_idle_sec
+        if idle or conversation.role != role:
+            self.reset(chat_id)
+            return None
+        return conversation
+
+    def role(self, chat_id: int) -> str | None:
+        conversation = self._chats.get(chat_id)
+        return conversation.role if conversation else None
+
+    def history(self, chat_id: int, role: str) -> tuple:
+        conversation = self._get(chat_id, role)
+        return conversation.history() if conversation else ()
+
+    def add(self, chat_id: int, role: str, question: str, answer: str) -> None:
+        conversation = self._get(chat_id, role)
+        if conversation is None:
+            conversation = self._chats[chat_id] = Conversation(
+                role, self.chat_max_tokens
+            )
+        self.tokens -= conversation.tokens
+        conversation.add(question, answer)
+        self.tokens += conversation.tokens
+        self._chats.move_to_end(chat_id)
+        while len(self._chats) > self.max_chats or self.tokens > self.max_tokens:
+            _, evicted = self._chats.popitem(last=False)
+            self.tokens -= evicted.tokens
+
+    def reset(self, chat_id: int) -> None:
+        conversation = self._chats.pop(chat_id, None)
+        if conversation:
+            self.tokens -= conversation.tokens
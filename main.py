@@ -1,25 +1,53 @@
+from contextlib import ExitStack, nullcontext
+import functools
+import hashlib
 from io import BytesIO
 import logging
 import math
 import os
-import json
+import struct
 import sys
-import traceback
+import time
 import asyncio
 import httpx
-from telegram import Update, InputMediaPhoto, InputMediaDocument
+from telegram import (
+    Update,
+    InputFile,
+    InputMediaPhoto,
+    InputMediaDocument,
+    InlineQueryResultCachedMpeg4Gif,
+    InlineQueryResultCachedPhoto,
+    InlineQueryResultCachedVideo,
+    InlineQueryResultsButton,
+    Message,
+    MessageEntity,
+    ReplyParameters,
+)
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
+    InlineQueryHandler,
     MessageHandler,
     ContextTypes,
     filters,
 )
 import validators
 from dotenv import load_dotenv
-from cache import AsyncTTL, AsyncLRU
-from converter import convert2MP4, convert2JPG, convert2LOG
+from caching import Cache, cached, get_cache_stats
+from converter import (
+    ConvertedVideo,
+    convert2MP4,
+    convert2Animation,
+    read_mp4_metadata,
+    convert2JPG,
+    is_animation,
+    is_streamable,
+    prepare_photo,
+    tile_photo,
+    check_ffmpeg,
+)
 from scraper import (
     is_big,
     is_link,
@@ -33,6 +61,7 @@ from scraper import (
     is_bot_message,
     is_private_message,
     link_to_bot,
+    extract_links,
     get_headers,
     get_post_pics,
     remove_file,
@@ -45,19 +74,33 @@ from scraper import (
     is_downloadable_video,
     is_generic_video,
     is_generic_image,
+    is_hls_manifest,
+    is_dash_manifest,
+    get_dash_video,
     get_instagram_video,
     get_youtube_video,
+    get_youtube_media,
     get_vk_video,
-    get_youtube_audio,
+    prewarm_ydl_worker,
     get_instagram_pics,
     check_filesize,
-    ScraperException,
     UploadIsTooBig,
+    MEDIA_AUDIO,
+)
+from errors import ErrorAggregator, ErrorRecord, get_error_logs, get_error_summary
+from gpt import Conversations, GPTBusy, GPTGateway
+from manifests import download_hls
+from reposts import Repost, RepostIndex, dhash_image, dhash_video
+from randomizer import (
+    sword,
+    fortune,
+    nsfw,
+    get_countdown,
+    load_fortunes,
+    check_random_secret,
 )
-from randomizer import sword, fortune, nsfw, get_countdown
-from utils import run_command
+from utils import Deadline, get_timeout, run_command, timeouts
 from PIL import Image
-from openai import AsyncOpenAI
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -66,7 +109,6 @@ logging.basicConfig(
 logging.getLogger("httpx").setLevel(logging.WARNING)
 
 logger = logging.getLogger(__name__)
-gpt_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY", "fake"))
 
 JOY_PUBLIC_DOMAINS = {
     "joyreactor.cc",
@@ -79,12 +121,34 @@ NSFW_FLAGS = {
     "spoiler",
     "ero",
 }
-CACHE_CONFIG = dict(maxsize=100, time_to_live=43200)
 SEND_CONFIG = dict(read_timeout=30, write_timeout=30, pool_timeout=30)
-
-_cached_sword = AsyncTTL(**CACHE_CONFIG)(sword)
-_cached_fortune = AsyncTTL(**CACHE_CONFIG)(fortune)
-_cached_nsfw = AsyncLRU(maxsize=1)(nsfw)
+BIG_IMAGE_PIXELS = 1920 * 1080
+MESSAGE_MAX_LENGTH = 4096
+CACHE_STATS_INTERVAL_SEC = 3600
+# whole budget of a link, from download to upload
+JOB_TIMEOUT_SEC = 300
+GPT_ROLE = "You are a helpful assistant of python senior backend developer"
+GPT_PLACEHOLDER = "…"
+GPT_EDIT_INTERVAL_SEC = 3
+GPT_FINAL_EDIT_ATTEMPTS = 3
+LONGPOST_RATIO = 2
+# links of one message checked and processed at once, the rest wait for a slot
+MESSAGE_LINK_CONCURRENCY = 4
+MAX_LINKS_PER_MESSAGE = 20
+# telegram shows up to 50 inline results, cached answers are reused by it
+INLINE_MAX_RESULTS = 10
+INLINE_CACHE_TIME_SEC = 300
+# file ids die with the bot token, resending a stale one costs a download
+FILE_ID_TTL_SEC = 7 * 24 * 3600
+
+_cached_nsfw = cached("nsfw", maxsize=1)(nsfw)
+head_cache = Cache("head", maxsize=1024, ttl=600)
+file_id_cache = Cache("file_ids", maxsize=8192, ttl=FILE_ID_TTL_SEC)
+# inline misses waiting for the user to start the bot with their token
+inline_requests = Cache("inline_requests", maxsize=1024, ttl=JOB_TIMEOUT_SEC)
+error_aggregator = ErrorAggregator()
+gpt_gateway = GPTGateway()
+gpt_conversations = Conversations()
 
 
 def get_bot_token(env_key: str = "BOT_TOKEN") -> str:
@@ -95,81 +159,85 @@ def get_bot_token(env_key: str = "BOT_TOKEN") -> str:
     return val
 
 
-async def _mark(key: str, coro) -> tuple:
-    return key, await coro
-
-
-async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
-    chat_id = None
-    message_data = None
-    error = context.error
-    logger.error("Exception while handling bot task:", exc_info=error)
-    if not isinstance(update, Update):
-        job = getattr(context, "job", None)
-        if job:
-            chat_id = job.chat_id
-            if job.data:
-                message_data = job.data
-    else:
-        chat_id = update.effective_chat.id
-        message_data = update.to_dict()
-    if not chat_id:
-        logger.error("No chat id to send exception to")
-        return
+async def _send_error_report(bot, chat_id: int, record: ErrorRecord):
     caption = "An exception was raised while handling bot task"
-    exception_data = {}
-    if message_data:
-        exception_data["message.json.txt"] = json.dumps(
-            message_data, indent=2, ensure_ascii=False
-        )
-    tb_list = traceback.format_exception(None, error, error.__traceback__)
-    if tb_list:
-        tb_str = "".join(tb_list)
-        exception_data["traceback.txt"] = tb_str
-    if not exception_data:
+    exception_logs = get_error_logs(record)
+    if not exception_logs:
         logger.warning("No exception data")
-        await context.bot.send_message(
+        await bot.send_message(
             chat_id=chat_id,
             text=caption,
         )
         return
-    exception_logs = {
-        log_name: (filename, open(filename, "rb"))
-        for log_name, filename in await asyncio.gather(
-            *[
-                _mark(key, convert2LOG(content))
-                for key, content in exception_data.items()
-            ]
-        )
-    }
     if len(exception_logs) > 1:
         logs = list(exception_logs.items())
-        last_log = logs.pop()
+        last_log_name, last_log = logs.pop()
         media = [
-            InputMediaDocument(file_handle, filename=log_name)
-            for log_name, (_, file_handle) in logs
+            InputMediaDocument(content, filename=log_name) for log_name, content in logs
         ]
-        log_name, (_, file_handle) = last_log
         media.append(
-            InputMediaDocument(file_handle, filename=log_name, caption=caption)
+            InputMediaDocument(last_log, filename=last_log_name, caption=caption)
         )
-        await context.bot.send_media_group(
+        await bot.send_media_group(
             chat_id,
             media,
         )
-        for filename, file_handle in exception_logs.values():
-            file_handle.close()
-            remove_file(filename)
     else:
-        log_name, (filename, file_handle) = exception_logs.popitem()
-        await context.bot.send_document(
+        log_name, content = exception_logs.popitem()
+        await bot.send_document(
             chat_id,
             caption=caption,
-            document=file_handle,
+            document=content,
             filename=log_name,
         )
-        file_handle.close()
-        remove_file(filename)
+
+
+async def flush_errors(context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = context.job.chat_id
+    records = error_aggregator.flush(chat_id)
+    if not records:
+        return
+    # one summary per window, however many different errors were postponed
+    count = sum(record.count - record.reported for record in records)
+    [(log_name, content)] = get_error_summary(records).items()
+    await context.bot.send_document(
+        chat_id,
+        caption=f"{count} more exception(s) of {len(records)} kind(s)"
+        f" in {error_aggregator.window_sec}s",
+        document=content,
+        filename=log_name,
+    )
+
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = None
+    message_data = None
+    error = context.error
+    logger.error("Exception while handling bot task:", exc_info=error)
+    if not isinstance(update, Update):
+        job = getattr(context, "job", None)
+        if job:
+            chat_id = job.chat_id
+            if job.data:
+                message_data = job.data
+    else:
+        # inline queries come without a chat, a user who never started the
+        # bot can't be messaged, so their errors are only logged
+        chat_id = update.effective_chat.id if update.effective_chat else None
+        message_data = update.to_dict()
+    if not chat_id:
+        logger.error("No chat id to send exception to")
+        return
+    # same errors are counted and reported once per window
+    if not error_aggregator.is_window_open(chat_id):
+        context.job_queue.run_once(
+            flush_errors, error_aggregator.window_sec, chat_id=chat_id
+        )
+    record = error_aggregator.add(chat_id, error, message_data)
+    if record is None:
+        logger.info("Exception report for chat %s is postponed", chat_id)
+        return
+    await _send_error_report(context.bot, chat_id, record)
 
 
 class ProcessException(Exception):
@@ -191,14 +259,20 @@ async def check_link(link: str) -> tuple[str, dict]:
         return None, {}
     if is_vk_video(link):
         return None, {}
+    if is_hls_manifest(link) or is_dash_manifest(link):
+        return None, {}
     async with httpx.AsyncClient(follow_redirects=True) as client:
         try:
-            headers = await get_headers(client, link)
+            headers = await head_cache.get_or_set(
+                link, lambda: get_headers(client, link)
+            )
         except Exception:
             logger.exception(
                 "Can't get headers for %s - assuming it's valid link", link
             )
             return None, {}
+    if is_hls_manifest(link, headers) or is_dash_manifest(link, headers):
+        return None, headers
     if not is_downloadable(headers):
         content_type = get_content_type(headers)
         return f"Can't download {link} - {content_type} unknown!", headers
@@ -207,6 +281,123 @@ async def check_link(link: str) -> tuple[str, dict]:
     return None, headers
 
 
+def _hold_slot(callback):
+    # jobs of one message share its slots and the budget starts in one, so
+    # queued links don't run out of time while waiting
+    @functools.wraps(callback)
+    async def wrapper(context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+        data = context.job.data
+        async with data.get("slot") or nullcontext():
+            data.setdefault("deadline", Deadline(JOB_TIMEOUT_SEC))
+            return await callback(context, *args, **kwargs)
+
+    return wrapper
+
+
+def _get_repost_index(context: ContextTypes.DEFAULT_TYPE) -> RepostIndex:
+    return context.chat_data.setdefault("reposts", RepostIndex())
+
+
+async def _get_media_hash(media_hash) -> int | None:
+    try:
+        return await media_hash
+    except Exception:
+        logger.exception("Can't get perceptual hash of the media")
+        return None
+
+
+def _get_file_id(message: Message) -> tuple[str, str] | None:
+    if message.animation:
+        return "animation", message.animation.file_id
+    if message.video:
+        return "video", message.video.file_id
+    if message.photo:
+        return "photo", message.photo[-1].file_id
+    return None
+
+
+def _remember_repost(reposts: RepostIndex, media_hash: int, message: Message):
+    if media_hash is None:
+        return
+    file_id = _get_file_id(message)
+    if file_id:
+        reposts.add(media_hash, Repost(*file_id, message.message_id))
+
+
+def _remember_file_id(link: str, message: Message):
+    file_id = _get_file_id(message)
+    if file_id:
+        file_id_cache.set(link, file_id)
+
+
+async def _send_file_id(
+    context: ContextTypes.DEFAULT_TYPE, chat_id: int, kind: str, file_id: str, **kwargs
+):
+    send = {
+        "animation": context.bot.send_animation,
+        "video": context.bot.send_video,
+        "photo": context.bot.send_photo,
+    }[kind]
+    return await send(
+        chat_id, file_id, disable_notification=True, **SEND_CONFIG, **kwargs
+    )
+
+
+async def _send_cached_file_id(
+    context: ContextTypes.DEFAULT_TYPE, chat_id: int, link: str, **kwargs
+) -> bool:
+    file_id = file_id_cache.get(link)
+    if not file_id:
+        return False
+    logger.info("Reusing %s %s sent for %s", *file_id, link)
+    try:
+        await _send_file_id(context, chat_id, *file_id, **kwargs)
+    except BadRequest:
+        logger.exception("Telegram rejected %s %s - sending %s again", *file_id, link)
+        file_id_cache.delete(link)
+        return False
+    return True
+
+
+async def _send_repost(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    reposts: RepostIndex,
+    media_hash: int | None,
+    **kwargs,
+) -> bool:
+    repost = reposts.find(media_hash) if media_hash is not None else None
+    if not repost:
+        return False
+    logger.info("Reusing %s %s for repost", repost.kind, repost.file_id)
+    try:
+        await _send_file_id(
+            context,
+            chat_id,
+            repost.kind,
+            repost.file_id,
+            reply_parameters=ReplyParameters(
+                message_id=repost.message_id, allow_sending_without_reply=True
+            ),
+            **kwargs,
+        )
+    except BadRequest:
+        logger.exception("Telegram rejected repost %s - sending it again", repost)
+        reposts.discard(media_hash)
+        return False
+    return True
+
+
+def _get_video_as_is(filename: str) -> ConvertedVideo:
+    try:
+        metadata = read_mp4_metadata(filename)
+    except (OSError, struct.error, IndexError):
+        logger.exception("Can't read metadata of %s", filename)
+        metadata = (None, None, None)
+    return ConvertedVideo(filename, *metadata, None)
+
+
+@_hold_slot
 async def send_converted_video(context: ContextTypes.DEFAULT_TYPE):
     original = None
     converted = None
@@ -215,48 +406,93 @@ async def send_converted_video(context: ContextTypes.DEFAULT_TYPE):
     data = job.data["data"]
     is_file_name = job.data["is_file_name"]
     caption = job.data.get("caption")
+    deadline = job.data.get("deadline")
     is_nsfw = any(flag in data.split(" ") for flag in NSFW_FLAGS)
     should_convert = False
+    is_animated = False
     if is_file_name:
         original = data
         _, file_extension = os.path.splitext(original)
         if file_extension != ".mp4":
             should_convert = True
     else:
-        original = await download_file(data)
+        if await _send_cached_file_id(
+            context, chat_id, data, caption=caption, has_spoiler=is_nsfw
+        ):
+            return
+        original = await download_file(data, deadline=deadline)
         # we can't trust extension of downloaded file
         should_convert = True
+    reposts = _get_repost_index(context)
+    media_hash = await _get_media_hash(
+        dhash_video(original, timeout=get_timeout(deadline))
+    )
+    if await _send_repost(
+        context, chat_id, reposts, media_hash, caption=caption, has_spoiler=is_nsfw
+    ):
+        remove_file(original)
+        return
     if should_convert or job.data.get("force_convert", False):
-        logger.info("Will convert %s to mp4", original)
         try:
-            converted = await convert2MP4(original)
+            is_animated = await is_animation(original)
+            if is_animated:
+                logger.info("Will convert %s to mp4 animation", original)
+                converted = await convert2Animation(
+                    original, timeout=get_timeout(deadline)
+                )
+            else:
+                logger.info("Will convert %s to mp4", original)
+                converted = await convert2MP4(original, timeout=get_timeout(deadline))
         except Exception:
             raise
         finally:
             remove_file(original)
     else:
-        converted = original
-        logger.info("Sending video file %s as it is", converted)
+        converted = _get_video_as_is(original)
+        logger.info("Sending video file %s as it is", original)
+    send_kwargs = dict(
+        chat_id=chat_id,
+        read_timeout=180,
+        write_timeout=180,
+        pool_timeout=180,
+        disable_notification=True,
+        has_spoiler=is_nsfw,
+        caption=caption,
+        width=converted.width,
+        height=converted.height,
+        duration=converted.duration,
+    )
     try:
-        check_filesize(converted)
-        with open(converted, "rb") as video:
-            await context.bot.send_video(
-                chat_id=chat_id,
-                video=video,
-                supports_streaming=True,
-                read_timeout=180,
-                write_timeout=180,
-                pool_timeout=180,
-                disable_notification=True,
-                has_spoiler=is_nsfw,
-                caption=caption,
-            )
+        check_filesize(converted.filename)
+        with ExitStack() as files:
+            video = files.enter_context(open(converted.filename, "rb"))
+            if converted.thumbnail:
+                send_kwargs["thumbnail"] = files.enter_context(
+                    open(converted.thumbnail, "rb")
+                )
+            if is_animated:
+                message = await context.bot.send_animation(
+                    animation=video, **send_kwargs
+                )
+            else:
+                message = await context.bot.send_video(
+                    video=video,
+                    supports_streaming=True,
+                    **send_kwargs,
+                )
+        _remember_repost(reposts, media_hash, message)
+        # downloaded files are remembered by the link they came from
+        link = job.data.get("link") if is_file_name else data
+        if link:
+            _remember_file_id(link, message)
     except Exception:
         raise
     finally:
-        remove_file(converted)
+        remove_file(converted.filename)
+        remove_file(converted.thumbnail)
 
 
+@_hold_slot
 async def send_converted_audio(context: ContextTypes.DEFAULT_TYPE):
     job = context.job
     chat_id = job.chat_id
@@ -281,13 +517,21 @@ async def send_converted_audio(context: ContextTypes.DEFAULT_TYPE):
             remove_file(filename)
 
 
+@_hold_slot
 async def send_converted_image(context: ContextTypes.DEFAULT_TYPE):
     original = None
     converted = None
     job = context.job
     chat_id = job.chat_id
     link = job.data["link"]
-    original = await download_file(link)
+    if await _send_cached_file_id(context, chat_id, link):
+        return
+    original = await download_file(link, deadline=job.data.get("deadline"))
+    reposts = _get_repost_index(context)
+    media_hash = await _get_media_hash(dhash_image(original))
+    if await _send_repost(context, chat_id, reposts, media_hash):
+        remove_file(original)
+        return
     try:
         converted = await convert2JPG(original)
     except Exception:
@@ -296,12 +540,14 @@ async def send_converted_image(context: ContextTypes.DEFAULT_TYPE):
         remove_file(original)
     try:
         with open(converted, "rb") as media:
-            await context.bot.send_photo(
+            message = await context.bot.send_photo(
                 chat_id=chat_id,
                 photo=media,
                 disable_notification=True,
                 **SEND_CONFIG,
             )
+        _remember_repost(reposts, media_hash, message)
+        _remember_file_id(link, message)
     except Exception:
         raise
     finally:
@@ -326,14 +572,32 @@ async def image2photo(client, image_link, caption="", force_sending_link=False):
         logger.exception("Can't convert image to photo from %s", media)
     else:
         width, height = _get_image_dimensions(media_content)
-        is_longpost = (height * width) >= (1920 * 1080)
-        if not force_sending_link or is_longpost:
+        is_big_image = (height * width) >= BIG_IMAGE_PIXELS
+        is_longpost = is_big_image and height > width * LONGPOST_RATIO
+        if is_longpost:
+            tiles = await tile_photo(media_content)
+            if tiles:
+                return [
+                    InputMediaPhoto(
+                        media=tile,
+                        caption=caption if index == 0 else None,
+                        has_spoiler=is_nsfw,
+                    )
+                    for index, tile in enumerate(tiles)
+                ]
+        elif is_big_image:
+            media_content = await prepare_photo(media_content)
+        if not force_sending_link or is_big_image:
             media = media_content
     if is_longpost:
-        return InputMediaDocument(
-            media=media, filename=get_filename_from_url(image_link), caption=caption
-        )
-    return InputMediaPhoto(media=media, caption=caption, has_spoiler=is_nsfw)
+        return [
+            InputMediaDocument(
+                media=media,
+                filename=get_filename_from_url(image_link),
+                caption=caption,
+            )
+        ]
+    return [InputMediaPhoto(media=media, caption=caption, has_spoiler=is_nsfw)]
 
 
 async def images2album(images_links, link):
@@ -341,25 +605,37 @@ async def images2album(images_links, link):
     if images_links:
         first_image_link, rest_images_links = images_links[0], images_links[1:]
         async with httpx.AsyncClient(follow_redirects=True) as client:
-            first_photo = await image2photo(
+            photos = await image2photo(
                 client,
                 first_image_link,
                 caption=link,
                 force_sending_link=is_public_domain,
             )
-            photos = [first_photo]
             rest_photos = await asyncio.gather(
                 *[
                     image2photo(client, image_link, None, is_public_domain)
                     for image_link in rest_images_links
                 ]
             )
-            photos.extend(rest_photos)
+            for image_photos in rest_photos:
+                photos.extend(image_photos)
         return photos
     return []
 
 
-async def _send_media_group(context: ContextTypes.DEFAULT_TYPE, delay: int = 6):
+async def _hash_media_item(media_item) -> int | None:
+    # only downloaded photos can be hashed, links are sent as they are
+    if not isinstance(media_item, InputMediaPhoto):
+        return None
+    if not isinstance(media_item.media, InputFile):
+        return None
+    return await _get_media_hash(dhash_image(media_item.media.input_file_content))
+
+
+@_hold_slot
+async def _send_media_group(
+    context: ContextTypes.DEFAULT_TYPE, delay: int = 6, album_size: int = 10
+):
     job = context.job
     chat_id = job.chat_id
     batch_index = job.data["batch_index"]
@@ -380,28 +656,51 @@ async def _send_media_group(context: ContextTypes.DEFAULT_TYPE, delay: int = 6):
     media_items = await images2album(batch, caption)
     if not media_items:
         return
+    reposts = _get_repost_index(context)
+    media_hashes = await asyncio.gather(
+        *[_hash_media_item(media_item) for media_item in media_items]
+    )
     current_media_type = type(media_items[0])
     media_type_batches = [[]]
     current_batch_index = 0
-    for media_item in media_items:
+    for media_item, media_hash in zip(media_items, media_hashes):
         if not isinstance(media_item, current_media_type):
             current_batch_index += 1
             media_type_batches.append([])
             current_media_type = type(media_item)
-        media_type_batches[current_batch_index].append(media_item)
-    for media in media_type_batches:
-        await context.bot.send_media_group(
-            media=media,
-            **send_kwargs,
-        )
-        await asyncio.sleep(delay)
+        repost = reposts.find(media_hash) if media_hash is not None else None
+        if repost and repost.kind == "photo":
+            logger.info("Reusing photo %s for repost", repost.file_id)
+            media_item = InputMediaPhoto(
+                media=repost.file_id,
+                caption=media_item.caption,
+                has_spoiler=media_item.has_spoiler,
+            )
+            media_hash = None
+        media_type_batches[current_batch_index].append((media_item, media_hash))
+    # longpost tiles can overflow telegram album limit
+    for media_type_batch in media_type_batches:
+        for i in range(0, len(media_type_batch), album_size):
+            album = media_type_batch[i : i + album_size]
+            messages = await context.bot.send_media_group(
+                media=[media_item for media_item, _ in album],
+                **send_kwargs,
+            )
+            for message, (_, media_hash) in zip(messages, album):
+                _remember_repost(reposts, media_hash, message)
+            await asyncio.sleep(delay)
     batch_index = batch_number
     if batch_index < batches_count:
         context.job_queue.run_once(
             _send_media_group,
             get_countdown(value=delay, add=delay // 2),
             chat_id=chat_id,
-            data=dict(link=link, batches=batches, batch_index=batch_index),
+            data=dict(
+                link=link,
+                batches=batches,
+                batch_index=batch_index,
+                slot=job.data.get("slot"),
+            ),
         )
 
 
@@ -419,6 +718,7 @@ def _balance_batches(batches: list[list]) -> None:
             penultimate_batch.pop()
 
 
+@_hold_slot
 async def send_post_images_as_album(
     context: ContextTypes.DEFAULT_TYPE, album_size: int = 10
 ):
@@ -442,15 +742,17 @@ async def send_post_images_as_album(
         _send_media_group,
         get_countdown(),
         chat_id=chat_id,
-        data=dict(link=link, batches=batches, batch_index=0),
+        data=dict(link=link, batches=batches, batch_index=0, slot=job.data.get("slot")),
     )
 
 
+@_hold_slot
 async def send_instagram_video(context: ContextTypes.DEFAULT_TYPE):
     job = context.job
     chat_id = job.chat_id
     link = job.data["link"]
-    reel_filename, title = await get_instagram_video(link)
+    deadline = job.data.get("deadline")
+    reel_filename, title = await get_instagram_video(link, deadline)
     if not reel_filename:
         raise ProcessException(f"Restricted or not reel {link}")
     context.job_queue.run_once(
@@ -462,10 +764,14 @@ async def send_instagram_video(context: ContextTypes.DEFAULT_TYPE):
             is_file_name=True,
             caption=f"{title}\n{link}",
             force_convert=True,
+            deadline=deadline,
+            link=link,
+            slot=job.data.get("slot"),
         ),
     )
 
 
+@_hold_slot
 async def send_instagram_album(
     context: ContextTypes.DEFAULT_TYPE, album_size: int = 10
 ):
@@ -490,52 +796,61 @@ async def send_instagram_album(
         _send_media_group,
         get_countdown(),
         chat_id=chat_id,
-        data=dict(link=link, batches=batches, batch_index=0),
+        data=dict(link=link, batches=batches, batch_index=0, slot=job.data.get("slot")),
     )
 
 
+@_hold_slot
 async def send_youtube_video(context: ContextTypes.DEFAULT_TYPE):
     job = context.job
     chat_id = job.chat_id
     link = job.data["link"]
+    deadline = job.data.get("deadline")
     try:
-        video_filename, title = await get_youtube_video(link)
-    except ScraperException:
-        logger.exception("Video download error - will try to download audio")
-        try:
-            audio_filename, title = await get_youtube_audio(link)
-        except UploadIsTooBig as exc:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=f"{link} is too big for upload\n{exc}",
-            )
-        else:
-            context.job_queue.run_once(
-                send_converted_audio,
-                get_countdown(),
-                chat_id=chat_id,
-                data=dict(filename=audio_filename, caption=f"{title}\n{link}"),
-            )
+        filename, title, media_type = await get_youtube_media(link, deadline)
+    except UploadIsTooBig as exc:
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=f"{link} is too big for upload\n{exc}",
+        )
+        return
+    if media_type == MEDIA_AUDIO:
+        logger.info("Only audio of %s fits into upload limit", link)
+        context.job_queue.run_once(
+            send_converted_audio,
+            get_countdown(),
+            chat_id=chat_id,
+            data=dict(
+                filename=filename,
+                caption=f"{title}\n{link}",
+                slot=job.data.get("slot"),
+            ),
+        )
     else:
         context.job_queue.run_once(
             send_converted_video,
             get_countdown(),
             chat_id=chat_id,
             data=dict(
-                data=video_filename,
+                data=filename,
                 is_file_name=True,
                 caption=f"{title}\n{link}",
                 force_convert=True,
+                deadline=deadline,
+                link=link,
+                slot=job.data.get("slot"),
             ),
         )
 
 
+@_hold_slot
 async def send_tiktok_video(context: ContextTypes.DEFAULT_TYPE):
     # YoutubeDL handle tiktok as well
     job = context.job
     chat_id = job.chat_id
     link = job.data["link"]
-    video_filename, title = await get_youtube_video(link)
+    deadline = job.data.get("deadline")
+    video_filename, title = await get_youtube_video(link, deadline)
     context.job_queue.run_once(
         send_converted_video,
         get_countdown(),
@@ -545,16 +860,21 @@ async def send_tiktok_video(context: ContextTypes.DEFAULT_TYPE):
             is_file_name=True,
             caption=f"{title}\n{link}",
             force_convert=True,
+            deadline=deadline,
+            link=link,
+            slot=job.data.get("slot"),
         ),
     )
 
 
+@_hold_slot
 async def send_vk_video(context: ContextTypes.DEFAULT_TYPE):
     # YoutubeDL handle vk as well
     job = context.job
     chat_id = job.chat_id
     link = job.data["link"]
-    video_filename, title = await get_vk_video(link)
+    deadline = job.data.get("deadline")
+    video_filename, title = await get_vk_video(link, deadline)
     context.job_queue.run_once(
         send_converted_video,
         get_countdown(),
@@ -564,22 +884,66 @@ async def send_vk_video(context: ContextTypes.DEFAULT_TYPE):
             is_file_name=True,
             caption=f"{title}\n{link}",
             force_convert=True,
+            deadline=deadline,
+            link=link,
+            slot=job.data.get("slot"),
         ),
     )
 
 
-async def process(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    message = update.message
-    if not message:
+@_hold_slot
+async def send_manifest_video(context: ContextTypes.DEFAULT_TYPE):
+    job = context.job
+    chat_id = job.chat_id
+    link = job.data["link"]
+    deadline = job.data.get("deadline")
+    try:
+        if job.data.get("dash"):
+            video_filename, _ = await get_dash_video(link, deadline)
+        else:
+            video_filename = await download_hls(link, deadline=deadline)
+    except UploadIsTooBig as exc:
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=f"{link} is too big for upload\n{exc}",
+        )
         return
-    text = message.text
-    if not is_bot_message(text):
-        if not is_private_message(message):
-            return
-    link = link_to_bot(text)
+    # segments are only remuxed, so most streams can be sent as they are
+    force_convert = not await is_streamable(video_filename)
+    context.job_queue.run_once(
+        send_converted_video,
+        get_countdown(),
+        chat_id=chat_id,
+        data=dict(
+            data=video_filename,
+            is_file_name=True,
+            caption=link,
+            force_convert=force_convert,
+            deadline=deadline,
+            link=link,
+            slot=job.data.get("slot"),
+        ),
+    )
+
+
+def get_message_links(message: Message) -> list[str]:
+    entities = message.parse_entities([MessageEntity.URL, MessageEntity.TEXT_LINK])
+    links = [
+        entity.url if entity.type == MessageEntity.TEXT_LINK else text
+        for entity, text in entities.items()
+    ]
+    links += extract_links(message.text)
+    links = [link for link in dict.fromkeys(links) if is_link(link)]
+    return links[:MAX_LINKS_PER_MESSAGE]
+
+
+async def dispatch_link(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    link: str,
+    slot: asyncio.Semaphore | None = None,
+) -> None:
     error, headers = await check_link(link)
-    chat_id = update.effective_chat.id
-    message_id = message.message_id
     if error:
         logger.error(error)
         await context.bot.send_message(
@@ -587,89 +951,175 @@ async def process(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text=error,
             **SEND_CONFIG,
         )
-        await context.bot.delete_message(
-            chat_id=chat_id,
-            message_id=message_id,
-            **SEND_CONFIG,
-        )
         return
     jobs = context.job_queue
     default_countdown = get_countdown(value=1, add=1)
-    try:
-        if is_joyreactor_post(link):
-            jobs.run_once(
-                send_post_images_as_album,
-                get_countdown(value=1, add=9),
-                chat_id=chat_id,
-                data=dict(link=link),
-            )
+    if is_joyreactor_post(link):
+        jobs.run_once(
+            send_post_images_as_album,
+            get_countdown(value=1, add=9),
+            chat_id=chat_id,
+            data=dict(link=link, slot=slot),
+        )
 
-        elif is_instagram_post(link):
-            if is_instagram_reel(link):
-                jobs.run_once(
-                    send_instagram_video,
-                    default_countdown,
-                    chat_id=chat_id,
-                    data=dict(link=link),
-                )
-            elif is_instagram_album:
-                jobs.run_once(
-                    send_instagram_album,
-                    default_countdown,
-                    chat_id=chat_id,
-                    data=dict(link=link),
-                )
-        elif is_vk_video(link):
-            jobs.run_once(
-                send_vk_video, default_countdown, chat_id=chat_id, data=dict(link=link)
-            )
-        elif is_youtube_video(link):
-            jobs.run_once(
-                send_youtube_video,
-                default_countdown,
-                chat_id=chat_id,
-                data=dict(link=link),
-            )
-        elif is_tiktok_post(link):
-            jobs.run_once(
-                send_tiktok_video,
-                default_countdown,
-                chat_id=chat_id,
-                data=dict(link=link),
-            )
-        elif is_downloadable_image(headers) or is_generic_image(link):
+    elif is_instagram_post(link):
+        if is_instagram_reel(link):
             jobs.run_once(
-                send_converted_image,
+                send_instagram_video,
                 default_countdown,
                 chat_id=chat_id,
-                data=dict(link=link),
+                data=dict(link=link, slot=slot),
             )
-        elif is_downloadable_video(headers) or is_generic_video(link):
+        elif is_instagram_album:
             jobs.run_once(
-                send_converted_video,
+                send_instagram_album,
                 default_countdown,
                 chat_id=chat_id,
-                data=dict(data=link, is_file_name=False, force_convert=True),
+                data=dict(link=link, slot=slot),
             )
+    elif is_vk_video(link):
+        jobs.run_once(
+            send_vk_video,
+            default_countdown,
+            chat_id=chat_id,
+            data=dict(link=link, slot=slot),
+        )
+    elif is_youtube_video(link):
+        jobs.run_once(
+            send_youtube_video,
+            default_countdown,
+            chat_id=chat_id,
+            data=dict(link=link, slot=slot),
+        )
+    elif is_tiktok_post(link):
+        jobs.run_once(
+            send_tiktok_video,
+            default_countdown,
+            chat_id=chat_id,
+            data=dict(link=link, slot=slot),
+        )
+    elif is_hls_manifest(link, headers) or is_dash_manifest(link, headers):
+        jobs.run_once(
+            send_manifest_video,
+            default_countdown,
+            chat_id=chat_id,
+            data=dict(
+                link=link,
+                dash=is_dash_manifest(link, headers),
+                slot=slot,
+            ),
+        )
+    elif is_downloadable_image(headers) or is_generic_image(link):
+        jobs.run_once(
+            send_converted_image,
+            default_countdown,
+            chat_id=chat_id,
+            data=dict(link=link, slot=slot),
+        )
+    elif is_downloadable_video(headers) or is_generic_video(link):
+        jobs.run_once(
+            send_converted_video,
+            default_countdown,
+            chat_id=chat_id,
+            data=dict(
+                data=link,
+                is_file_name=False,
+                force_convert=True,
+                slot=slot,
+            ),
+        )
+    else:
+        error = f"No idea what to do with {link}"
+        logger.error(error)
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=error,
+            **SEND_CONFIG,
+        )
+
+
+def _get_inline_result(link: str, kind: str, file_id: str):
+    result_id = hashlib.sha256(link.encode()).hexdigest()
+    if kind == "video":
+        return InlineQueryResultCachedVideo(result_id, file_id, title=link)
+    if kind == "animation":
+        return InlineQueryResultCachedMpeg4Gif(result_id, file_id)
+    return InlineQueryResultCachedPhoto(result_id, file_id)
+
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.inline_query
+    results = []
+    misses = []
+    for link in extract_links(query.query)[:INLINE_MAX_RESULTS]:
+        file_id = file_id_cache.get(link)
+        if file_id:
+            results.append(_get_inline_result(link, *file_id))
         else:
-            error = f"No idea what to do with {link}"
-            logger.error(error)
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=error,
-                **SEND_CONFIG,
-            )
-    except Exception:
-        raise
+            misses.append(link)
+    # answer from memory first, telegram drops slow inline answers
+    button = None
+    if misses:
+        # file ids only come from uploads, misses are converted in the private
+        # chat once the user asks for it, not on every keystroke
+        token = hashlib.sha256(" ".join(misses).encode()).hexdigest()[:32]
+        inline_requests.set(token, misses)
+        button = InlineQueryResultsButton(
+            text="Convert in private chat, then ask again", start_parameter=token
+        )
+    await query.answer(
+        results,
+        cache_time=0 if misses else INLINE_CACHE_TIME_SEC,
+        button=button,
+    )
+
+
+async def _dispatch_links(
+    context: ContextTypes.DEFAULT_TYPE, chat_id: int, links: list[str]
+) -> None:
+    semaphore = asyncio.Semaphore(MESSAGE_LINK_CONCURRENCY)
+
+    async def dispatch(link: str) -> None:
+        async with semaphore:
+            await dispatch_link(context, chat_id, link, semaphore)
+
+    # one broken link must not stop the rest of the batch
+    results = await asyncio.gather(
+        *[dispatch(link) for link in links], return_exceptions=True
+    )
+    failures = [
+        (link, result)
+        for link, result in zip(links, results)
+        if isinstance(result, Exception)
+    ]
+    for link, failure in failures:
+        logger.error("Can't dispatch %s", link, exc_info=failure)
+    if failures:
+        raise failures[0][1]
+
+
+async def process(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    if not message:
+        return
+    text = message.text
+    if not is_bot_message(text):
+        if not is_private_message(message):
+            return
+    # without any link the whole text is checked to explain what is wrong
+    links = get_message_links(message) or [link_to_bot(text)]
+    chat_id = update.effective_chat.id
+    try:
+        await _dispatch_links(context, chat_id, links)
     finally:
         await context.bot.delete_message(
             chat_id=chat_id,
-            message_id=message_id,
+            message_id=message.message_id,
             **SEND_CONFIG,
         )
 
 
-@AsyncLRU(maxsize=1)
+@cached(maxsize=1)
 async def get_latest_commit_date() -> str:
     cmd_path = await run_command("git", "log", "-1", "--format=%cd - %s")
     return cmd_path.strip()
@@ -677,10 +1127,10 @@ async def get_latest_commit_date() -> str:
 
 async def sword_size(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    user_name = update.effective_user.name
+    user = update.effective_user
     await context.bot.send_message(
         chat_id=chat_id,
-        text=await _cached_sword(user_name),
+        text=await sword(user.name, seed=user.id),
         **SEND_CONFIG,
     )
     await context.bot.delete_message(
@@ -692,11 +1142,19 @@ async def sword_size(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text=await get_latest_commit_date(),
-        **SEND_CONFIG,
-    )
+    token = context.args[0] if context.args else None
+    # the inline button starts the bot, so its private chat is reachable
+    links = inline_requests.get(token) if token else None
+    if links:
+        inline_requests.delete(token)
+        logger.info("Converting %s for inline queries", links)
+        await _dispatch_links(context, chat_id, links)
+    else:
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=await get_latest_commit_date(),
+            **SEND_CONFIG,
+        )
     await context.bot.delete_message(
         chat_id=chat_id,
         message_id=update.message.message_id,
@@ -727,18 +1185,29 @@ def extract_role_and_question(message):
         return None, message.strip()
 
 
-async def _ask_gpt(role, question):
-    completion = await gpt_client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {
-                "role": "system",
-                "content": role,
-            },
-            {"role": "user", "content": question},
-        ],
-    )
-    return completion.choices[0].message.content
+async def _edit_answer(message: Message, text: str, **kwargs) -> None:
+    try:
+        await message.edit_text(text[:MESSAGE_MAX_LENGTH], **kwargs, **SEND_CONFIG)
+    except BadRequest as exc:
+        if "not modified" not in str(exc):
+            raise
+
+
+async def _edit_final_answer(message: Message, answer: str) -> None:
+    # streaming edits are what gets throttled, the final one must still land
+    for attempt in range(1, GPT_FINAL_EDIT_ATTEMPTS + 1):
+        try:
+            try:
+                await _edit_answer(message, answer, parse_mode=ParseMode.MARKDOWN)
+            except BadRequest:
+                logger.exception("Can't send GPT answer as markdown - sending as it is")
+                await _edit_answer(message, answer)
+            return
+        except RetryAfter as exc:
+            if attempt == GPT_FINAL_EDIT_ATTEMPTS:
+                raise
+            logger.warning("GPT answer edit is throttled for %s", exc.retry_after)
+            await asyncio.sleep(exc.retry_after)
 
 
 async def ask_gpt(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -754,14 +1223,45 @@ async def ask_gpt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not question:
         question = "Who are you?"
     if not role:
-        role = "You are a helpful assistant of python senior backend developer"
+        # follow-ups without a role continue the current conversation
+        role = gpt_conversations.role(chat_id) or GPT_ROLE
+    history = gpt_conversations.history(chat_id, role)
 
-    await context.bot.send_message(
+    try:
+        answers = gpt_gateway.ask(chat_id, role, question, history)
+    except GPTBusy:
+        logger.warning("GPT queue is full - rejecting question from %s", chat_id)
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text="Too many questions at once, ask me later",
+            reply_to_message_id=message.message_id,
+            **SEND_CONFIG,
+        )
+        return
+    answer_message = await context.bot.send_message(
         chat_id=chat_id,
-        text=await _ask_gpt(role, question),
-        parse_mode=ParseMode.MARKDOWN,
+        text=GPT_PLACEHOLDER,
         **SEND_CONFIG,
     )
+    answer = ""
+    # first tokens are shown right away, later ones at the edit interval
+    last_edit = float("-inf")
+    async for answer in answers:
+        # telegram throttles frequent edits of the same message
+        if time.monotonic() - last_edit < GPT_EDIT_INTERVAL_SEC:
+            continue
+        try:
+            await _edit_answer(answer_message, f"{answer}{GPT_PLACEHOLDER}")
+        except RetryAfter as exc:
+            logger.warning("GPT answer edits are throttled for %s", exc.retry_after)
+            last_edit = time.monotonic() + exc.retry_after
+        else:
+            last_edit = time.monotonic()
+    if answer:
+        gpt_conversations.add(chat_id, role, question, answer)
+    else:
+        answer = "No answer"
+    await _edit_final_answer(answer_message, answer)
     await context.bot.delete_message(
         chat_id=chat_id,
         message_id=update.message.message_id,
@@ -771,10 +1271,10 @@ async def ask_gpt(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def fortune_cookie(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    user_name = update.effective_user.name
+    user = update.effective_user
     await context.bot.send_message(
         chat_id=chat_id,
-        text=await _cached_fortune(user_name),
+        text=await fortune(user.name, seed=user.id),
         parse_mode=ParseMode.HTML,
         **SEND_CONFIG,
     )
@@ -785,18 +1285,44 @@ async def fortune_cookie(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-if __name__ == "__main__":
-    load_dotenv()
-    application = (
-        ApplicationBuilder()
-        .token(get_bot_token())
-        .pool_timeout(30)
-        .connect_timeout(30)
-        .write_timeout(30)
-        .read_timeout(30)
-        .concurrent_updates(True)
-        .build()
+async def log_cache_stats(context: ContextTypes.DEFAULT_TYPE) -> None:
+    for name, stats in get_cache_stats().items():
+        logger.info("Cache %s: %s", name, stats)
+    if timeouts:
+        logger.info("Job timeouts by stage: %s", dict(timeouts))
+
+
+async def _warm_up_step(name: str, coro) -> None:
+    started = time.perf_counter()
+    try:
+        await coro
+    except Exception:
+        logger.exception("Warm-up of %s failed", name)
+    else:
+        logger.info("Warm-up of %s took %.3fs", name, time.perf_counter() - started)
+
+
+async def warm_up(application) -> None:
+    # resolve everything first requests would otherwise wait for
+    started = time.perf_counter()
+    await asyncio.gather(
+        _warm_up_step("ffmpeg", check_ffmpeg()),
+        _warm_up_step("nsfw curtain", _cached_nsfw()),
+        _warm_up_step("commit date", get_latest_commit_date()),
+        _warm_up_step("fortunes", asyncio.to_thread(load_fortunes)),
+        _warm_up_step("pillow plugins", asyncio.to_thread(Image.init)),
+        _warm_up_step("yt-dlp worker", prewarm_ydl_worker()),
     )
+    file_id_cache.persist(os.getenv("CACHE_DB"))
+    check_random_secret()
+    if application:
+        application.job_queue.run_repeating(
+            log_cache_stats, interval=CACHE_STATS_INTERVAL_SEC
+        )
+    logger.info("Warm-up finished in %.2fs", time.perf_counter() - started)
+
+
+def add_handlers(application) -> None:
     converter_handler = MessageHandler(
         filters.TEXT & ~filters.COMMAND,
         process,
@@ -807,13 +1333,31 @@ if __name__ == "__main__":
     fortune_handler = CommandHandler("fortune", fortune_cookie, block=False)
     curtain_handler = CommandHandler("nsfw", nsfw_curtain, block=False)
     gpt_handler = CommandHandler("gpt", ask_gpt, block=False)
+    inline_handler = InlineQueryHandler(inline_query, block=False)
     application.add_handler(sword_handler)
     application.add_handler(fortune_handler)
     application.add_handler(curtain_handler)
     application.add_handler(converter_handler)
     application.add_handler(start_handler)
     application.add_handler(gpt_handler)
+    application.add_handler(inline_handler)
     application.add_error_handler(error_handler)
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    application = (
+        ApplicationBuilder()
+        .token(get_bot_token())
+        .pool_timeout(30)
+        .connect_timeout(30)
+        .write_timeout(30)
+        .read_timeout(30)
+        .concurrent_updates(True)
+        .post_init(warm_up)
+        .build()
+    )
+    add_handlers(application)
     application.run_polling(
         poll_interval=5,
         bootstrap_retries=3,
@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import os
+import re
+import shutil
+from tempfile import mkdtemp
+from typing import NamedTuple
+from urllib.parse import urljoin
+
+import httpx
+
+from converter import remux2MP4
+from scraper import ScraperException, UploadIsTooBig
+from utils import deadline_exceeded, gather_or_cancel, get_timeout
+
+SEGMENT_CONCURRENCY = 8
+ATTRIBUTE_PATTERN = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+logger = logging.getLogger(__name__)
+
+
+class Variant(NamedTuple):
+    uri: str
+    bandwidth: int
+    resolution: str | None
+    audio_uri: str | None
+
+
+class MediaPlaylist(NamedTuple):
+    segments: list[str]
+    duration: float
+    init: str | None
+
+
+def _parse_attributes(line: str) -> dict[str, str]:
+    _, _, attributes = line.partition(":")
+    return {
+        key: value.strip('"') for key, value in ATTRIBUTE_PATTERN.findall(attributes)
+    }
+
+
+def _check_playlist(text: str) -> list[str]:
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    if not lines or lines[0] != "#EXTM3U":
+        raise ScraperException("Not an HLS playlist")
+    return lines
+
+
+def is_master_playlist(text: str) -> bool:
+    return "#EXT-X-STREAM-INF" in text
+
+
+def parse_master_playlist(text: str, base_url: str) -> list[Variant]:
+    lines = _check_playlist(text)
+    audio_groups = {}
+    for line in lines:
+        if line.startswith("#EXT-X-MEDIA:"):
+            media = _parse_attributes(line)
+            if media.get("TYPE") != "AUDIO" or "URI" not in media:
+                continue
+            # keep the default rendition of every group, otherwise the first
+            if media.get("DEFAULT") == "YES" or media["GROUP-ID"] not in audio_groups:
+                audio_groups[media["GROUP-ID"]] = urljoin(base_url, media["URI"])
+    variants = []
+    for line, uri in zip(lines, lines[1:]):
+        if not line.startswith("#EXT-X-STREAM-INF:"):
+            continue
+        stream = _parse_attributes(line)
+        bandwidth = stream.get("AVERAGE-BANDWIDTH") or stream.get("BANDWIDTH") or 0
+        variants.append(
+            Variant(
+                urljoin(base_url, uri),
+                int(bandwidth),
+                stream.get("RESOLUTION"),
+                audio_groups.get(stream.get("AUDIO")),
+            )
+        )
+    return sorted(variants, key=lambda variant: variant.bandwidth, reverse=True)
+
+
+def parse_media_playlist(text: str, base_url: str) -> MediaPlaylist:
+    lines = _check_playlist(text)
+    if "#EXT-X-ENDLIST" not in lines:
+        raise ScraperException("Live HLS streams are not supported")
+    segments = []
+    duration = 0.0
+    init = None
+    for line in lines:
+        if line.startswith("#EXTINF:"):
+            duration += float(line[len("#EXTINF:") :].split(",")[0])
+        elif line.startswith("#EXT-X-KEY:"):
+            if _parse_attributes(line).get("METHOD", "NONE") != "NONE":
+                raise ScraperException("Encrypted HLS streams are not supported")
+        elif line.startswith("#EXT-X-BYTERANGE"):
+            raise ScraperException("Byte range HLS segments are not supported")
+        elif line.startswith("#EXT-X-MAP:"):
+            init = urljoin(base_url, _parse_attributes(line)["URI"])
+        elif not line.startswith("#"):
+            segments.append(urljoin(base_url, line))
+    return MediaPlaylist(segments, duration, init)
+
+
+def select_variant(
+    variants: list[Variant], duration: float, max_filesize_mb: int = 50
+) -> Variant:
+    max_filesize = max_filesize_mb * 1024 * 1024
+    for variant in variants:
+        if variant.bandwidth / 8 * duration <= max_filesize:
+            return variant
+    raise UploadIsTooBig(f"Every HLS variant is bigger than {max_filesize_mb} MB")
+
+
+async def _get_text(client, url: str, timeout: int) -> str:
+    response = await client.get(url, timeout=timeout)
+    response.raise_for_status()
+    return response.text
+
+
+class _Budget:
+    def __init__(self, max_bytes: int):
+        self.left = max_bytes
+
+    def spend(self, size: int) -> None:
+        self.left -= size
+        if self.left < 0:
+            raise UploadIsTooBig("HLS stream is bigger than planned")
+
+
+async def _download_segment(client, url, filename, semaphore, budget, timeout):
+    async with semaphore:
+        async with client.stream("GET", url, timeout=timeout) as response:
+            response.raise_for_status()
+            with open(filename, "wb") as file:
+                async for chunk in response.aiter_bytes():
+                    budget.spend(len(chunk))
+                    file.write(chunk)
+
+
+async def _download_track(client, playlist, filename, budget, concurrency, timeout):
+    urls = ([playlist.init] if playlist.init else []) + playlist.segments
+    parts = [f"{filename}.{index:06d}" for index in range(len(urls))]
+    semaphore = asyncio.Semaphore(concurrency)
+    await gather_or_cancel(
+        _download_segment(client, url, part, semaphore, budget, timeout)
+        for url, part in zip(urls, parts)
+    )
+    # TS segments and fMP4 fragments after their init are both concatenable
+    with open(filename, "wb") as track:
+        for part in parts:
+            with open(part, "rb") as segment:
+                shutil.copyfileobj(segment, track)
+            os.remove(part)
+
+
+async def download_hls(
+    url: str,
+    max_filesize_mb: int = 50,
+    concurrency: int = SEGMENT_CONCURRENCY,
+    timeout: int = 30,
+    deadline=None,
+) -> str:
+    directory = mkdtemp()
+    try:
+        async with asyncio.timeout(get_timeout(deadline)):
+            return await _download_hls(
+                url, directory, max_filesize_mb, concurrency, timeout
+            )
+    except TimeoutError:
+        raise deadline_exceeded("hls") from None
+    except httpx.HTTPError as exc:
+        raise ScraperException(f"Can't download HLS stream {url}") from exc
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+async def _download_hls(url, directory, max_filesize_mb, concurrency, timeout) -> str:
+    async with httpx.AsyncClient(follow_redirects=True) as client:
+        text = await _get_text(client, url, timeout)
+        variants = [Variant(url, 0, None, None)]
+        if is_master_playlist(text):
+            variants = parse_master_playlist(text, url)
+            if not variants:
+                raise ScraperException(f"No variants in HLS playlist {url}")
+            text = await _get_text(client, variants[0].uri, timeout)
+        playlist = parse_media_playlist(text, variants[0].uri)
+        variant = select_variant(variants, playlist.duration, max_filesize_mb)
+        if variant != variants[0]:
+            text = await _get_text(client, variant.uri, timeout)
+            playlist = parse_media_playlist(text, variant.uri)
+        logger.info(
+            "Downloading %s HLS variant of %s with %d segments",
+            variant.resolution or f"{variant.bandwidth}bps",
+            url,
+            len(playlist.segments),
+        )
+        budget = _Budget(max_filesize_mb * 1024 * 1024)
+        video_file = os.path.join(directory, "video")
+        tracks = [(playlist, video_file)]
+        audio_file = None
+        if variant.audio_uri:
+            text = await _get_text(client, variant.audio_uri, timeout)
+            audio_file = os.path.join(directory, "audio")
+            tracks.append((parse_media_playlist(text, variant.audio_uri), audio_file))
+        await gather_or_cancel(
+            _download_track(client, track, filename, budget, concurrency, timeout)
+            for track, filename in tracks
+        )
+    return await remux2MP4(video_file, audio_file)
@@ -1,12 +1,35 @@
+import codecs
+import glob
+import hashlib
+import hmac
 import logging
 import html
+import mmap
+import os
 import random
+import struct
+import sys
+import textwrap
+from array import array
+from bisect import bisect_left
+from datetime import date, datetime, timezone
+from itertools import accumulate
 
 from utils import run_command, which
 
-# games can't be found by which
-FORTUNE_CMD = "/usr/games/fortune"
-COWSAY_CMD = "/usr/games/cowsay"
+FORTUNES_DIR = "/usr/share/games/fortunes"
+# strfile header: version, count, longest, shortest, flags, delimiter
+STRFILE_HEADER = struct.Struct(">5Ic3x")
+STRFILE_ROTATED = 0x4
+# fortune -s threshold
+SHORT_FORTUNE_LENGTH = 160
+COW = r"""
+        \   ^__^
+         \  (oo)\_______
+            (__)\       )\/\
+                ||----w |
+                ||     ||
+"""
 
 random.seed()
 LINE_WIDTH = 30
@@ -29,26 +52,132 @@ SWORDS = {
 }
 
 
-def random_blade_length(min_blade: int = 15, max_blade: int = 160) -> int:
-    return random.randint(min_blade, max_blade)
+SWORD_LENGTHS = sorted(SWORDS)
+SWORD_DESCRIPTIONS = [SWORDS[length] for length in SWORD_LENGTHS]
 
 
-async def sword(user_id: str) -> str:
-    length = random_blade_length()
-    sword_message = f"{user_id} blade is {length}cm long."
+def check_random_secret() -> bool:
+    if os.getenv("RANDOM_SECRET"):
+        return True
+    logger.warning("RANDOM_SECRET is not set - daily results can be predicted")
+    return False
+
+
+def daily_random(seed, day: date | None = None) -> random.Random:
+    # same seed gets the same values for the whole UTC day, across restarts
+    if day is None:
+        day = datetime.now(timezone.utc).date()
+    secret = os.getenv("RANDOM_SECRET", "").encode()
+    digest = hmac.digest(secret, f"{seed}:{day.isoformat()}".encode(), hashlib.sha256)
+    return random.Random(int.from_bytes(digest))
+
+
+def random_blade_length(
+    min_blade: int = 15, max_blade: int = 160, rng: random.Random = random
+) -> int:
+    return rng.randint(min_blade, max_blade)
 
-    for blade_length, description in SWORDS.items():
-        if length <= blade_length:
-            return f"{sword_message} {description}"
 
+def get_sword_description(length: int) -> str | None:
+    index = bisect_left(SWORD_LENGTHS, length)
+    if index < len(SWORD_DESCRIPTIONS):
+        return SWORD_DESCRIPTIONS[index]
+    return None
+
+
+async def sword(user_id: str, seed=None) -> str:
+    rng = daily_random(user_id if seed is None else seed)
+    length = random_blade_length(rng=rng)
+    sword_message = f"{user_id} blade is {length}cm long."
+    description = get_sword_description(length)
+    if description:
+        return f"{sword_message} {description}"
     return sword_message
 
 
-async def fortune(user_id: str) -> str:
-    fortune_line = await run_command(FORTUNE_CMD, "-s")
-    cowsay_line = await run_command(
-        COWSAY_CMD, "-W", str(LINE_WIDTH), fortune_line.strip()
-    )
+class FortuneDB:
+    def __init__(self, path: str):
+        with open(f"{path}.dat", "rb") as index_file:
+            header = index_file.read(STRFILE_HEADER.size)
+            _, count, _, _, flags, delimiter = STRFILE_HEADER.unpack(header)
+            # strfile stores count + 1 offsets, the last one is the end of file
+            self.offsets = array("I", index_file.read((count + 1) * 4))
+        if sys.byteorder == "little":
+            self.offsets.byteswap()
+        self.is_rotated = bool(flags & STRFILE_ROTATED)
+        self.delimiter = delimiter + b"\n"
+        self.short = array(
+            "I",
+            (
+                i
+                for i in range(count)
+                if self.offsets[i + 1] - self.offsets[i] - len(self.delimiter)
+                <= SHORT_FORTUNE_LENGTH
+            ),
+        )
+        with open(path, "rb") as text_file:
+            self.text = mmap.mmap(text_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        quote = self.text[self.offsets[i] : self.offsets[i + 1]]
+        quote = quote.removesuffix(self.delimiter).decode(errors="replace")
+        if self.is_rotated:
+            quote = codecs.decode(quote, "rot13")
+        return quote.strip()
+
+
+_fortune_dbs: list[FortuneDB] = []
+_fortune_weights: list[int] = []
+
+
+def load_fortunes(fortunes_dir: str = FORTUNES_DIR) -> None:
+    _fortune_dbs.clear()
+    for index_path in sorted(glob.glob(os.path.join(fortunes_dir, "*.dat"))):
+        path = index_path.removesuffix(".dat")
+        if not os.path.isfile(path):
+            continue
+        fortune_db = FortuneDB(path)
+        if fortune_db.short:
+            _fortune_dbs.append(fortune_db)
+    _fortune_weights[:] = accumulate(len(db.short) for db in _fortune_dbs)
+    logger.info("Loaded %d fortune databases", len(_fortune_dbs))
+
+
+def random_fortune(rng: random.Random = random) -> str:
+    if not _fortune_dbs:
+        load_fortunes()
+    if not _fortune_dbs:
+        raise FileNotFoundError(f"No fortune databases in {FORTUNES_DIR}")
+    # every short fortune has the same chance, like fortune -s
+    [fortune_db] = rng.choices(_fortune_dbs, cum_weights=_fortune_weights)
+    return fortune_db[rng.choice(fortune_db.short)]
+
+
+def cowsay(text: str, width: int = LINE_WIDTH) -> str:
+    lines = textwrap.wrap(" ".join(text.split()), width - 1) or [""]
+    bubble_width = max(len(line) for line in lines)
+    bubble = [" " + "_" * (bubble_width + 2)]
+    if len(lines) == 1:
+        bubble.append(f"< {lines[0]} >")
+    else:
+        for i, line in enumerate(lines):
+            if i == 0:
+                left, right = "/", "\\"
+            elif i == len(lines) - 1:
+                left, right = "\\", "/"
+            else:
+                left, right = "|", "|"
+            bubble.append(f"{left} {line.ljust(bubble_width)} {right}")
+    bubble.append(" " + "-" * (bubble_width + 2))
+    return "\n".join(bubble) + COW
+
+
+async def fortune(user_id: str, seed=None) -> str:
+    rng = daily_random(user_id if seed is None else seed)
+    cowsay_line = cowsay(random_fortune(rng), LINE_WIDTH)
     escaped_line = html.escape(cowsay_line.strip())
     return f"{user_id} fortune for today<pre><code>{escaped_line}</code></pre>"
 
@@ -0,0 +1,163 @@
+import asyncio
+import math
+from array import array
+from io import BytesIO
+from typing import NamedTuple
+
+from PIL import Image
+
+from converter import photo_executor
+from utils import run_command, which
+
+HASH_SIZE = 8
+# frame is one pixel wider as dhash compares neighbours
+HASH_FRAME_SIZE = (HASH_SIZE + 1) * HASH_SIZE
+MAX_DISTANCE = 4
+# flat frames and text on white set only a few bits, such hashes match
+# unrelated media and are never stored or looked up
+MIN_HASH_BITS = 8
+# per chat, older reposts are forgotten first
+MAX_REPOSTS = 10_000
+VIDEO_KEYFRAMES = 3
+
+
+class Repost(NamedTuple):
+    kind: str
+    file_id: str
+    message_id: int
+
+
+def _dhash_pixels(pixels) -> int:
+    value = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(offset, offset + HASH_SIZE):
+            value = value << 1 | (pixels[col] > pixels[col + 1])
+    return value
+
+
+def _dhash_image(source) -> int:
+    if isinstance(source, bytes):
+        source = BytesIO(source)
+    with Image.open(source) as image:
+        # hash needs only a few pixels, so decode JPEG at 1/8 scale
+        image.draft("L", (HASH_SIZE * 8, HASH_SIZE * 8))
+        small = image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE))
+        return _dhash_pixels(small.tobytes())
+
+
+async def dhash_image(source) -> int:
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(photo_executor, _dhash_image, source)
+
+
+async def dhash_video(
+    filename: str, keyframes: int = VIDEO_KEYFRAMES, timeout: float | None = None
+) -> int:
+    ffmpeg_args = [
+        "-v",
+        "error",
+        "-skip_frame",
+        "nokey",
+        "-i",
+        filename,
+        "-vf",
+        f"scale={HASH_SIZE + 1}:{HASH_SIZE},format=gray",
+        "-frames:v",
+        str(keyframes),
+        "-fps_mode",
+        "passthrough",
+        "-f",
+        "rawvideo",
+        "-",
+    ]
+    ffmpeg_cmd = await which("ffmpeg")
+    raw = await run_command(ffmpeg_cmd, *ffmpeg_args, decode=False, timeout=timeout)
+    frames_count = len(raw) // HASH_FRAME_SIZE
+    if not frames_count:
+        raise ValueError(f"No keyframes decoded from {filename}")
+    # averaging keyframes keeps a single black intro frame from matching everything
+    pixels = [
+        sum(raw[frame * HASH_FRAME_SIZE + i] for frame in range(frames_count))
+        for i in range(HASH_FRAME_SIZE)
+    ]
+    return _dhash_pixels(pixels)
+
+
+def _has_detail(value: int) -> bool:
+    return MIN_HASH_BITS <= value.bit_count() <= HASH_SIZE * HASH_SIZE - MIN_HASH_BITS
+
+
+class RepostIndex:
+    # multi-index hashing: split 64 bit hashes into max_distance + 1 chunks,
+    # any hash within max_distance shares at least one chunk exactly
+    def __init__(self, max_distance: int = MAX_DISTANCE, maxsize: int = MAX_REPOSTS):
+        self.max_distance = max_distance
+        self.maxsize = maxsize
+        self._chunks_count = max_distance + 1
+        self._chunk_bits = math.ceil(HASH_SIZE * HASH_SIZE / self._chunks_count)
+        # a ring of maxsize slots, a new entry takes the slot of the oldest one
+        self._next_id = 0
+        self._hashes = array("Q")
+        self._reposts = []
+        self._buckets = [{} for _ in range(self._chunks_count)]
+
+    def __len__(self) -> int:
+        return len(self._reposts) - self._reposts.count(None)
+
+    def _chunks(self, value: int):
+        mask = (1 << self._chunk_bits) - 1
+        for i in range(self._chunks_count):
+            yield (value >> (i * self._chunk_bits)) & mask
+
+    def add(self, value: int, repost: Repost) -> None:
+        if not _has_detail(value):
+            return
+        entry_id = self._next_id
+        self._next_id += 1
+        slot = entry_id % self.maxsize
+        if slot < len(self._hashes):
+            if self._reposts[slot] is not None:
+                self._evict(entry_id - self.maxsize, self._hashes[slot])
+            self._hashes[slot] = value
+            self._reposts[slot] = repost
+        else:
+            self._hashes.append(value)
+            self._reposts.append(repost)
+        for bucket, chunk in zip(self._buckets, self._chunks(value)):
+            bucket.setdefault(chunk, array("Q")).append(entry_id)
+
+    def _evict(self, entry_id: int, value: int) -> None:
+        for bucket, chunk in zip(self._buckets, self._chunks(value)):
+            ids = bucket[chunk]
+            # ids are appended in order, so the oldest one is found first
+            ids.remove(entry_id)
+            if not ids:
+                del bucket[chunk]
+
+    def _find_id(self, value: int) -> int | None:
+        found = None
+        best_distance = self.max_distance + 1
+        for bucket, chunk in zip(self._buckets, self._chunks(value)):
+            for entry_id in bucket.get(chunk, ()):
+                distance = (self._hashes[entry_id % self.maxsize] ^ value).bit_count()
+                if distance < best_distance:
+                    found, best_distance = entry_id, distance
+        return found
+
+    def find(self, value: int) -> Repost | None:
+        if not _has_detail(value):
+            return None
+        entry_id = self._find_id(value)
+        if entry_id is None:
+            return None
+        return self._reposts[entry_id % self.maxsize]
+
+    def discard(self, value: int) -> None:
+        # drops the entry find returns, e.g. when its file id went stale
+        entry_id = self._find_id(value) if _has_detail(value) else None
+        if entry_id is None:
+            return
+        slot = entry_id % self.maxsize
+        self._evict(entry_id, self._hashes[slot])
+        self._reposts[slot] = None
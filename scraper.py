@@ -1,23 +1,29 @@
 import asyncio
+import math
+import pickle
 import shutil
 import uuid
 import re
 import os
 import logging
-import time
 from functools import partial
 from urllib.parse import urlparse
 from pathlib import Path
 from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 import httpx
 import validators
-from bs4 import BeautifulSoup
 from tempfile import gettempdir, mkdtemp
-import instaloader
-from yt_dlp import YoutubeDL
-from yt_dlp.utils import DownloadError
-from yt_dlp.postprocessor import PostProcessor
+
+from caching import Cache
+from utils import get_timeout, deadline_exceeded, kill_process_group
+from sources import (
+    get_conditional_headers,
+    get_source_store,
+    get_validators,
+    is_fresh,
+)
 
 BOT_NAME = "@memes2telegram_bot"
 BOT_SUPPORTED_VIDEOS = {"video/mp4", "image/gif", "video/webm"}
@@ -32,6 +38,15 @@ YOUTUBE_HOSTS = {
 }
 KNOWN_VIDEO_EXTENSIONS = {".mp4", ".webm", ".gif"}
 KNOWN_IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+HLS_EXTENSIONS = {".m3u8"}
+HLS_CONTENT_TYPES = {
+    "application/vnd.apple.mpegurl",
+    "application/x-mpegurl",
+    "audio/mpegurl",
+    "audio/x-mpegurl",
+}
+DASH_EXTENSIONS = {".mpd"}
+DASH_CONTENT_TYPES = {"application/dash+xml"}
 NINE_GAG_HOSTS = {
     "img-9gag-fun.9cache.com",
 }
@@ -45,9 +60,21 @@ TIKTOK_PATHS = {
     "tiktok.com/",
 }
 VK_PATHS = {"vk.com/video", "vk.com/clip-"}
+MEDIA_VIDEO = "video"
+MEDIA_AUDIO = "audio"
+# telegram audio player handles only these, key is acodec without profile
+NATIVE_AUDIO_CODECS = {"mp4a": "m4a", "aac": "m4a", "mp3": "mp3"}
+YDL_SOCKET_TIMEOUT_SEC = 30
+# extracted format urls are signed for hours, a planned link is reused for less
+YDL_INFO_TTL_SEC = 600
+# warm yt-dlp workers kept between calls, a killed worker is never reused
+YDL_IDLE_WORKERS = 2
+LINK_PATTERN = re.compile(r"https?://\S+", re.IGNORECASE)
 UUID_PATTERN = re.compile(r"\w{8}-\w{4}-\w{4}-\w{4}-\w{12}")
 
 logger = logging.getLogger(__name__)
+ydl_info_cache = Cache("yt-dlp info", maxsize=128, ttl=YDL_INFO_TTL_SEC)
+_idle_ydl_executors: list[ProcessPoolExecutor] = []
 
 
 def get_content_type(headers):
@@ -146,6 +173,18 @@ is_generic_video = partial(_link_has_extension, KNOWN_VIDEO_EXTENSIONS)
 is_generic_image = partial(_link_has_extension, KNOWN_IMAGE_EXTENSIONS)
 
 
+def _is_manifest(extensions: set[str], content_types: set[str], url, headers=None):
+    # manifest links usually carry tokens in the query string
+    if os.path.splitext(urlparse(url).path)[1].lower() in extensions:
+        return True
+    content_type = get_content_type(headers or {}).split(";")[0].strip()
+    return content_type in content_types
+
+
+is_hls_manifest = partial(_is_manifest, HLS_EXTENSIONS, HLS_CONTENT_TYPES)
+is_dash_manifest = partial(_is_manifest, DASH_EXTENSIONS, DASH_CONTENT_TYPES)
+
+
 def parse_extension(url: str) -> str:
     extension = get_extension(url)
     if extension in KNOWN_VIDEO_EXTENSIONS:
@@ -161,6 +200,14 @@ def link_to_bot(text):
     return text.split(BOT_NAME)[-1].strip()
 
 
+def extract_links(text):
+    # punctuation right after a link belongs to the sentence, not the url
+    links = (
+        match.rstrip(".,;:!?)]}>'\"") for match in LINK_PATTERN.findall(text or "")
+    )
+    return [link for link in dict.fromkeys(links) if is_link(link)]
+
+
 def is_bot_message(text):
     return text.startswith(BOT_NAME)
 
@@ -192,8 +239,104 @@ def _generate_filename(file_url):
     return os.path.join(gettempdir(), f"{file_name}{extension}")
 
 
-async def download_file(url, timeout=60):
+def supports_ranges(headers) -> bool:
+    return headers.get("accept-ranges", "").lower() == "bytes"
+
+
+def split_ranges(size: int, chunks: int) -> list[tuple[int, int]]:
+    chunk_size = math.ceil(size / chunks)
+    return [
+        (start, min(start + chunk_size, size) - 1)
+        for start in range(0, size, chunk_size)
+    ]
+
+
+async def _download_range(client, url, filename, start, end, headers, timeout):
+    range_headers = dict(headers)
+    range_headers.update(
+        {"Range": f"bytes={start}-{end}", "Accept-Encoding": "identity"}
+    )
+    written = 0
+    async with client.stream(
+        "GET", url, headers=range_headers, timeout=timeout
+    ) as response:
+        response.raise_for_status()
+        if response.status_code != httpx.codes.PARTIAL_CONTENT:
+            raise ScraperException(f"Range requests are ignored by {url}")
+        with open(filename, "r+b") as file:
+            file.seek(start)
+            async for chunk in response.aiter_raw():
+                file.write(chunk)
+                written += len(chunk)
+    if written != end - start + 1:
+        raise ScraperException(f"Range {start}-{end} of {url} is incomplete")
+
+
+async def _download_ranges(client, url, filename, size, headers, timeout, chunks):
+    with open(filename, "wb") as file:
+        file.truncate(size)
+    tasks = [
+        asyncio.create_task(
+            _download_range(client, url, filename, start, end, headers, timeout)
+        )
+        for start, end in split_ranges(size, chunks)
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    except (httpx.HTTPError, ScraperException) as exc:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise ScraperException(f"Ranged download of {url} failed") from exc
+    if os.path.getsize(filename) != size:
+        raise ScraperException(f"Ranged download of {url} is incomplete")
+
+
+async def _download_stream(client, url, filename, headers, timeout):
+    async with client.stream("GET", url, headers=headers, timeout=timeout) as response:
+        if response.status_code == httpx.codes.NOT_MODIFIED:
+            return None
+        response.raise_for_status()
+        with open(filename, "wb") as file:
+            async for chunk in response.aiter_bytes():
+                file.write(chunk)
+        return response.headers
+
+
+async def _store_source(url, filename, headers):
+    etag, last_modified = get_validators(headers)
+    # without validators a stored copy could never be checked for freshness
+    if not etag and not last_modified:
+        return
+    try:
+        await asyncio.to_thread(
+            get_source_store().add, url, filename, etag, last_modified
+        )
+    except OSError:
+        logger.exception("Can't store source of %s", url)
+
+
+async def download_file(url, timeout=60, chunks=4, range_min_size_mb=5, deadline=None):
     filename = _generate_filename(url)
+    try:
+        async with asyncio.timeout(get_timeout(deadline)):
+            return await _download_file(
+                url, filename, timeout, chunks, range_min_size_mb
+            )
+    except TimeoutError:
+        remove_file(filename)
+        raise deadline_exceeded("download") from None
+    except BaseException:
+        # a partial file would otherwise stay in the temp dir forever
+        remove_file(filename)
+        raise
+
+
+async def _download_file(url, filename, timeout, chunks, range_min_size_mb):
+    size = 0
+    headers = None
+    store = get_source_store()
+    source = await asyncio.to_thread(store.lookup, url)
     async with httpx.AsyncClient(follow_redirects=True) as client:
         try:
             headers = await get_headers(client, url)
@@ -202,15 +345,36 @@ async def download_file(url, timeout=60):
         else:
             if not is_downloadable(headers):
                 raise ScraperException(f"Can't download file from {url}")
+            if source and is_fresh(source, headers):
+                logger.info("Reusing stored source %s of %s", source.sha256, url)
+                return await asyncio.to_thread(store.checkout, source, filename)
+            source = None
+            if supports_ranges(headers):
+                size = int(headers.get("content-length", 0))
         request_headers = _get_referer_headers(url)
         request_headers["User-Agent"] = "Mozilla/5.0"
-        async with client.stream(
-            "GET", url, headers=request_headers, timeout=timeout
-        ) as response:
-            response.raise_for_status()
-            content = await response.aread()
-            with open(filename, "wb") as file:
-                file.write(content)
+        if chunks > 1 and size >= range_min_size_mb * 1024 * 1024:
+            try:
+                await _download_ranges(
+                    client, url, filename, size, request_headers, timeout, chunks
+                )
+            except ScraperException:
+                logger.exception(
+                    "Can't download %s by ranges - falling back to single stream", url
+                )
+            else:
+                await _store_source(url, filename, headers)
+                return filename
+        if source:
+            # no HEAD answer, so let the server tell whether the copy is stale
+            request_headers.update(get_conditional_headers(source))
+        response_headers = await _download_stream(
+            client, url, filename, request_headers, timeout
+        )
+    if response_headers is None:
+        logger.info("Source %s of %s is not modified", source.sha256, url)
+        return await asyncio.to_thread(store.checkout, source, filename)
+    await _store_source(url, filename, response_headers)
     return filename
 
 
@@ -226,9 +390,16 @@ async def download_image(client, url, timeout=30):
             "Priority": "u=1",
         }
     )
+    store = get_source_store()
+    source = await asyncio.to_thread(store.lookup, url)
+    if source:
+        request_headers.update(get_conditional_headers(source))
     async with client.stream(
         "GET", url, headers=request_headers, timeout=timeout
     ) as response:
+        if source and response.status_code == httpx.codes.NOT_MODIFIED:
+            logger.info("Image %s is not modified - reusing stored source", url)
+            return await asyncio.to_thread(store.read, source)
         response.raise_for_status()
         content_type = get_content_type(response.headers)
         if not content_type.startswith("image/"):
@@ -236,7 +407,13 @@ async def download_image(client, url, timeout=30):
                 f"Downloaded file from {url} is not an image, it's {content_type}"
             )
         content = await response.aread()
-        return content
+    etag, last_modified = get_validators(response.headers)
+    if etag or last_modified:
+        try:
+            await asyncio.to_thread(store.add_bytes, url, content, etag, last_modified)
+        except OSError:
+            logger.exception("Can't store source of %s", url)
+    return content
 
 
 def remove_file(filename):
@@ -274,6 +451,9 @@ def _is_post_pic(tag):
 
 
 def _get_post_pics(html_doc):
+    # heavy parsers are imported by worker processes only
+    from bs4 import BeautifulSoup
+
     soup = BeautifulSoup(html_doc, "html.parser")
     img_tags = soup.find_all("img")
     images = [img["src"] for img in img_tags if _is_post_pic(img)]
@@ -293,6 +473,8 @@ async def get_post_pics(post_url, timeout=30):
 
 
 def _get_instagram_pics(album_url):
+    import instaloader
+
     shortcode = album_url.split("/")[-2]
     tmp_folder = mkdtemp()
     L = instaloader.Instaloader(
@@ -332,203 +514,309 @@ async def get_instagram_pics(album_url):
         return await loop.run_in_executor(executor, _get_instagram_pics, album_url)
 
 
-class FinishedVideoPostProcessor(PostProcessor):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.final_file_path = None
-        self.title = None
+def _has_video(fmt: dict) -> bool:
+    return fmt.get("vcodec") != "none"
 
-    def run(self, info: dict) -> tuple[list, dict]:
-        self.final_file_path = info["requested_downloads"][0]["filepath"]
-        self.title = info.get("title", "")
-        return [], info
 
+def _has_audio(fmt: dict) -> bool:
+    return fmt.get("acodec") != "none"
 
-class FinishedAudioPostProcessor(PostProcessor):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.final_file_path = None
-        self.title = None
 
-    def run(self, info: dict) -> tuple[list, dict]:
-        self.final_file_path = info["filepath"]
-        self.title = info["title"]
-        return [], info
+def estimate_filesize(fmt: dict, duration: float | None = None) -> int | None:
+    filesize = fmt.get("filesize") or fmt.get("filesize_approx")
+    if filesize:
+        return int(filesize)
+    # total bitrate is in KBit/s
+    bitrate = fmt.get("tbr")
+    if bitrate and duration:
+        return int(bitrate * 1000 / 8 * duration)
+    return None
 
 
-def _download_video(
-    video_url: str, opts: dict, max_retries: int = 3, retry_delay_sec: int = 5
-) -> str:
-    finished_post_processor = FinishedVideoPostProcessor()
-    with YoutubeDL(opts) as ydl:
-        ydl.add_post_processor(finished_post_processor, when="after_video")
-        try:
-            error_code = ydl.download([video_url])
-        except DownloadError as exc:
-            raise ScraperException(f"Video {video_url} download error") from exc
-        else:
-            if error_code:
-                raise ScraperException(
-                    f"Video {video_url} download got error code {error_code}"
-                )
-    retries = 1
-    while finished_post_processor.final_file_path is None:
-        logger.warning(
-            f"Try {retries} failed. Sleeping {retry_delay_sec} until video path is not set"
-        )
-        time.sleep(retry_delay_sec * retries)
-        retries += 1
-        if retries == max_retries:
-            raise ScraperException(f"Video {video_url} won't download fully")
-    try:
-        check_filesize(finished_post_processor.final_file_path)
-    except UploadIsTooBig:
-        remove_file(finished_post_processor.final_file_path)
-        raise
-    return finished_post_processor.final_file_path, finished_post_processor.title
+def get_native_audio_codec(fmt: dict) -> str | None:
+    acodec = (fmt.get("acodec") or "").split(".")[0]
+    return NATIVE_AUDIO_CODECS.get(acodec)
 
 
-def _download_audio(
-    audio_url: str, opts: dict, max_retries: int = 3, retry_delay_sec: int = 5
-) -> tuple[str, str]:
-    finished_post_processor = FinishedAudioPostProcessor()
-    with YoutubeDL(opts) as ydl:
-        ydl.add_post_processor(finished_post_processor)
-        try:
-            error_code = ydl.download([audio_url])
-        except DownloadError as exc:
-            raise ScraperException(f"Audio {audio_url} download error") from exc
-        else:
-            if error_code:
-                raise ScraperException(
-                    f"Audio {audio_url} download got error code {error_code}"
-                )
-    retries = 1
-    while finished_post_processor.final_file_path is None:
-        logger.warning(
-            f"Try {retries} failed. Sleeping {retry_delay_sec} until audio path are not set"
-        )
-        time.sleep(retry_delay_sec * retries)
-        retries += 1
-        if retries == max_retries:
-            raise ScraperException(f"Audio {audio_url} won't download fully")
-    try:
-        check_filesize(finished_post_processor.final_file_path)
-    except UploadIsTooBig:
-        remove_file(finished_post_processor.final_file_path)
-        raise
-    return finished_post_processor.final_file_path, finished_post_processor.title
+def _fits(filesize: int | None, budget: int) -> bool:
+    # unknown sizes are left to the yt-dlp max_filesize guard
+    return filesize is None or filesize <= budget
 
 
-def _get_youtube_video(youtube_url: str, max_filesize_mb: int = 50) -> str:
-    size_filter = f"[filesize<{max_filesize_mb}M]"
-    tmp_dir = gettempdir()
-    formats = "/".join(
-        (
-            f"bestvideo*{size_filter}+bestaudio{size_filter}",
-            f"best{size_filter}",
+def _sum_filesizes(*filesizes: int | None) -> int | None:
+    if any(filesize is None for filesize in filesizes):
+        return None
+    return sum(filesizes)
+
+
+def plan_format(
+    info: dict, max_filesize_mb: int = 50, allow_audio: bool = False
+) -> tuple[str, str]:
+    budget = max_filesize_mb * 1024 * 1024
+    duration = info.get("duration")
+    # yt-dlp sorts formats from worst to best
+    formats = [
+        (fmt, estimate_filesize(fmt, duration))
+        for fmt in reversed(info.get("formats") or [info])
+    ]
+    has_audio_formats = any(_has_audio(fmt) for fmt, _ in formats)
+    audio_formats = [
+        (fmt, filesize)
+        for fmt, filesize in formats
+        if _has_audio(fmt) and not _has_video(fmt) and _fits(filesize, budget)
+    ]
+    best_audio, best_audio_size = audio_formats[0] if audio_formats else (None, None)
+    for fmt, filesize in formats:
+        if not _has_video(fmt):
+            continue
+        format_id = fmt.get("format_id", "best")
+        if _has_audio(fmt) or not has_audio_formats:
+            if _fits(filesize, budget):
+                return format_id, MEDIA_VIDEO
+        elif best_audio is not None:
+            if _fits(_sum_filesizes(filesize, best_audio_size), budget):
+                return f"{format_id}+{best_audio['format_id']}", MEDIA_VIDEO
+    if allow_audio and best_audio is not None:
+        # prefer a stream telegram plays as it is to avoid transcoding
+        native_audio = next(
+            (fmt for fmt, _ in audio_formats if get_native_audio_codec(fmt)),
+            best_audio,
         )
+        return native_audio["format_id"], MEDIA_AUDIO
+    raise UploadIsTooBig(
+        f"No format of {info.get('title', 'media')} fits into the {max_filesize_mb} MB upload limit"
     )
-    opts = {
-        "format": formats,
-        "paths": {"home": tmp_dir, "temp": tmp_dir},
-        "cachedir": False,
-        "restrictfilenames": True,
-        "noprogress": True,
-        "no_color": True,
-        "vcodec": "libx264",
-        "acodec": "aac",
-        "merge_output_format": "mp4",
-        "max_filesize": (max_filesize_mb + 1) * 1024 * 1024,  # 51 mb
-    }
-    return _download_video(youtube_url, opts)
 
 
-def _get_vk_video(vk_url: str, max_filesize_mb: int = 50) -> str:
-    tmp_dir = gettempdir()
-    opts = {
-        "paths": {"home": tmp_dir, "temp": tmp_dir},
-        "cachedir": False,
-        "restrictfilenames": True,
-        "noprogress": True,
-        "no_color": True,
-        "vcodec": "libx264",
-        "acodec": "aac",
-        "merge_output_format": "mp4",
-        "max_filesize": (max_filesize_mb + 1) * 1024 * 1024,  # 51 mb
-    }
-    return _download_video(vk_url, opts)
+def _find_format(info: dict, format_id: str) -> dict:
+    formats = info.get("formats") or [info]
+    return next((fmt for fmt in formats if fmt.get("format_id") == format_id), {})
 
 
-def _get_instagram_video(reel_url: str, max_filesize_mb: int = 50) -> str:
+def _get_ydl_opts(max_filesize_mb: int = 50, temp_dir: str | None = None) -> dict:
     tmp_dir = gettempdir()
-    opts = {
-        "paths": {"home": tmp_dir, "temp": tmp_dir},
+    return {
+        "paths": {"home": tmp_dir, "temp": temp_dir or tmp_dir},
         "cachedir": False,
+        "socket_timeout": YDL_SOCKET_TIMEOUT_SEC,
         "restrictfilenames": True,
+        "noplaylist": True,
+        "concurrent_fragment_downloads": 4,
         "noprogress": True,
         "no_color": True,
-        "vcodec": "libx264",
-        "acodec": "aac",
-        "merge_output_format": "mp4",
         "max_filesize": (max_filesize_mb + 1) * 1024 * 1024,  # 51 mb
     }
-    return _download_video(reel_url, opts)
 
 
-def _get_youtube_audio(
-    youtube_url: str, max_filesize_mb: int = 50, codec: str = "mp3"
-) -> str:
-    size_filter = f"[filesize<{max_filesize_mb}M]"
-    tmp_dir = gettempdir()
-    formats = "/".join(
-        (
-            f"bestaudio{size_filter}",
-            f"best{size_filter}",
-        )
-    )
-    opts = {
-        "format": formats,
-        "paths": {"home": tmp_dir, "temp": tmp_dir},
-        "cachedir": False,
-        "restrictfilenames": True,
-        "noprogress": True,
-        "no_color": True,
-        "acodec": codec,
-        "max_filesize": (max_filesize_mb + 1) * 1024 * 1024,  # 51 mb
-        "postprocessors": [
+def _extract_info(media_url: str, opts: dict) -> dict:
+    # yt-dlp is imported by worker processes only
+    from yt_dlp import YoutubeDL
+    from yt_dlp.utils import DownloadError
+
+    with YoutubeDL(opts) as ydl:
+        try:
+            return ydl.extract_info(media_url, download=False)
+        except DownloadError as exc:
+            raise ScraperException(f"Media {media_url} info extraction error") from exc
+
+
+def _download_info(media_url: str, info: dict, opts: dict) -> tuple[str, str]:
+    from yt_dlp import YoutubeDL
+    from yt_dlp.utils import DownloadError
+
+    # post hooks get the final path after merging, conversion and moving
+    final_file_paths = []
+    # reuse already extracted info instead of running the extractor again
+    with YoutubeDL(opts) as ydl:
+        ydl.add_post_hook(final_file_paths.append)
+        try:
+            ydl.process_ie_result(info, download=True)
+        except DownloadError as exc:
+            raise ScraperException(f"Media {media_url} download error") from exc
+    # hooks run synchronously, so waiting won't make a missing path appear
+    if not final_file_paths:
+        raise ScraperException(f"Media {media_url} won't download fully")
+    final_file_path = final_file_paths[-1]
+    try:
+        check_filesize(final_file_path)
+    except UploadIsTooBig:
+        remove_file(final_file_path)
+        raise
+    return final_file_path, info.get("title", "")
+
+
+def _copy_info(info: dict) -> dict | None:
+    # extractors may leave callables in the info, those can't leave the worker
+    try:
+        return pickle.loads(pickle.dumps(info))
+    except Exception:
+        return None
+
+
+def _download_media(
+    media_url: str,
+    max_filesize_mb: int = 50,
+    allow_audio: bool = False,
+    temp_dir: str | None = None,
+    info: dict | None = None,
+) -> tuple[tuple[str, str, str], dict | None]:
+    opts = _get_ydl_opts(max_filesize_mb, temp_dir)
+    if info is None:
+        info = _extract_info(media_url, opts)
+    else:
+        logger.info("Reusing extracted info of %s", media_url)
+    # downloading fills the info with local paths, the copy stays reusable
+    planned_info = _copy_info(info)
+    format_selector, media_type = plan_format(info, max_filesize_mb, allow_audio)
+    logger.info("Planned %s format %s for %s", media_type, format_selector, media_url)
+    opts["format"] = format_selector
+    if media_type == MEDIA_AUDIO:
+        audio_format = _find_format(info, format_selector)
+        codec = get_native_audio_codec(audio_format)
+        if codec:
+            logger.info("Copying native %s audio of %s", codec, media_url)
+        else:
+            codec = "mp3"
+            logger.info(
+                "Transcoding %s audio of %s to %s",
+                audio_format.get("acodec"),
+                media_url,
+                codec,
+            )
+        # same codec makes ffmpeg copy the stream into a proper container
+        opts["postprocessors"] = [
             {
                 "key": "FFmpegExtractAudio",
                 "preferredcodec": codec,
             }
-        ],
-    }
-    return _download_audio(youtube_url, opts)
+        ]
+    else:
+        opts.update(
+            {
+                "vcodec": "libx264",
+                "acodec": "aac",
+                "merge_output_format": "mp4",
+            }
+        )
+    # the same extractor id and format always resolve to the same media
+    source_key = (
+        f"yt-dlp:{info.get('extractor_key')}:{info.get('id')}:{format_selector}"
+    )
+    store = get_source_store()
+    source = store.lookup(source_key)
+    if source:
+        logger.info("Reusing stored %s for %s", source.name, media_url)
+        checkout = store.checkout(source)
+        return (checkout, info.get("title", ""), media_type), planned_info
+    filename, title = _download_info(media_url, info, opts)
+    try:
+        store.add(source_key, filename)
+    except OSError:
+        logger.exception("Can't store source of %s", media_url)
+    return (filename, title, media_type), planned_info
+
+
+def _get_youtube_media(
+    youtube_url: str,
+    max_filesize_mb: int = 50,
+    temp_dir: str | None = None,
+    info: dict | None = None,
+) -> tuple:
+    return _download_media(youtube_url, max_filesize_mb, True, temp_dir, info)
+
+
+def _get_video(
+    video_url: str,
+    max_filesize_mb: int = 50,
+    temp_dir: str | None = None,
+    info: dict | None = None,
+) -> tuple:
+    (filename, title, _), info = _download_media(
+        video_url, max_filesize_mb, temp_dir=temp_dir, info=info
+    )
+    return (filename, title), info
 
 
-async def get_youtube_video(youtube_url):
-    loop = asyncio.get_event_loop()
-    # both io and cpu bound operations here
-    with ProcessPoolExecutor(max_workers=1) as executor:
-        return await loop.run_in_executor(executor, _get_youtube_video, youtube_url)
+def _init_ydl_worker() -> None:
+    # own process group, so ffmpeg spawned by yt-dlp is killed along with it
+    os.setpgrp()
+    # the parent never imports yt-dlp, a reused worker imports it only once
+    import yt_dlp  # noqa: F401
 
 
-async def get_youtube_audio(youtube_url):
-    loop = asyncio.get_event_loop()
-    # both io and cpu bound operations here
-    with ProcessPoolExecutor(max_workers=1) as executor:
-        return await loop.run_in_executor(executor, _get_youtube_audio, youtube_url)
+def _checkout_ydl_executor() -> ProcessPoolExecutor:
+    if _idle_ydl_executors:
+        return _idle_ydl_executors.pop()
+    return ProcessPoolExecutor(max_workers=1, initializer=_init_ydl_worker)
+
+
+def _checkin_ydl_executor(executor: ProcessPoolExecutor) -> None:
+    if len(_idle_ydl_executors) < YDL_IDLE_WORKERS:
+        _idle_ydl_executors.append(executor)
+    else:
+        executor.shutdown(wait=False)
 
 
-async def get_vk_video(vk_url):
+async def prewarm_ydl_worker() -> None:
     loop = asyncio.get_event_loop()
-    # both io and cpu bound operations here
-    with ProcessPoolExecutor(max_workers=1) as executor:
-        return await loop.run_in_executor(executor, _get_vk_video, vk_url)
+    executor = _checkout_ydl_executor()
+    await loop.run_in_executor(executor, os.getpid)
+    _checkin_ydl_executor(executor)
 
 
-async def get_instagram_video(reel_url):
+async def _run_in_worker(func, url: str, deadline=None):
     loop = asyncio.get_event_loop()
+    # fragments and unmerged parts stay here, so a killed job leaves nothing
+    temp_dir = mkdtemp(prefix="yt-dlp-")
+    executor = _checkout_ydl_executor()
+    future = loop.run_in_executor(executor, partial(func, url, temp_dir=temp_dir))
+    try:
+        return await asyncio.wait_for(future, get_timeout(deadline))
+    except TimeoutError:
+        raise deadline_exceeded("yt-dlp") from None
+    finally:
+        if future.cancelled():
+            # the pool can't stop a running call, its worker pids are private
+            for pid in list(executor._processes):
+                kill_process_group(pid)
+            executor.shutdown(wait=False, cancel_futures=True)
+        elif isinstance(future.exception(), BrokenProcessPool):
+            executor.shutdown(wait=False)
+        else:
+            _checkin_ydl_executor(executor)
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+async def _run_ydl(func, url: str, deadline=None):
+    # repeated links skip the extractor, the slowest part of a yt-dlp run
+    info = ydl_info_cache.get(url)
+    try:
+        result, info = await _run_in_worker(partial(func, info=info), url, deadline)
+    except Exception:
+        ydl_info_cache.delete(url)
+        raise
+    if info is not None:
+        ydl_info_cache.set(url, info)
+    return result
+
+
+async def get_youtube_media(youtube_url, deadline=None):
     # both io and cpu bound operations here
-    with ProcessPoolExecutor(max_workers=1) as executor:
-        return await loop.run_in_executor(executor, _get_instagram_video, reel_url)
+    return await _run_ydl(_get_youtube_media, youtube_url, deadline)
+
+
+async def get_youtube_video(youtube_url, deadline=None):
+    return await _run_ydl(_get_video, youtube_url, deadline)
+
+
+async def get_vk_video(vk_url, deadline=None):
+    return await _run_ydl(_get_video, vk_url, deadline)
+
+
+async def get_dash_video(manifest_url, deadline=None):
+    # yt-dlp selects DASH representations and merges them without re-encoding
+    return await _run_ydl(_get_video, manifest_url, deadline)
+
+
+async def get_instagram_video(reel_url, deadline=None):
+    return await _run_ydl(_get_video, reel_url, deadline)
@@ -0,0 +1,195 @@
+import functools
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from tempfile import gettempdir
+from typing import NamedTuple
+
+SOURCE_CACHE_SIZE_MB = 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class Source(NamedTuple):
+    sha256: str
+    name: str
+    etag: str | None
+    last_modified: str | None
+
+
+def get_validators(headers) -> tuple[str | None, str | None]:
+    return headers.get("etag"), headers.get("last-modified")
+
+
+def get_conditional_headers(source: Source) -> dict:
+    headers = {}
+    if source.etag:
+        headers["If-None-Match"] = source.etag
+    if source.last_modified:
+        headers["If-Modified-Since"] = source.last_modified
+    return headers
+
+
+def is_fresh(source: Source, headers) -> bool:
+    etag, last_modified = get_validators(headers)
+    if etag or source.etag:
+        return etag == source.etag
+    return bool(last_modified) and last_modified == source.last_modified
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def hash_file(filename: str) -> str:
+    digest = hashlib.sha256()
+    with open(filename, "rb") as file:
+        while chunk := file.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SourceStore:
+    def __init__(self, directory: str, max_bytes: int):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        # lookups run in threads and forked workers, connections can't be shared
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            local.db = sqlite3.connect(
+                os.path.join(self.directory, "index.sqlite3"),
+                timeout=30,
+                isolation_level=None,
+            )
+            local.db.executescript(
+                "CREATE TABLE IF NOT EXISTS blobs"
+                " (sha256 TEXT PRIMARY KEY, size INTEGER, used REAL);"
+                "CREATE INDEX IF NOT EXISTS blobs_used ON blobs (used);"
+                "CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY,"
+                " sha256 TEXT, name TEXT, etag TEXT, last_modified TEXT);"
+            )
+            local.pid = os.getpid()
+        return local.db
+
+    def _path(self, sha256: str) -> str:
+        return os.path.join(self.directory, sha256[:2], sha256)
+
+    @property
+    def size(self) -> int:
+        (size,) = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()
+        return size
+
+    def lookup(self, url: str) -> Source | None:
+        row = self.db.execute(
+            "SELECT sha256, name, etag, last_modified FROM urls WHERE url = ?", (url,)
+        ).fetchone()
+        if row is None:
+            return None
+        source = Source(*row)
+        if not os.path.exists(self._path(source.sha256)):
+            self.db.execute("DELETE FROM urls WHERE sha256 = ?", (source.sha256,))
+            self.db.execute("DELETE FROM blobs WHERE sha256 = ?", (source.sha256,))
+            return None
+        return source
+
+    def _touch(self, source: Source) -> None:
+        self.db.execute(
+            "UPDATE blobs SET used = ? WHERE sha256 = ?", (time.time(), source.sha256)
+        )
+
+    def checkout(self, source: Source, filename: str | None = None) -> str:
+        if filename is None:
+            filename = os.path.join(
+                gettempdir(), f"{uuid.uuid4().hex[:8]}-{source.name}"
+            )
+        _link_or_copy(self._path(source.sha256), filename)
+        self._touch(source)
+        return filename
+
+    def read(self, source: Source) -> bytes:
+        with open(self._path(source.sha256), "rb") as file:
+            content = file.read()
+        self._touch(source)
+        return content
+
+    def add(
+        self,
+        url: str,
+        filename: str,
+        etag: str | None = None,
+        last_modified: str | None = None,
+    ) -> Source:
+        sha256 = hash_file(filename)
+        path = self._path(sha256)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            spooled = f"{path}.{uuid.uuid4().hex}"
+            _link_or_copy(filename, spooled)
+            os.replace(spooled, path)
+        self.db.execute(
+            "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)",
+            (sha256, os.path.getsize(path), time.time()),
+        )
+        source = Source(sha256, os.path.basename(filename), etag, last_modified)
+        self.db.execute(
+            "INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?, ?)", (url, *source)
+        )
+        self._evict()
+        return source
+
+    def add_bytes(
+        self,
+        url: str,
+        content: bytes,
+        etag: str | None = None,
+        last_modified: str | None = None,
+    ) -> Source:
+        filename = os.path.join(self.directory, f"{uuid.uuid4().hex}.part")
+        with open(filename, "wb") as file:
+            file.write(content)
+        try:
+            return self.add(url, filename, etag, last_modified)
+        finally:
+            os.remove(filename)
+
+    def _evict(self) -> None:
+        size = self.size
+        if size <= self.max_bytes:
+            return
+        rows = self.db.execute(
+            "SELECT sha256, size FROM blobs ORDER BY used"
+        ).fetchall()
+        for sha256, blob_size in rows:
+            if size <= self.max_bytes:
+                break
+            logger.info("Evicting source %s of %d bytes", sha256, blob_size)
+            try:
+                os.remove(self._path(sha256))
+            except FileNotFoundError:
+                pass
+            self.db.execute("DELETE FROM urls WHERE sha256 = ?", (sha256,))
+            self.db.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+            size -= blob_size
+
+
+@functools.cache
+def get_source_store() -> SourceStore:
+    directory = os.getenv("SOURCE_CACHE_DIR") or os.path.join(
+        gettempdir(), "memes2telegram-sources"
+    )
+    max_size_mb = int(os.getenv("SOURCE_CACHE_SIZE_MB", SOURCE_CACHE_SIZE_MB))
+    return SourceStore(directory, max_size_mb * 1024 * 1024)
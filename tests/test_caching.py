@@ -0,0 +1,125 @@
+import asyncio
+
+import pytest
+
+from caching import CACHES, Cache, cached, get_cache_stats
+
+
+def test_cache_evicts_least_recently_used():
+    cache = Cache("test", maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert "a" in cache
+    assert "b" not in cache
+    assert cache.stats.evictions == 1
+
+
+def test_cache_expires_entries():
+    cache = Cache("test", ttl=0)
+    cache.set("a", 1)
+    assert cache.get("a") is None
+    assert cache.stats.expirations == 1
+    assert cache.stats.misses == 1
+    assert len(cache) == 0
+
+
+def test_cache_limits_bytes():
+    cache = Cache("test", maxsize=100, max_bytes=10, sizeof=len)
+    cache.set("a", b"12345")
+    cache.set("b", b"12345")
+    cache.set("c", b"123")
+    assert "a" not in cache
+    assert cache.bytes == 8
+    cache.set("d", b"12345678901")
+    assert "d" not in cache
+    cache.set("b", b"1")
+    assert cache.bytes == 4
+
+
+def test_cache_stats():
+    cache = Cache("test")
+    cache.set("a", 1)
+    cache.get("a")
+    cache.get("b")
+    stats = get_cache_stats()["test"]
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["hit_ratio"] == 0.5
+    assert stats["size"] == 1
+    assert CACHES["test"] is cache
+
+
+def test_cache_persists_entries(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = Cache("test", maxsize=2, path=path)
+    cache.set(("video", 1), ["file id"])
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.delete("b")
+    restored = Cache("test", path=path)
+    assert restored.get(("video", 1)) is None
+    assert restored.get("a") == 1
+    assert "b" not in restored
+    assert len(Cache("other", path=path)) == 0
+
+
+def test_cache_does_not_restore_expired_entries(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    Cache("test", ttl=0, path=path).set("a", 1)
+    assert len(Cache("test", path=path)) == 0
+
+
+def test_cache_persist_loads_existing_entries(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    Cache("test", path=path).set("a", 1)
+    cache = Cache("test")
+    cache.persist(None)
+    assert "a" not in cache
+    cache.persist(path)
+    assert cache.get("a") == 1
+
+
+async def test_get_or_set_calls_factory_once():
+    cache = Cache("test")
+    calls = 0
+
+    async def factory():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return calls
+
+    results = await asyncio.gather(*(cache.get_or_set("a", factory) for _ in range(5)))
+    assert results == [1] * 5
+    assert calls == 1
+    assert cache.stats.coalesced == 4
+    assert await cache.get_or_set("a", factory) == 1
+
+
+async def test_get_or_set_does_not_cache_errors():
+    cache = Cache("test")
+
+    async def factory():
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        await cache.get_or_set("a", factory)
+    assert "a" not in cache
+
+
+async def test_cached_decorator():
+    calls = []
+
+    @cached(maxsize=2)
+    async def double(value, extra=0):
+        calls.append(value)
+        return value * 2 + extra
+
+    assert await double(1) == 2
+    assert await double(1) == 2
+    assert await double(1, extra=1) == 3
+    assert calls == [1, 1]
+    assert double.cache.name.endswith("double")
+    assert double.cache.stats.hits == 1
@@ -0,0 +1,397 @@
+import contextlib
+import os
+import re
+import shutil
+import struct
+import subprocess
+from io import BytesIO
+
+import pytest
+from PIL import Image, ImageFile
+
+import converter
+from converter import (
+    CPUAllocator,
+    convert2Animation,
+    convert2MP4,
+    read_mp4_metadata,
+    is_animated_image,
+    is_animation,
+    get_tile_boxes,
+    tile_photo,
+    _prepare_photo,
+    PHOTO_MAX_SIDE,
+    TILE_MAX_WIDTH,
+    TILE_RATIO,
+)
+from utils import CMDException, DeadlineExceeded
+
+
+def _write(tmp_path, name, content):
+    path = tmp_path / name
+    path.write_bytes(content)
+    return str(path)
+
+
+def _webp_header(flags):
+    return (
+        b"RIFF"
+        + struct.pack("<I", 30)
+        + b"WEBPVP8X"
+        + struct.pack("<I", 10)
+        + bytes([flags])
+    )
+
+
+def test_is_animated_image_gif(tmp_path):
+    assert is_animated_image(_write(tmp_path, "a.gif", b"GIF89a" + b"\0" * 20))
+    assert is_animated_image(_write(tmp_path, "b.gif", b"GIF87a" + b"\0" * 20))
+
+
+def test_is_animated_image_animated_webp(tmp_path):
+    assert is_animated_image(_write(tmp_path, "a.webp", _webp_header(0x02)))
+
+
+def test_is_animated_image_static_webp(tmp_path):
+    assert not is_animated_image(_write(tmp_path, "a.webp", _webp_header(0x00)))
+
+
+@pytest.mark.parametrize("content", [b"", b"GIF8", b"RIFF", _webp_header(0x02)[:20]])
+def test_is_animated_image_truncated(tmp_path, content):
+    assert not is_animated_image(_write(tmp_path, "a.webp", content))
+
+
+def test_is_animated_image_video(tmp_path):
+    content = b"\0\0\0\x18ftypmp42" + b"\0" * 20
+    assert not is_animated_image(_write(tmp_path, "a.mp4", content))
+
+
+@pytest.mark.parametrize(
+    "media_info, expected",
+    [
+        ({"streams": [{"codec_type": "video"}], "format": {"duration": "5.0"}}, True),
+        (
+            {
+                "streams": [{"codec_type": "video"}, {"codec_type": "audio"}],
+                "format": {"duration": "5.0"},
+            },
+            False,
+        ),
+        ({"streams": [{"codec_type": "video"}], "format": {"duration": "600"}}, False),
+        ({"streams": [{"codec_type": "video"}], "format": {}}, False),
+    ],
+)
+async def test_is_animation_silent_clip(mocker, tmp_path, media_info, expected):
+    mocker.patch("converter.probe", return_value=media_info)
+    filename = _write(tmp_path, "a.mp4", b"\0" * 32)
+    assert await is_animation(filename) is expected
+
+
+async def test_is_animation_probe_error(mocker, tmp_path):
+    mocker.patch("converter.probe", side_effect=CMDException)
+    filename = _write(tmp_path, "a.mp4", b"\0" * 32)
+    assert await is_animation(filename) is False
+
+
+def _image_bytes(size, image_format="JPEG", mode="RGB"):
+    with BytesIO() as buffer:
+        Image.new(mode, size, color="red").save(buffer, image_format)
+        return buffer.getvalue()
+
+
+def test_prepare_photo_downscales_big_jpeg():
+    content = _prepare_photo(_image_bytes((6000, 3000)))
+    with Image.open(BytesIO(content)) as image:
+        assert image.format == "JPEG"
+        assert image.size == (PHOTO_MAX_SIDE, PHOTO_MAX_SIDE // 2)
+
+
+def test_prepare_photo_keeps_small_image_size():
+    content = _prepare_photo(_image_bytes((640, 480)))
+    with Image.open(BytesIO(content)) as image:
+        assert image.size == (640, 480)
+
+
+def test_prepare_photo_converts_transparent_png():
+    content = _prepare_photo(_image_bytes((3000, 3000), "PNG", "RGBA"))
+    with Image.open(BytesIO(content)) as image:
+        assert image.format == "JPEG"
+        assert image.mode == "RGB"
+        assert image.size == (PHOTO_MAX_SIDE, PHOTO_MAX_SIDE)
+
+
+def test_get_tile_boxes_short_image():
+    assert get_tile_boxes(100, 150, 200, 20) == [(0, 0, 100, 150)]
+
+
+def test_get_tile_boxes_overlap_and_bottom_alignment():
+    assert get_tile_boxes(100, 500, 200, 20) == [
+        (0, 0, 100, 200),
+        (0, 180, 100, 380),
+        (0, 300, 100, 500),
+    ]
+
+
+async def test_tile_photo_longpost():
+    tiles = await tile_photo(_image_bytes((2000, 20000)))
+    assert len(tiles) > 1
+    for tile in tiles:
+        with Image.open(BytesIO(tile)) as image:
+            assert image.format == "JPEG"
+            assert image.size == (TILE_MAX_WIDTH, TILE_MAX_WIDTH * TILE_RATIO)
+
+
+async def test_tile_photo_too_many_tiles():
+    assert await tile_photo(_image_bytes((100, 20000))) == []
+
+
+async def test_tile_photo_limits_decoded_pixels(mocker):
+    mocker.patch("converter.TILE_MAX_SOURCE_PIXELS", 10_000_000)
+    content = _image_bytes((3000, 9000), "PNG")
+    load = mocker.spy(ImageFile.ImageFile, "load")
+    # PNG can't be decoded at a smaller size, JPEG is drafted to 1500x4500
+    assert await tile_photo(content) == []
+    assert not load.call_count
+    assert await tile_photo(_image_bytes((3000, 9000)))
+
+
+def _box(kind, payload):
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+def _tkhd(width, height, version=0):
+    times = bytes(32 if version else 20)
+    return _box(
+        b"tkhd",
+        bytes([version, 0, 0, 0])
+        + times
+        + bytes(52)
+        + struct.pack(">II", width << 16, height << 16),
+    )
+
+
+def test_read_mp4_metadata(tmp_path):
+    mvhd = _box(b"mvhd", bytes(12) + struct.pack(">II", 1000, 12600) + bytes(80))
+    audio = _box(b"trak", _tkhd(0, 0))
+    video = _box(b"trak", _tkhd(1280, 720, version=1))
+    content = (
+        _box(b"ftyp", b"isom")
+        + _box(b"moov", mvhd + audio + video)
+        + _box(b"mdat", bytes(100))
+    )
+    assert read_mp4_metadata(_write(tmp_path, "a.mp4", content)) == (1280, 720, 13)
+
+
+def test_read_mp4_metadata_without_moov(tmp_path):
+    content = _box(b"ftyp", b"isom") + _box(b"mdat", bytes(10))
+    path = _write(tmp_path, "a.mp4", content)
+    assert read_mp4_metadata(path) == (None, None, None)
+
+
+requires_ffmpeg = pytest.mark.skipif(
+    not shutil.which("ffmpeg"), reason="ffmpeg is not installed"
+)
+
+
+def _make_video(tmp_path, name, source, *args):
+    path = str(tmp_path / name)
+    subprocess.run(
+        ["ffmpeg", "-v", "error", "-f", "lavfi", "-i", source, *args, path],
+        check=True,
+    )
+    return path
+
+
+def _remove(*filenames):
+    for filename in filenames:
+        if filename:
+            os.remove(filename)
+
+
+@requires_ffmpeg
+async def test_convert2mp4_metadata_and_thumbnail(tmp_path):
+    source = _make_video(
+        tmp_path,
+        "video.mkv",
+        "testsrc=size=640x360:rate=25:duration=2",
+        "-c:v",
+        "libx264",
+    )
+    converted = await convert2MP4(source)
+    try:
+        assert (converted.width, converted.height) == (640, 360)
+        assert converted.duration == 2
+        with Image.open(converted.thumbnail) as thumbnail:
+            assert thumbnail.format == "JPEG"
+            assert thumbnail.size == (320, 180)
+        assert os.path.getsize(converted.thumbnail) < 200 * 1024
+    finally:
+        _remove(converted.filename, converted.thumbnail)
+
+
+@requires_ffmpeg
+async def test_convert2animation_keeps_small_thumbnail(tmp_path):
+    source = _make_video(
+        tmp_path, "anim.gif", "testsrc=size=200x100:rate=10:duration=1"
+    )
+    converted = await convert2Animation(source)
+    try:
+        assert (converted.width, converted.height, converted.duration) == (200, 100, 1)
+        with Image.open(converted.thumbnail) as thumbnail:
+            assert thumbnail.size == (200, 100)
+    finally:
+        _remove(converted.filename, converted.thumbnail)
+
+
+def _decoded_duration(path, stream):
+    # decoding the stream to the end tells its real length, not the header's
+    result = subprocess.run(
+        ["ffmpeg", "-i", path, "-map", f"0:{stream}", "-f", "null", "-"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    hours, minutes, seconds = re.findall(r"time=(\d+):(\d+):([\d.]+)", result.stderr)[
+        -1
+    ]
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+@requires_ffmpeg
+async def test_convert2mp4_segmented_keeps_sync(tmp_path, mocker):
+    source = _make_video(
+        tmp_path,
+        "long.mkv",
+        "testsrc=size=320x240:rate=25:duration=20",
+        "-f",
+        "lavfi",
+        "-i",
+        "sine=frequency=440:duration=20",
+        "-c:v",
+        "libx264",
+        "-g",
+        "50",
+        "-c:a",
+        "flac",
+    )
+    mocker.patch("converter.probe", return_value={"format": {"duration": "20"}})
+    mocker.patch("converter.SEGMENTED_MIN_DURATION_SEC", 10)
+    mocker.patch("converter.SEGMENTED_MIN_SIZE", 0)
+    mocker.patch("converter.SEGMENT_DURATION_SEC", 5)
+    mocker.patch("converter.get_cpu_allocator", return_value=CPUAllocator((0, 1)))
+    split = mocker.spy(converter, "_split_video")
+    converted = await convert2MP4(source)
+    try:
+        assert len(split.spy_return) == 4
+        assert (converted.width, converted.height, converted.duration) == (
+            320,
+            240,
+            20,
+        )
+        assert converted.thumbnail
+        video = _decoded_duration(converted.filename, "v:0")
+        audio = _decoded_duration(converted.filename, "a:0")
+        assert video == pytest.approx(20, abs=0.05)
+        assert audio == pytest.approx(video, abs=0.05)
+    finally:
+        _remove(converted.filename, converted.thumbnail)
+
+
+async def test_convert2mp4_short_video_is_not_segmented(mocker, tmp_path):
+    mocker.patch("converter.probe", return_value={"format": {"duration": "60"}})
+    mocker.patch("converter.SEGMENTED_MIN_SIZE", 0)
+    mocker.patch("converter.get_cpu_allocator", return_value=CPUAllocator((0, 1)))
+    encode_video = mocker.patch("converter._encode_video")
+    encode_segmented = mocker.patch("converter._encode_segmented")
+    await convert2MP4(_write(tmp_path, "short.mp4", b""))
+    encode_video.assert_called_once()
+    encode_segmented.assert_not_called()
+
+
+async def test_convert2mp4_small_file_is_not_probed(mocker, tmp_path):
+    probe = mocker.patch("converter.probe")
+    mocker.patch("converter.get_cpu_allocator", return_value=CPUAllocator((0, 1)))
+    encode_video = mocker.patch("converter._encode_video")
+    await convert2MP4(_write(tmp_path, "clip.mp4", b"\0" * 1024))
+    probe.assert_not_called()
+    encode_video.assert_called_once()
+
+
+async def test_probe_is_bounded_by_timeout_and_reused(mocker, tmp_path):
+    mocker.patch("converter.which", return_value="ffprobe")
+    run_command = mocker.patch(
+        "converter.run_command", return_value='{"format": {"duration": "200"}}'
+    )
+    filename = _write(tmp_path, "long.mp4", b"")
+    assert await converter.get_duration(filename, timeout=5) == 200
+    assert await is_animation(filename) is False
+    run_command.assert_called_once()
+    assert run_command.call_args.kwargs["timeout"] == 5
+
+
+async def test_segmented_copy_passes_run_on_job_cpus(mocker, tmp_path):
+    allocator = CPUAllocator((0, 1), pin=True)
+    mocker.patch("converter.get_cpu_allocator", return_value=allocator)
+    split = mocker.patch("converter._split_video", return_value=[])
+    join = mocker.patch("converter._join_segments")
+    mocker.patch("converter._get_converted_video")
+    await converter._encode_segmented(
+        _write(tmp_path, "long.mp4", b""), converter.MP4_ENCODE_ARGS, "slow"
+    )
+    assert split.call_args.args[-1] == (0, 1)
+    assert join.call_args.args[-1] == (0, 1)
+
+
+async def test_convert2mp4_timeout_removes_partial_outputs(mocker, tmp_path):
+    fake_ffmpeg = tmp_path / "ffmpeg"
+    fake_ffmpeg.write_text(
+        "#!/bin/sh\n"
+        'for arg; do case "$arg" in *.mp4|*.jpg) echo partial > "$arg";; esac; done\n'
+        "sleep 30\n"
+    )
+    fake_ffmpeg.chmod(0o755)
+    mocker.patch("converter.which", return_value=str(fake_ffmpeg))
+    mocker.patch("converter.probe", return_value={})
+    outputs = [str(tmp_path / "converted.mp4"), str(tmp_path / "thumbnail.jpg")]
+    mocker.patch("converter._get_converted_name", side_effect=outputs)
+    with pytest.raises(DeadlineExceeded):
+        await convert2MP4(_write(tmp_path, "source.mov", b""), timeout=0.5)
+    assert not any(os.path.exists(output) for output in outputs)
+
+
+def test_cpu_allocator_splits_cores():
+    allocator = CPUAllocator(tuple(range(8)))
+    with allocator.allocate("slow") as first:
+        assert (first.threads, first.preset, first.cpus) == (8, "slow", None)
+        with allocator.allocate("slow") as second:
+            assert second.threads == 4
+            with allocator.allocate("slow") as third:
+                assert third.threads == 2
+        # idle cores go to the next encode
+        with allocator.allocate("slow") as fourth:
+            assert fourth.threads == 4
+    assert (allocator.active, allocator.threads) == (0, 0)
+
+
+def test_cpu_allocator_speeds_up_preset_under_load():
+    allocator = CPUAllocator((0, 1))
+    with contextlib.ExitStack() as stack:
+        presets = [
+            stack.enter_context(allocator.allocate("slow")).preset for _ in range(5)
+        ]
+        assert presets == ["slow", "medium", "fast", "fast", "veryfast"]
+        # requested preset is never slowed down
+        assert stack.enter_context(allocator.allocate("ultrafast")).preset == (
+            "ultrafast"
+        )
+
+
+def test_cpu_allocator_pins_least_busy_cpus():
+    allocator = CPUAllocator(tuple(range(4)), pin=True)
+    with allocator.allocate("slow") as first:
+        assert first.cpus == (0, 1, 2, 3)
+        with allocator.allocate("slow") as second:
+            assert second.cpus == (0, 1)
+            with allocator.allocate("slow") as third:
+                assert len(third.cpus) == 1
+                assert set(third.cpus).isdisjoint(second.cpus)
@@ -0,0 +1,95 @@
+import gzip
+
+from errors import (
+    COMPRESS_LOG_SIZE,
+    ErrorAggregator,
+    ErrorRecord,
+    get_error_fingerprint,
+    get_error_logs,
+    get_error_summary,
+)
+
+
+def _raise(exc_type=ValueError):
+    try:
+        raise exc_type("boom")
+    except Exception as exc:
+        return exc
+
+
+def _raise_elsewhere():
+    try:
+        raise ValueError("boom")
+    except Exception as exc:
+        return exc
+
+
+def test_fingerprint_same_site():
+    assert get_error_fingerprint(_raise()) == get_error_fingerprint(_raise())
+
+
+def test_fingerprint_differs_by_type_and_site():
+    fingerprint = get_error_fingerprint(_raise())
+    assert fingerprint != get_error_fingerprint(_raise(KeyError))
+    assert fingerprint != get_error_fingerprint(_raise_elsewhere())
+
+
+def test_aggregator_reports_first_and_counts_repeats():
+    errors = ErrorAggregator()
+    assert not errors.is_window_open(1)
+    record = errors.add(1, _raise(), {"update": 1})
+    assert record is not None
+    assert "ValueError: boom" in record.traceback
+    assert errors.is_window_open(1)
+    assert errors.add(1, _raise(), {"update": 2}) is None
+    assert errors.add(1, _raise(), {"update": 3}) is None
+    [flushed] = errors.flush(1)
+    assert flushed.fingerprint == get_error_fingerprint(_raise())
+    assert flushed.count == 3
+    assert flushed.reported == 1
+    assert flushed.message_data == {"update": 3}
+    assert not errors.is_window_open(1)
+
+
+def test_aggregator_flush_skips_reported_once():
+    errors = ErrorAggregator()
+    errors.add(1, _raise(), None)
+    assert errors.flush(1) == []
+
+
+def test_aggregator_rate_limits_per_chat():
+    errors = ErrorAggregator(max_reports=1)
+    assert errors.add(1, _raise(), None) is not None
+    assert errors.add(1, _raise_elsewhere(), None) is None
+    assert errors.add(2, _raise_elsewhere(), None) is not None
+    [postponed] = errors.flush(1)
+    assert postponed.reported == 0
+
+
+def test_get_error_logs():
+    logs = get_error_logs(ErrorRecord("Traceback", {"chat": 1}))
+    assert logs == {
+        "message.json.txt": b'{\n  "chat": 1\n}',
+        "traceback.txt": b"Traceback",
+    }
+
+
+def test_get_error_logs_compresses_big_logs():
+    traceback = "x" * (COMPRESS_LOG_SIZE + 1)
+    logs = get_error_logs(ErrorRecord(traceback, None))
+    assert gzip.decompress(logs["traceback.txt.gz"]) == traceback.encode()
+
+
+def test_get_error_summary_joins_records():
+    errors = ErrorAggregator(max_reports=0)
+    errors.add(1, _raise(), {"update": 1})
+    errors.add(1, _raise(), {"update": 2})
+    errors.add(1, _raise_elsewhere(), None)
+    records = errors.flush(1)
+    [(name, content)] = get_error_summary(records).items()
+    assert name == "errors.txt"
+    summary = content.decode()
+    assert f"{records[0].fingerprint}: 2 time(s), 2 not reported" in summary
+    assert f"{records[1].fingerprint}: 1 time(s), 1 not reported" in summary
+    assert summary.count("ValueError: boom") == 2
+    assert '"update": 2' in summary
@@ -0,0 +1,270 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import gpt as gpt_module
+from gpt import Conversation, Conversations, GPTBusy, GPTGateway, count_tokens
+
+
+def chunk(content=None, usage=None):
+    choices = (
+        []
+        if content is None
+        else [SimpleNamespace(delta=SimpleNamespace(content=content))]
+    )
+    return SimpleNamespace(choices=choices, usage=usage)
+
+
+class FakeClient:
+    def __init__(self, tokens=("Hello", " ", "world"), error=None):
+        self.tokens = tokens
+        self.error = error
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+        self.release = asyncio.Event()
+        self.release.set()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, **kwargs):
+        self.calls.append(kwargs)
+        return self.stream()
+
+    async def stream(self):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await self.release.wait()
+            if self.error:
+                raise self.error
+            for token in self.tokens:
+                yield chunk(token)
+            usage = SimpleNamespace(prompt_tokens=5, completion_tokens=len(self.tokens))
+            yield chunk(usage=usage)
+        finally:
+            self.running -= 1
+
+
+def gateway(client, **kwargs):
+    return GPTGateway(client_factory=lambda: client, **kwargs)
+
+
+async def collect(answers):
+    return [answer async for answer in answers]
+
+
+async def test_ask_streams_accumulated_answer():
+    client = FakeClient()
+    gpt = gateway(client)
+    answers = await collect(gpt.ask(1, "role", "question"))
+    assert answers == ["Hello", "Hello ", "Hello world"]
+    assert client.calls[0]["stream"] is True
+    assert client.calls[0]["messages"][0] == {"role": "system", "content": "role"}
+    assert gpt.metrics["prompt_tokens"] == 5
+    assert gpt.metrics["completion_tokens"] == 3
+
+
+async def test_ask_caches_answer():
+    client = FakeClient()
+    gpt = gateway(client)
+    await collect(gpt.ask(1, "role", "question"))
+    answers = await collect(gpt.ask(2, "role", "question"))
+    assert answers == ["Hello world"]
+    assert len(client.calls) == 1
+    assert gpt.metrics["cache_hits"] == 1
+    await collect(gpt.ask(1, "other role", "question"))
+    assert len(client.calls) == 2
+
+
+async def test_ask_cache_expires():
+    client = FakeClient()
+    gpt = gateway(client, cache_ttl_sec=0)
+    await collect(gpt.ask(1, "role", "question"))
+    await collect(gpt.ask(1, "role", "question"))
+    assert len(client.calls) == 2
+
+
+async def test_ask_coalesces_identical_questions():
+    client = FakeClient()
+    client.release.clear()
+    gpt = gateway(client)
+    first = asyncio.create_task(collect(gpt.ask(1, "role", "question")))
+    second = asyncio.create_task(collect(gpt.ask(2, "role", "question")))
+    await asyncio.sleep(0.01)
+    client.release.set()
+    first, second = await asyncio.gather(first, second)
+    assert first[-1] == second[-1] == "Hello world"
+    assert len(client.calls) == 1
+    assert gpt.metrics["coalesced"] == 1
+
+
+async def test_ask_limits_concurrency():
+    client = FakeClient()
+    client.release.clear()
+    gpt = gateway(client, max_concurrency=2, max_chat_concurrency=1)
+    tasks = [
+        asyncio.create_task(collect(gpt.ask(chat_id, "role", f"question {i}")))
+        for i, chat_id in enumerate([1, 1, 2, 3])
+    ]
+    await asyncio.sleep(0.01)
+    assert client.running == 2
+    client.release.set()
+    await asyncio.gather(*tasks)
+    assert client.max_running == 2
+    assert len(client.calls) == 4
+
+
+async def test_ask_rejects_when_queue_is_full():
+    client = FakeClient()
+    client.release.clear()
+    gpt = gateway(client, max_concurrency=1, max_queue=1)
+    running = asyncio.create_task(collect(gpt.ask(1, "role", "first")))
+    await asyncio.sleep(0.01)
+    queued = asyncio.create_task(collect(gpt.ask(2, "role", "second")))
+    await asyncio.sleep(0.01)
+    with pytest.raises(GPTBusy):
+        gpt.ask(3, "role", "third")
+    assert gpt.metrics["rejected"] == 1
+    client.release.set()
+    await asyncio.gather(running, queued)
+
+
+async def test_ask_rejects_burst_in_one_tick():
+    client = FakeClient()
+    gpt = gateway(client, max_queue=2)
+    answers = [gpt.ask(1, "role", "first"), gpt.ask(2, "role", "second")]
+    with pytest.raises(GPTBusy):
+        gpt.ask(3, "role", "third")
+    await asyncio.gather(*[collect(answer) for answer in answers])
+    assert gpt._waiting == 0
+
+
+async def test_cancelled_question_leaves_queue():
+    client = FakeClient()
+    client.release.clear()
+    gpt = gateway(client, max_concurrency=1)
+    running = asyncio.create_task(collect(gpt.ask(1, "role", "first")))
+    queued = gpt.ask(2, "role", "second")
+    await asyncio.sleep(0.01)
+    assert gpt._waiting == 1
+    [task] = [completion.task for completion in gpt._in_flight.values()][1:]
+    task.cancel()
+    with pytest.raises(GPTBusy):
+        await collect(queued)
+    assert gpt._waiting == 0
+    client.release.set()
+    await running
+
+
+async def test_held_chat_semaphore_is_kept():
+    client = FakeClient()
+    client.release.clear()
+    gpt = gateway(client)
+    running = asyncio.create_task(collect(gpt.ask(1, "role", "first")))
+    await asyncio.sleep(0.01)
+    semaphore = gpt._get_chat_semaphore(1)
+    assert semaphore.locked()
+    client.release.set()
+    await running
+    del semaphore
+    assert 1 not in gpt._chat_semaphores
+
+
+async def test_ask_error_is_not_cached():
+    client = FakeClient(error=RuntimeError("boom"))
+    gpt = gateway(client)
+    with pytest.raises(RuntimeError):
+        await collect(gpt.ask(1, "role", "question"))
+    assert gpt.metrics["errors"] == 1
+    client.error = None
+    assert await collect(gpt.ask(1, "role", "question"))
+    assert len(client.calls) == 2
+
+
+async def test_ask_sends_history():
+    client = FakeClient()
+    gpt = gateway(client)
+    history = (("user", "hi"), ("assistant", "hello"))
+    await collect(gpt.ask(1, "role", "question", history))
+    messages = client.calls[0]["messages"]
+    assert messages[1:] == [
+        {"role": "user", "content": "hi"},
+        {"role": "assistant", "content": "hello"},
+        {"role": "user", "content": "question"},
+    ]
+    await collect(gpt.ask(1, "role", "question"))
+    assert len(client.calls) == 2
+
+
+def test_conversation_history():
+    conversation = Conversation("role")
+    conversation.add("hi", "hello")
+    conversation.add("how are you", "fine")
+    assert conversation.history() == (
+        ("user", "hi"),
+        ("assistant", "hello"),
+        ("user", "how are you"),
+        ("assistant", "fine"),
+    )
+    assert conversation.tokens == sum(
+        count_tokens(t) for _, t in conversation.history()
+    )
+
+
+def test_conversation_summarizes_old_turns():
+    conversation = Conversation("role", max_tokens=100)
+    for i in range(5):
+        conversation.add(f"question {i}", "a" * 200)
+    assert conversation.tokens <= 100
+    assert [turn.question for turn in conversation.turns] == ["question 4"]
+    summary = conversation.history()[0]
+    assert summary == (
+        "system",
+        "Earlier the user asked about: question 0; question 1; question 2; question 3",
+    )
+    expected = count_tokens(conversation.summary) + conversation.turns[0].tokens
+    assert conversation.tokens == expected
+
+
+def test_conversation_limits_turns(mocker):
+    mocker.patch.object(gpt_module, "HISTORY_MAX_TURNS", 2)
+    conversation = Conversation("role")
+    for i in range(4):
+        conversation.add(f"q{i}", "a")
+    assert [turn.question for turn in conversation.turns] == ["q2", "q3"]
+    assert conversation.summary == "q0; q1"
+
+
+def test_conversations_reset_on_role_change():
+    conversations = Conversations()
+    conversations.add(1, "role", "hi", "hello")
+    assert conversations.role(1) == "role"
+    assert conversations.history(1, "role")
+    assert conversations.history(1, "pirate") == ()
+    assert len(conversations) == 0
+    assert conversations.tokens == 0
+
+
+def test_conversations_forget_idle_chats():
+    conversations = Conversations(max_idle_sec=0)
+    conversations.add(1, "role", "hi", "hello")
+    assert conversations.history(1, "role") == ()
+
+
+def test_conversations_evict_least_recently_used():
+    conversations = Conversations(max_chats=2)
+    for chat_id in (1, 2, 1, 3):
+        conversations.add(chat_id, "role", "hi", "hello")
+    assert conversations.role(1) == "role"
+    assert conversations.role(2) is None
+    assert conversations.role(3) == "role"
+
+
+def test_conversations_bound_total_tokens():
+    conversations = Conversations(max_tokens=100)
+    for chat_id in range(10):
+        conversations.add(chat_id, "role", "q" * 100, "a" * 100)
+    assert conversations.tokens <= 100
+    assert len(conversations) == 1
+    assert conversations.role(9) == "role"
@@ -1,18 +1,63 @@
-from unittest.mock import patch
+import asyncio
+import json
+from unittest.mock import AsyncMock, MagicMock, patch
 import pytest
 import httpx
 from pytest_httpx import HTTPXMock
 
+from telegram.error import BadRequest, RetryAfter
+from telegram import (
+    Update,
+    InlineQueryResultCachedPhoto,
+    InlineQueryResultCachedVideo,
+    MessageEntity,
+)
+
+from gpt import Conversations, GPTBusy, GPTGateway
+from sources import SourceStore
+
 from main import (
     check_link,
     image2photo,
     InputMediaPhoto,
+    InputMediaDocument,
     images2album,
+    warm_up,
+    ask_gpt,
+    error_aggregator,
+    error_handler,
+    flush_errors,
+    process,
+    start,
+    inline_query,
+    inline_requests,
+    head_cache,
+    file_id_cache,
+    send_converted_image,
+    send_converted_video,
+    send_manifest_video,
 )
+from converter import ConvertedVideo
+from reposts import Repost, RepostIndex
+from scraper import UploadIsTooBig
 
 image_headers = {"content-type": "image/jpeg", "content-length": b"1", "content": b"1"}
 
 
+@pytest.fixture(autouse=True)
+def source_store(tmp_path, mocker):
+    store = SourceStore(str(tmp_path / "sources"), 1024 * 1024)
+    mocker.patch("scraper.get_source_store", return_value=store)
+    return store
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    head_cache.clear()
+    file_id_cache.clear()
+    inline_requests.clear()
+
+
 @pytest.fixture(autouse=True)
 def mock_get_image_dimensions():
     with patch("main._get_image_dimensions") as mock_get_image_dimensions:
@@ -81,6 +126,81 @@ async def test_check_link_big_file(mocker):
     )
 
 
+async def test_check_link_manifest(mocker):
+    get_headers = mocker.patch("main.get_headers")
+    assert (await check_link("https://example.com/index.m3u8?token=1"))[0] is None
+    get_headers.assert_not_called()
+    mocker.patch(
+        "main.get_headers", return_value={"content-type": "application/dash+xml"}
+    )
+    assert (await check_link("https://example.com/play"))[0] is None
+
+
+async def test_check_link_caches_headers(mocker):
+    link = "https://example.com/some_video.mp4"
+    get_headers = mocker.patch(
+        "main.get_headers", return_value={"content-type": "video/mp4"}
+    )
+    assert (await check_link(link))[0] is None
+    assert (await check_link(link))[0] is None
+    get_headers.assert_awaited_once()
+
+
+async def test_send_converted_image_reuses_file_id(mocker):
+    download_file = mocker.patch("main.download_file")
+    file_id_cache.set("https://example.com/a.jpg", ("photo", "file id"))
+    context = MagicMock()
+    context.bot = AsyncMock()
+    context.job.chat_id = 1
+    context.job.data = {"link": "https://example.com/a.jpg"}
+    await send_converted_image(context)
+    download_file.assert_not_called()
+    assert context.bot.send_photo.await_args.args == (1, "file id")
+
+
+async def test_send_converted_image_drops_rejected_file_id(mocker):
+    link = "https://example.com/a.jpg"
+    download_file = mocker.patch(
+        "main.download_file", side_effect=Exception("downloading")
+    )
+    file_id_cache.set(link, ("photo", "stale id"))
+    context = MagicMock()
+    context.bot = AsyncMock()
+    context.bot.send_photo.side_effect = BadRequest("Wrong file identifier")
+    context.job.chat_id = 1
+    context.job.data = {"link": link}
+    with pytest.raises(Exception, match="downloading"):
+        await send_converted_image(context)
+    download_file.assert_awaited_once()
+    assert link not in file_id_cache
+
+
+async def test_send_converted_image_drops_rejected_repost(tmp_path, mocker):
+    media_hash = 0x5A5A_5A5A_5A5A_5A5A
+    original = tmp_path / "original"
+    converted = tmp_path / "converted.jpg"
+    original.write_bytes(b"original")
+    converted.write_bytes(b"converted")
+    mocker.patch("main.download_file", return_value=str(original))
+    mocker.patch("main.dhash_image", return_value=media_hash)
+    mocker.patch("main.convert2JPG", return_value=str(converted))
+    reposts = RepostIndex()
+    reposts.add(media_hash, Repost("photo", "stale id", 1))
+    context = MagicMock()
+    context.bot = AsyncMock()
+    message = MagicMock(animation=None, video=None, message_id=2)
+    message.photo[-1].file_id = "fresh id"
+    context.bot.send_photo.side_effect = [BadRequest("Wrong file identifier"), message]
+    context.chat_data = {"reposts": reposts}
+    context.job.chat_id = 1
+    context.job.data = {"link": "https://example.com/a.jpg"}
+    await send_converted_image(context)
+    assert context.bot.send_photo.await_count == 2
+    assert context.bot.send_photo.await_args.kwargs["photo"].name == str(converted)
+    assert reposts.find(media_hash) == Repost("photo", "fresh id", 2)
+    assert len(reposts) == 1
+
+
 async def test_check_link_regular_case(mocker):
     link = "https://example.com/some_video.mp4"
     headers = {"content-type": "video/mp4"}
@@ -97,7 +217,7 @@ async def test_image2photo(httpx_mock: HTTPXMock):
     httpx_mock.add_response(url=image_link, headers=image_headers)
     caption = "This is a caption"
     async with httpx.AsyncClient(follow_redirects=True) as client:
-        result = await image2photo(client, image_link, caption)
+        [result] = await image2photo(client, image_link, caption)
     assert isinstance(result, InputMediaPhoto)
     assert result.caption == caption
 
@@ -106,11 +226,50 @@ async def test_image2photo_empty_caption(httpx_mock: HTTPXMock):
     url = "https://example.com/image.jpg"
     httpx_mock.add_response(url=url, headers=image_headers)
     async with httpx.AsyncClient(follow_redirects=True) as client:
-        result = await image2photo(client, url)
+        [result] = await image2photo(client, url)
     assert isinstance(result, InputMediaPhoto)
     assert not result.caption
 
 
+async def test_image2photo_big_image_prepared(
+    httpx_mock: HTTPXMock, mock_get_image_dimensions, mocker
+):
+    image_link = "https://example.com/image.jpg"
+    httpx_mock.add_response(url=image_link, headers=image_headers)
+    mock_get_image_dimensions.return_value = (4000, 3000)
+    prepare_photo = mocker.patch("main.prepare_photo", return_value=b"prepared")
+    async with httpx.AsyncClient(follow_redirects=True) as client:
+        [result] = await image2photo(client, image_link, force_sending_link=True)
+    prepare_photo.assert_awaited_once()
+    assert isinstance(result, InputMediaPhoto)
+
+
+async def test_image2photo_longpost_tiles(
+    httpx_mock: HTTPXMock, mock_get_image_dimensions, mocker
+):
+    image_link = "https://example.com/image.jpg"
+    httpx_mock.add_response(url=image_link, headers=image_headers)
+    mock_get_image_dimensions.return_value = (1000, 8000)
+    mocker.patch("main.tile_photo", return_value=[b"1", b"2", b"3"])
+    async with httpx.AsyncClient(follow_redirects=True) as client:
+        result = await image2photo(client, image_link, "caption")
+    assert len(result) == 3
+    assert all(isinstance(media, InputMediaPhoto) for media in result)
+    assert [media.caption for media in result] == ["caption", None, None]
+
+
+async def test_image2photo_longpost_too_long(
+    httpx_mock: HTTPXMock, mock_get_image_dimensions, mocker
+):
+    image_link = "https://example.com/image.jpg"
+    httpx_mock.add_response(url=image_link, headers=image_headers)
+    mock_get_image_dimensions.return_value = (100, 80000)
+    mocker.patch("main.tile_photo", return_value=[])
+    async with httpx.AsyncClient(follow_redirects=True) as client:
+        [result] = await image2photo(client, image_link)
+    assert isinstance(result, InputMediaDocument)
+
+
 async def test_images2album_5_images(httpx_mock: HTTPXMock):
     image_links = [f"https://example.com/album/image{i}.jpg" for i in range(1, 6)]
     for url in image_links:
@@ -147,3 +306,380 @@ async def test_images2album_no_images():
     expected_result = []
     result = await images2album(image_links, link)
     assert result == expected_result
+
+
+async def test_warm_up_survives_failed_steps(mocker):
+    mocker.patch("main.check_ffmpeg", side_effect=Exception("no ffmpeg"))
+    nsfw = mocker.patch("main._cached_nsfw", return_value="curtain")
+    commit_date = mocker.patch("main.get_latest_commit_date", return_value="date")
+    load_fortunes = mocker.patch("main.load_fortunes")
+    mocker.patch("main.prewarm_ydl_worker")
+    await warm_up(None)
+    nsfw.assert_awaited_once()
+    commit_date.assert_awaited_once()
+    load_fortunes.assert_called_once()
+
+
+GPT_URL = "https://api.openai.com/v1/chat/completions"
+
+
+def gpt_stream(*tokens):
+    chunks = [
+        {
+            "id": "1",
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": "gpt-4o-mini",
+            "choices": [{"index": 0, "delta": {"content": token}}],
+        }
+        for token in tokens
+    ]
+    events = [f"data: {json.dumps(chunk)}\n\n" for chunk in chunks]
+    events.append("data: [DONE]\n\n")
+    return "".join(events).encode()
+
+
+@pytest.fixture(autouse=True)
+def gpt_gateway(mocker):
+    mocker.patch("main.gpt_conversations", Conversations())
+    return mocker.patch("main.gpt_gateway", GPTGateway())
+
+
+def gpt_update(text):
+    update = MagicMock()
+    update.effective_chat.id = 1
+    update.message.text = text
+    update.message.chat.type = "private"
+    return update
+
+
+def gpt_context():
+    context = MagicMock()
+    context.bot = AsyncMock()
+    answer_message = AsyncMock()
+    context.bot.send_message.return_value = answer_message
+    return context, answer_message
+
+
+async def test_ask_gpt_streams_answer(httpx_mock: HTTPXMock, mocker):
+    httpx_mock.add_response(
+        url=GPT_URL,
+        headers={"content-type": "text/event-stream"},
+        content=gpt_stream("Hello", ", ", "*world*"),
+    )
+    mocker.patch("main.GPT_EDIT_INTERVAL_SEC", 0)
+    context, answer_message = gpt_context()
+    await ask_gpt(gpt_update("/gpt pirate: say hi"), context)
+    assert context.bot.send_message.await_args.kwargs["text"] == "…"
+    edits = [call.args[0] for call in answer_message.edit_text.await_args_list]
+    assert edits == ["Hello…", "Hello, …", "Hello, *world*…", "Hello, *world*"]
+    assert answer_message.edit_text.await_args.kwargs["parse_mode"] == "Markdown"
+    request = json.loads(httpx_mock.get_request().content)
+    assert request["stream"] is True
+    assert request["messages"][0] == {"role": "system", "content": "pirate"}
+    context.bot.delete_message.assert_awaited_once()
+
+
+async def test_ask_gpt_throttles_edits(httpx_mock: HTTPXMock):
+    httpx_mock.add_response(
+        url=GPT_URL,
+        headers={"content-type": "text/event-stream"},
+        content=gpt_stream("Hello", " ", "world"),
+    )
+    context, answer_message = gpt_context()
+    await ask_gpt(gpt_update("/gpt say hi"), context)
+    edits = [call.args[0] for call in answer_message.edit_text.await_args_list]
+    assert edits == ["Hello…", "Hello world"]
+
+
+async def test_ask_gpt_retries_throttled_final_edit(httpx_mock: HTTPXMock, mocker):
+    httpx_mock.add_response(
+        url=GPT_URL,
+        headers={"content-type": "text/event-stream"},
+        content=gpt_stream("Hello"),
+    )
+    sleep = mocker.patch("main.asyncio.sleep")
+    context, answer_message = gpt_context()
+    answer_message.edit_text.side_effect = [None, RetryAfter(7), None]
+    await ask_gpt(gpt_update("/gpt say hi"), context)
+    edits = [call.args[0] for call in answer_message.edit_text.await_args_list]
+    assert edits == ["Hello…", "Hello", "Hello"]
+    sleep.assert_any_await(7)
+    context.bot.delete_message.assert_awaited_once()
+
+
+async def test_ask_gpt_replies_when_busy(gpt_gateway, mocker):
+    mocker.patch.object(gpt_gateway, "ask", side_effect=GPTBusy)
+    context, answer_message = gpt_context()
+    await ask_gpt(gpt_update("/gpt say hi"), context)
+    assert "later" in context.bot.send_message.await_args.kwargs["text"]
+    answer_message.edit_text.assert_not_awaited()
+    context.bot.delete_message.assert_not_awaited()
+
+
+async def test_ask_gpt_remembers_conversation(httpx_mock: HTTPXMock):
+    for answer in ("Arr", "Aye"):
+        httpx_mock.add_response(
+            url=GPT_URL,
+            headers={"content-type": "text/event-stream"},
+            content=gpt_stream(answer),
+        )
+    context, _ = gpt_context()
+    await ask_gpt(gpt_update("/gpt pirate: say hi"), context)
+    await ask_gpt(gpt_update("/gpt again"), context)
+    request = json.loads(httpx_mock.get_requests()[-1].content)
+    assert request["messages"] == [
+        {"role": "system", "content": "pirate"},
+        {"role": "user", "content": "say hi"},
+        {"role": "assistant", "content": "Arr"},
+        {"role": "user", "content": "again"},
+    ]
+
+
+async def test_send_converted_video_passes_metadata(tmp_path, mocker):
+    video = tmp_path / "video.mp4"
+    thumbnail = tmp_path / "thumbnail.jpg"
+    video.write_bytes(b"video")
+    thumbnail.write_bytes(b"thumbnail")
+    mocker.patch("main.download_file", return_value=str(tmp_path / "original"))
+    mocker.patch("main.dhash_video", side_effect=Exception("no ffmpeg"))
+    mocker.patch("main.is_animation", return_value=False)
+    mocker.patch(
+        "main.convert2MP4",
+        return_value=ConvertedVideo(str(video), 640, 360, 12, str(thumbnail)),
+    )
+    context = MagicMock()
+    context.bot = AsyncMock()
+    context.chat_data = {}
+    context.job.chat_id = 1
+    context.job.data = {"data": "https://example.com/a.webm", "is_file_name": False}
+    await send_converted_video(context)
+    kwargs = context.bot.send_video.await_args.kwargs
+    assert (kwargs["width"], kwargs["height"], kwargs["duration"]) == (640, 360, 12)
+    assert kwargs["thumbnail"].name == str(thumbnail)
+    assert not video.exists()
+    assert not thumbnail.exists()
+
+
+def make_link_update(text, entities=None):
+    update = MagicMock()
+    update.message.text = text
+    update.message.chat.type = "private"
+    update.message.parse_entities.return_value = entities or {}
+    update.effective_chat.id = 1
+    return update
+
+
+async def test_process_dispatches_every_link_once(mocker):
+    mocker.patch("main.MESSAGE_LINK_CONCURRENCY", 2)
+    running = 0
+    peak = 0
+
+    async def check_link(link):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return None, {"content-type": "image/jpeg"}
+
+    mocker.patch("main.check_link", side_effect=check_link)
+    hidden = MagicMock(type=MessageEntity.TEXT_LINK, url="https://example.com/3.jpg")
+    update = make_link_update(
+        "https://example.com/1.jpg https://example.com/2.jpg https://example.com/1.jpg"
+        " example.com",
+        {hidden: "meme"},
+    )
+    context = MagicMock()
+    context.bot = AsyncMock()
+    await process(update, context)
+    links = [
+        call.kwargs["data"]["link"]
+        for call in context.job_queue.run_once.call_args_list
+    ]
+    assert links == [
+        "https://example.com/3.jpg",
+        "https://example.com/1.jpg",
+        "https://example.com/2.jpg",
+    ]
+    assert peak == 2
+    slots = {
+        call.kwargs["data"]["slot"]
+        for call in context.job_queue.run_once.call_args_list
+    }
+    assert len(slots) == 1
+    context.bot.delete_message.assert_awaited_once()
+
+
+async def test_process_reports_broken_link_and_keeps_going(mocker, caplog):
+    mocker.patch(
+        "main.check_link",
+        side_effect=[
+            RuntimeError("boom"),
+            (None, {"content-type": "image/jpeg"}),
+            ValueError("bang"),
+        ],
+    )
+    update = make_link_update(
+        "https://example.com/1.jpg https://example.com/2.jpg https://example.com/3.jpg"
+    )
+    context = MagicMock()
+    context.bot = AsyncMock()
+    with pytest.raises(RuntimeError):
+        await process(update, context)
+    context.job_queue.run_once.assert_called_once()
+    context.bot.delete_message.assert_awaited_once()
+    failed = [record.exc_info[1] for record in caplog.records if record.exc_info]
+    assert [str(error) for error in failed] == ["boom", "bang"]
+
+
+async def test_message_jobs_hold_slot_for_whole_job(mocker):
+    running = 0
+    peak = 0
+
+    async def download_file(link, deadline=None):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        raise RuntimeError("offline")
+
+    mocker.patch("main.download_file", side_effect=download_file)
+    slot = asyncio.Semaphore(1)
+    contexts = []
+    for index in range(3):
+        context = MagicMock()
+        context.job.data = {"link": f"https://example.com/{index}.jpg", "slot": slot}
+        contexts.append(context)
+    results = await asyncio.gather(
+        *[send_converted_image(context) for context in contexts],
+        return_exceptions=True,
+    )
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert peak == 1
+    assert all(context.job.data["deadline"] for context in contexts)
+
+
+async def test_process_without_links_explains_error():
+    update = make_link_update("just text")
+    context = MagicMock()
+    context.bot = AsyncMock()
+    await process(update, context)
+    assert context.bot.send_message.call_args.kwargs["text"] == "Not a link!"
+    context.bot.delete_message.assert_awaited_once()
+
+
+def make_inline_update(query):
+    update = MagicMock()
+    update.inline_query.query = query
+    update.inline_query.from_user.id = 7
+    update.inline_query.answer = AsyncMock()
+    return update
+
+
+async def test_inline_query_answers_from_file_id_cache(mocker):
+    file_id_cache.set("https://example.com/a.mp4", ("video", "video-id"))
+    file_id_cache.set("https://example.com/b.jpg", ("photo", "photo-id"))
+    update = make_inline_update(
+        "@memes2telegram_bot https://example.com/a.mp4 https://example.com/b.jpg"
+    )
+    context = MagicMock()
+    await inline_query(update, context)
+    (results,), kwargs = update.inline_query.answer.await_args
+    assert isinstance(results[0], InlineQueryResultCachedVideo)
+    assert results[0].video_file_id == "video-id"
+    assert isinstance(results[1], InlineQueryResultCachedPhoto)
+    assert kwargs["cache_time"] == 300
+    assert kwargs["button"] is None
+    context.application.create_task.assert_not_called()
+
+
+async def test_inline_query_converts_miss_only_from_private_chat(mocker):
+    dispatch_link = mocker.patch("main.dispatch_link")
+    update = make_inline_update("https://example.com/a.mp4")
+    context = MagicMock()
+    await inline_query(update, context)
+    (results,), kwargs = update.inline_query.answer.await_args
+    assert results == []
+    assert kwargs["cache_time"] == 0
+    token = kwargs["button"].start_parameter
+    assert len(token) <= 64
+    dispatch_link.assert_not_called()
+    context.application.create_task.assert_not_called()
+
+    start_update = make_link_update(f"/start {token}")
+    start_update.effective_chat.id = 7
+    context = MagicMock()
+    context.bot = AsyncMock()
+    context.args = [token]
+    await start(start_update, context)
+    assert dispatch_link.call_args.args[1:3] == (7, "https://example.com/a.mp4")
+    context.bot.delete_message.assert_awaited_once()
+    assert token not in inline_requests
+
+
+async def test_send_converted_video_remembers_downloaded_link(tmp_path, mocker):
+    video = tmp_path / "video.mp4"
+    video.write_bytes(b"video")
+    mocker.patch("main.dhash_video", side_effect=Exception("no ffmpeg"))
+    mocker.patch("main.read_mp4_metadata", return_value=(640, 360, 12))
+    context = MagicMock()
+    context.bot = AsyncMock()
+    context.bot.send_video.return_value.animation = None
+    context.bot.send_video.return_value.video.file_id = "video-id"
+    context.chat_data = {}
+    context.job.chat_id = 1
+    context.job.data = {
+        "data": str(video),
+        "is_file_name": True,
+        "link": "https://youtu.be/a",
+    }
+    await send_converted_video(context)
+    assert file_id_cache.get("https://youtu.be/a") == ("video", "video-id")
+
+
+async def test_flush_errors_sends_one_summary():
+    chat_id = 42
+    for error_type in (ValueError, KeyError, TypeError, OSError, RuntimeError):
+        try:
+            raise error_type("boom")
+        except Exception as exc:
+            error_aggregator.add(chat_id, exc, None)
+    context = MagicMock()
+    context.job.chat_id = chat_id
+    context.bot = AsyncMock()
+    await flush_errors(context)
+    context.bot.send_document.assert_awaited_once()
+    caption = context.bot.send_document.call_args.kwargs["caption"]
+    assert caption.startswith("2 more exception(s) of 2 kind(s)")
+    assert not error_aggregator.is_window_open(chat_id)
+
+
+async def test_error_handler_only_logs_chatless_updates(mocker, caplog):
+    send_report = mocker.patch("main._send_error_report")
+    update = MagicMock(spec=Update)
+    update.effective_chat = None
+    update.effective_user.id = 7
+    update.to_dict.return_value = {"inline_query": {"query": "https://x.com"}}
+    context = MagicMock()
+    context.error = RuntimeError("boom")
+    await error_handler(update, context)
+    send_report.assert_not_called()
+    context.job_queue.run_once.assert_not_called()
+    assert "No chat id to send exception to" in caplog.text
+
+
+@pytest.mark.parametrize("dash", [False, True])
+async def test_send_manifest_video_reports_too_big_stream(mocker, dash):
+    too_big = UploadIsTooBig("Every HLS variant is bigger than 50 MB")
+    mocker.patch("main.download_hls", side_effect=too_big)
+    mocker.patch("main.get_dash_video", side_effect=too_big)
+    context = MagicMock()
+    context.bot = AsyncMock()
+    context.job.chat_id = 1
+    context.job.data = {"link": "https://example.com/a.m3u8", "dash": dash}
+    await send_manifest_video(context)
+    text = context.bot.send_message.await_args.kwargs["text"]
+    assert text.startswith("https://example.com/a.m3u8 is too big for upload")
+    context.job_queue.run_once.assert_not_called()
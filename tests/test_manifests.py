@@ -0,0 +1,253 @@
+import os
+import shutil
+import subprocess
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from converter import read_mp4_metadata
+from manifests import (
+    Variant,
+    download_hls,
+    parse_master_playlist,
+    parse_media_playlist,
+    select_variant,
+)
+from scraper import ScraperException, UploadIsTooBig, is_dash_manifest, is_hls_manifest
+
+MASTER = """#EXTM3U
+#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aac",NAME="en",DEFAULT=NO,URI="audio/en.m3u8"
+#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aac",NAME="ru",DEFAULT=YES,URI="audio/ru.m3u8"
+#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360,CODECS="avc1.4d401e,mp4a.40.2"
+low/index.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=5000000,AVERAGE-BANDWIDTH=4000000,RESOLUTION=1920x1080,AUDIO="aac"
+https://cdn.example.com/high/index.m3u8
+"""
+
+
+def media_playlist(segments, duration=4, init=None):
+    lines = ["#EXTM3U", "#EXT-X-TARGETDURATION:4"]
+    if init:
+        lines.append(f'#EXT-X-MAP:URI="{init}"')
+    for segment in segments:
+        lines += [f"#EXTINF:{duration}.0,", segment]
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+
+def test_parse_master_playlist():
+    variants = parse_master_playlist(MASTER, "https://example.com/video/master.m3u8")
+    assert variants == [
+        Variant(
+            "https://cdn.example.com/high/index.m3u8",
+            4000000,
+            "1920x1080",
+            "https://example.com/video/audio/ru.m3u8",
+        ),
+        Variant("https://example.com/video/low/index.m3u8", 800000, "640x360", None),
+    ]
+
+
+def test_parse_media_playlist():
+    text = media_playlist(["0.m4s", "/1.m4s"], init="init.mp4")
+    playlist = parse_media_playlist(text, "https://example.com/v/index.m3u8")
+    assert playlist.segments == [
+        "https://example.com/v/0.m4s",
+        "https://example.com/1.m4s",
+    ]
+    assert playlist.init == "https://example.com/v/init.mp4"
+    assert playlist.duration == 8
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        '#EXT-X-KEY:METHOD=AES-128,URI="key"',
+        "#EXT-X-BYTERANGE:100@0",
+    ],
+)
+def test_parse_media_playlist_unsupported(line):
+    text = media_playlist(["0.ts"]).replace("#EXTINF", f"{line}\n#EXTINF")
+    with pytest.raises(ScraperException):
+        parse_media_playlist(text, "https://example.com/")
+
+
+def test_parse_media_playlist_live():
+    text = media_playlist(["0.ts"]).replace("#EXT-X-ENDLIST\n", "")
+    with pytest.raises(ScraperException, match="Live"):
+        parse_media_playlist(text, "https://example.com/")
+
+
+def test_select_variant():
+    high = Variant("high", 8 * 1024 * 1024, None, None)
+    low = Variant("low", 1024 * 1024, None, None)
+    assert select_variant([high, low], duration=10) == high
+    assert select_variant([high, low], duration=100) == low
+    with pytest.raises(UploadIsTooBig):
+        select_variant([high, low], duration=1000)
+
+
+def test_is_manifest():
+    assert is_hls_manifest("https://example.com/index.m3u8?token=1")
+    assert is_hls_manifest(
+        "https://example.com/play", {"content-type": "application/x-mpegURL"}
+    )
+    assert is_dash_manifest("https://example.com/manifest.mpd")
+    assert is_dash_manifest(
+        "https://example.com/play", {"content-type": "application/dash+xml"}
+    )
+    assert not is_hls_manifest(
+        "https://example.com/video.mp4", {"content-type": "video/mp4"}
+    )
+
+
+class FixtureHandler(SimpleHTTPRequestHandler):
+    delay = 0
+    active = 0
+    max_active = 0
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+        try:
+            time.sleep(cls.delay)
+            super().do_GET()
+        finally:
+            with cls.lock:
+                cls.active -= 1
+
+
+@pytest.fixture
+def hls_server(tmp_path):
+    handler = type("Handler", (FixtureHandler,), {})
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), partial(handler, directory=str(tmp_path))
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}", handler
+    server.shutdown()
+    server.server_close()
+
+
+def write(tmp_path, name, content):
+    path = tmp_path / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if isinstance(content, str):
+        content = content.encode()
+    path.write_bytes(content)
+
+
+async def test_download_hls_assembles_segments(tmp_path, hls_server, mocker):
+    base_url, handler = hls_server
+    handler.delay = 0.02
+    master = MASTER.replace("https://cdn.example.com/high", "high")
+    write(tmp_path, "master.m3u8", master)
+    segments = [f"{i}.ts" for i in range(12)]
+    write(tmp_path, "high/index.m3u8", media_playlist(segments, init="init.mp4"))
+    write(tmp_path, "audio/ru.m3u8", media_playlist(["a0.ts", "a1.ts"]))
+    write(tmp_path, "high/init.mp4", b"init|")
+    for i, segment in enumerate(segments):
+        write(tmp_path, f"high/{segment}", f"{i}|")
+    write(tmp_path, "audio/a0.ts", b"a0|")
+    write(tmp_path, "audio/a1.ts", b"a1|")
+    tracks = {}
+
+    async def remux(video, audio=None):
+        with open(video, "rb") as file:
+            tracks["video"] = file.read()
+        with open(audio, "rb") as file:
+            tracks["audio"] = file.read()
+        return "converted.mp4"
+
+    mocker.patch("manifests.remux2MP4", side_effect=remux)
+    result = await download_hls(f"{base_url}/master.m3u8", concurrency=3)
+    assert result == "converted.mp4"
+    assert tracks["video"] == b"init|" + b"".join(f"{i}|".encode() for i in range(12))
+    assert tracks["audio"] == b"a0|a1|"
+    assert 1 < handler.max_active <= 3 + 2
+
+
+async def test_download_hls_picks_variant_under_budget(tmp_path, hls_server, mocker):
+    base_url, _ = hls_server
+    write(
+        tmp_path, "master.m3u8", MASTER.replace("https://cdn.example.com/high", "high")
+    )
+    # 4 Mbit/s for 200 seconds is 100 MB, 0.8 Mbit/s is 20 MB
+    write(tmp_path, "high/index.m3u8", media_playlist(["0.ts"], duration=200))
+    write(tmp_path, "low/index.m3u8", media_playlist(["0.ts"], duration=200))
+    write(tmp_path, "low/0.ts", b"low")
+    remux = mocker.patch("manifests.remux2MP4", return_value="converted.mp4")
+    await download_hls(f"{base_url}/master.m3u8")
+    video, audio = remux.await_args.args
+    assert audio is None
+
+
+async def test_download_hls_stops_over_budget(tmp_path, hls_server, mocker):
+    base_url, _ = hls_server
+    write(tmp_path, "index.m3u8", media_playlist(["0.ts", "1.ts"]))
+    write(tmp_path, "0.ts", bytes(600 * 1024))
+    write(tmp_path, "1.ts", bytes(600 * 1024))
+    remux = mocker.patch("manifests.remux2MP4")
+    with pytest.raises(UploadIsTooBig):
+        await download_hls(f"{base_url}/index.m3u8", max_filesize_mb=1)
+    remux.assert_not_awaited()
+
+
+async def test_download_hls_missing_segment(tmp_path, hls_server, mocker):
+    base_url, _ = hls_server
+    write(tmp_path, "index.m3u8", media_playlist(["0.ts", "missing.ts"]))
+    write(tmp_path, "0.ts", b"0")
+    mocker.patch("manifests.remux2MP4")
+    with pytest.raises(ScraperException):
+        await download_hls(f"{base_url}/index.m3u8")
+
+
+@pytest.mark.skipif(not shutil.which("ffmpeg"), reason="ffmpeg is not installed")
+@pytest.mark.parametrize("segment_type", ["mpegts", "fmp4"])
+async def test_download_hls_stream_copy(tmp_path, hls_server, segment_type):
+    base_url, _ = hls_server
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-v",
+            "error",
+            "-f",
+            "lavfi",
+            "-i",
+            "testsrc=size=320x240:rate=25:duration=6",
+            "-f",
+            "lavfi",
+            "-i",
+            "sine=duration=6",
+            "-c:v",
+            "libx264",
+            "-g",
+            "25",
+            "-c:a",
+            "aac",
+            "-f",
+            "hls",
+            "-hls_time",
+            "2",
+            "-hls_playlist_type",
+            "vod",
+            "-hls_segment_type",
+            segment_type,
+            str(tmp_path / "index.m3u8"),
+        ],
+        check=True,
+    )
+    converted = await download_hls(f"{base_url}/index.m3u8")
+    try:
+        assert read_mp4_metadata(converted) == (320, 240, 6)
+    finally:
+        os.remove(converted)
@@ -1,6 +1,22 @@
+import codecs
+import struct
+from datetime import date
+
 import pytest
 import re
-from randomizer import sword, random_blade_length
+from randomizer import (
+    sword,
+    random_blade_length,
+    cowsay,
+    fortune,
+    load_fortunes,
+    random_fortune,
+    FortuneDB,
+    STRFILE_ROTATED,
+    daily_random,
+    check_random_secret,
+    get_sword_description,
+)
 
 length_pattern = re.compile(r"\b(\d+)\s*cm\b")
 
@@ -96,3 +112,102 @@ async def test_sword_length_descriptions():
     ]
     result = await sword(user_id)
     assert result.split(". ")[1] in swords
+
+
+def write_strfile(path, quotes, flags=0):
+    text = b""
+    offsets = []
+    for quote in quotes:
+        offsets.append(len(text))
+        text += quote.encode() + b"\n%\n"
+    offsets.append(len(text))
+    path.write_bytes(text)
+    lengths = [len(quote) for quote in quotes]
+    header = struct.pack(
+        ">5Ic3x", 2, len(quotes), max(lengths), min(lengths), flags, b"%"
+    )
+    offsets_data = struct.pack(f">{len(offsets)}I", *offsets)
+    path.with_name(path.name + ".dat").write_bytes(header + offsets_data)
+
+
+def test_fortune_db(tmp_path):
+    quotes = ["First quote", "Second\nmultiline quote", "x" * 200]
+    write_strfile(tmp_path / "quotes", quotes)
+    fortune_db = FortuneDB(str(tmp_path / "quotes"))
+    assert len(fortune_db) == 3
+    assert [fortune_db[i] for i in range(3)] == quotes
+    assert list(fortune_db.short) == [0, 1]
+
+
+def test_fortune_db_rotated(tmp_path):
+    write_strfile(tmp_path / "off", [codecs.encode("Secret", "rot13")], STRFILE_ROTATED)
+    assert FortuneDB(str(tmp_path / "off"))[0] == "Secret"
+
+
+@pytest.fixture
+def fortune_dbs(monkeypatch):
+    # loaded databases are module state, keep temporary ones out of other tests
+    monkeypatch.setattr("randomizer._fortune_dbs", [])
+    monkeypatch.setattr("randomizer._fortune_weights", [])
+
+
+async def test_fortune_in_process(tmp_path, fortune_dbs):
+    write_strfile(tmp_path / "quotes", ["Only <short> quote"])
+    write_strfile(tmp_path / "long", ["x" * 200])
+    load_fortunes(str(tmp_path))
+    assert random_fortune() == "Only <short> quote"
+    result = await fortune("test_user")
+    assert result.startswith("test_user fortune for today<pre><code>")
+    assert "&lt;short&gt;" in result
+
+
+def test_cowsay_single_line():
+    assert cowsay("hi").splitlines()[:4] == [
+        " ____",
+        "< hi >",
+        " ----",
+        "        \\   ^__^",
+    ]
+
+
+def test_cowsay_wraps_to_line_width():
+    lines = cowsay("word " * 20, width=30).splitlines()
+    assert lines[1].startswith("/ ") and lines[1].endswith(" \\")
+    assert lines[2].startswith("| ")
+    bubble = lines[: lines.index(" " + "-" * (len(lines[0]) - 1))]
+    assert all(len(line) <= 30 + 3 for line in bubble)
+    assert len({len(line) for line in bubble[1:]}) == 1
+
+
+def test_daily_random_is_stable_for_the_day():
+    day = date(2024, 1, 1)
+    assert daily_random(1, day).random() == daily_random(1, day).random()
+    assert daily_random(1, day).random() != daily_random(2, day).random()
+    assert daily_random(1, day).random() != daily_random(1, date(2024, 1, 2)).random()
+
+
+def test_daily_random_depends_on_secret(monkeypatch):
+    day = date(2024, 1, 1)
+    value = daily_random(1, day).random()
+    monkeypatch.setenv("RANDOM_SECRET", "other")
+    assert daily_random(1, day).random() != value
+
+
+def test_check_random_secret(monkeypatch, caplog):
+    monkeypatch.delenv("RANDOM_SECRET", raising=False)
+    assert not check_random_secret()
+    assert "RANDOM_SECRET is not set" in caplog.text
+    monkeypatch.setenv("RANDOM_SECRET", "secret")
+    assert check_random_secret()
+
+
+async def test_sword_is_stable_for_user():
+    assert await sword("test_user", seed=42) == await sword("test_user", seed=42)
+
+
+def test_get_sword_description_thresholds():
+    assert get_sword_description(15) == "Cute dagger, rogue"
+    assert get_sword_description(25) == "Cute dagger, rogue"
+    assert get_sword_description(26) == "Deadly stiletto, assassin"
+    assert get_sword_description(160).startswith("Giant Dad")
+    assert get_sword_description(161) is None
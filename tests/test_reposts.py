@@ -0,0 +1,182 @@
+import shutil
+import subprocess
+from io import BytesIO
+
+import pytest
+from PIL import Image, ImageDraw
+
+from reposts import Repost, RepostIndex, _dhash_image, dhash_video
+from utils import DeadlineExceeded
+
+REPOST = Repost("photo", "file_id", 1)
+# a hash with enough detail to be indexed
+DETAILED = 0x5A5A_5A5A_5A5A_5A5A
+
+
+def _meme(size=(400, 300), image_format="JPEG", quality=90):
+    image = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(image)
+    width, height = size
+    draw.rectangle((0, 0, width // 3, height // 2), fill="black")
+    draw.ellipse((width // 2, height // 3, width, height), fill="gray")
+    with BytesIO() as buffer:
+        image.save(buffer, image_format, quality=quality)
+        return buffer.getvalue()
+
+
+def _distance(a, b):
+    return (a ^ b).bit_count()
+
+
+def test_dhash_image_survives_recompression_and_resize():
+    original = _dhash_image(_meme())
+    assert _distance(original, _dhash_image(_meme((800, 600), quality=40))) <= 4
+    assert _distance(original, _dhash_image(_meme(image_format="PNG"))) <= 4
+
+
+def test_dhash_image_differs_for_other_image():
+    flipped = Image.open(BytesIO(_meme())).transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+    with BytesIO() as buffer:
+        flipped.save(buffer, "JPEG")
+        other = _dhash_image(buffer.getvalue())
+    assert _distance(_dhash_image(_meme()), other) > 4
+
+
+def _frame(top_step, bottom_step):
+    # 9x8 gray frame, rows change by the given step from left to right
+    steps = [top_step] * 4 + [bottom_step] * 4
+    return bytes(128 + step * col for step in steps for col in range(9))
+
+
+async def test_dhash_video_averages_keyframes(mocker):
+    mocker.patch("reposts.which", return_value="ffmpeg")
+    # every pixel is brighter than its right neighbour in the first frame
+    # and darker in the second, their sum falls only in the bottom rows
+    falling, rising = _frame(-1, -2), _frame(2, 1)
+    run_command = mocker.patch("reposts.run_command", return_value=falling + rising)
+    assert await dhash_video("video.mp4") == 0xFFFFFFFF
+    assert run_command.call_args.kwargs == {"decode": False, "timeout": None}
+    run_command.return_value = falling
+    assert await dhash_video("video.mp4") == 0xFFFFFFFFFFFFFFFF
+    run_command.return_value = rising
+    assert await dhash_video("video.mp4") == 0
+
+
+def _clip(tmp_path, name, frames):
+    for index, frame in enumerate(frames):
+        frame.save(tmp_path / f"{name}{index}.png")
+    path = tmp_path / f"{name}.mp4"
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-v",
+            "error",
+            "-framerate",
+            "1",
+            "-i",
+            tmp_path / f"{name}%d.png",
+            "-c:v",
+            "mpeg4",
+            "-g",
+            "1",
+            path,
+        ],
+        check=True,
+    )
+    return str(path)
+
+
+@pytest.mark.skipif(not shutil.which("ffmpeg"), reason="ffmpeg is not installed")
+async def test_dhash_video_combines_different_keyframes(tmp_path):
+    meme = Image.open(BytesIO(_meme()))
+    frames = [
+        meme,
+        meme.transpose(Image.Transpose.FLIP_LEFT_RIGHT),
+        meme.transpose(Image.Transpose.FLIP_TOP_BOTTOM),
+    ]
+    combined = await dhash_video(_clip(tmp_path, "all", frames))
+    for index, frame in enumerate(frames):
+        single = await dhash_video(_clip(tmp_path, f"single{index}-", [frame]))
+        assert combined != single
+
+
+def test_repost_index_finds_near_duplicate():
+    index = RepostIndex()
+    index.add(DETAILED, REPOST)
+    assert index.find(DETAILED) == REPOST
+    assert index.find(DETAILED ^ 0b1111) == REPOST
+    assert len(index) == 1
+
+
+def test_repost_index_ignores_distant_hash():
+    index = RepostIndex()
+    index.add(DETAILED, REPOST)
+    assert index.find(DETAILED ^ 0b11111) is None
+
+
+def test_repost_index_prefers_closest():
+    index = RepostIndex()
+    far = Repost("photo", "far", 1)
+    close = Repost("photo", "close", 2)
+    index.add(DETAILED ^ 0b111, far)
+    index.add(DETAILED ^ 0b1, close)
+    assert index.find(DETAILED) == close
+
+
+def _plain(text, position):
+    image = Image.new("RGB", (400, 300), "white")
+    ImageDraw.Draw(image).text(position, text, fill="black")
+    with BytesIO() as buffer:
+        image.save(buffer, "PNG")
+        return buffer.getvalue()
+
+
+def test_repost_index_skips_plain_images():
+    first = _dhash_image(_plain("when the code works", (20, 20)))
+    second = _dhash_image(_plain("nobody:", (150, 250)))
+    # close enough to match although nothing is alike
+    assert _distance(first, second) <= 4
+    index = RepostIndex()
+    index.add(first, REPOST)
+    assert len(index) == 0
+    assert index.find(second) is None
+    assert index.find(0) is None
+
+
+def test_repost_index_forgets_oldest():
+    index = RepostIndex(maxsize=2)
+    hashes = [DETAILED, ~DETAILED & (2**64 - 1), 0x0F0F_0F0F_0F0F_0F0F]
+    for position, value in enumerate(hashes):
+        index.add(value, Repost("photo", f"file-{position}", position))
+    assert len(index) == 2
+    assert index.find(hashes[0]) is None
+    assert index.find(hashes[1]).file_id == "file-1"
+    assert index.find(hashes[2]).file_id == "file-2"
+    # evicted ids are gone from every chunk bucket
+    assert sum(len(ids) for bucket in index._buckets for ids in bucket.values()) == 10
+
+
+def test_repost_index_discards_stale_entry():
+    index = RepostIndex(maxsize=2)
+    index.add(DETAILED, REPOST)
+    index.discard(DETAILED ^ 0b1)
+    assert index.find(DETAILED) is None
+    assert len(index) == 0
+    # the emptied slot is reused without evicting anything twice
+    for position in range(3):
+        index.add(DETAILED ^ position << 8, Repost("photo", f"file-{position}", 1))
+    assert index.find(DETAILED ^ 2 << 8).file_id == "file-2"
+    assert len(index) == 2
+
+
+def test_repost_index_empty():
+    assert RepostIndex().find(42) is None
+
+
+async def test_dhash_video_times_out(tmp_path, mocker):
+    fake_ffmpeg = tmp_path / "ffmpeg"
+    fake_ffmpeg.write_text("#!/bin/sh\nsleep 30\n")
+    fake_ffmpeg.chmod(0o755)
+    mocker.patch("reposts.which", return_value=str(fake_ffmpeg))
+    with pytest.raises(DeadlineExceeded):
+        await dhash_video("video.mp4", timeout=0.2)
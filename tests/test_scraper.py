@@ -1,4 +1,9 @@
+import asyncio
+import os
+import time
+
 import httpx
+import pytest
 from pytest_httpx import HTTPXMock
 
 from scraper import (
@@ -16,11 +21,35 @@ from scraper import (
     is_bot_message,
     is_private_message,
     link_to_bot,
+    extract_links,
+    estimate_filesize,
+    get_native_audio_codec,
+    split_ranges,
+    download_file,
+    download_image,
+    remove_file,
+    plan_format,
+    ScraperException,
+    UploadIsTooBig,
+    MEDIA_VIDEO,
+    MEDIA_AUDIO,
+    _run_in_worker,
+    _run_ydl,
+    ydl_info_cache,
 )
+from sources import SourceStore
+from utils import Deadline, DeadlineExceeded
 
 BOT_NAME = "@memes2telegram_bot"
 
 
+@pytest.fixture(autouse=True)
+def source_store(tmp_path, mocker):
+    store = SourceStore(str(tmp_path / "sources"), 1024 * 1024)
+    mocker.patch("scraper.get_source_store", return_value=store)
+    return store
+
+
 def test_is_big_content_length_less_than_200MB():
     headers = {"content-length": "10000000"}  # 10 MB
     assert is_big(headers) is False
@@ -290,3 +319,330 @@ async def test_get_headers(httpx_mock: HTTPXMock):
     assert "content-type" in headers
     assert "content-length" in headers
     assert headers["content-type"] == "image/jpeg"
+
+
+MB = 1024 * 1024
+
+
+def _format(format_id, vcodec="avc1", acodec="mp4a", **kwargs):
+    return dict(format_id=format_id, vcodec=vcodec, acodec=acodec, **kwargs)
+
+
+def test_estimate_filesize_known():
+    assert estimate_filesize({"filesize": 10, "filesize_approx": 20}) == 10
+    assert estimate_filesize({"filesize_approx": 20}) == 20
+
+
+def test_estimate_filesize_from_bitrate():
+    assert estimate_filesize({"tbr": 800}, duration=10) == 1_000_000
+
+
+def test_estimate_filesize_unknown():
+    assert estimate_filesize({"tbr": 800}) is None
+    assert estimate_filesize({}) is None
+
+
+def test_plan_format_merges_best_video_and_audio():
+    info = {
+        "formats": [
+            _format("audio", vcodec="none", filesize=5 * MB),
+            _format("360p", vcodec="avc1", acodec="none", filesize=10 * MB),
+            _format("1080p", vcodec="avc1", acodec="none", filesize=40 * MB),
+        ]
+    }
+    assert plan_format(info) == ("1080p+audio", MEDIA_VIDEO)
+
+
+def test_plan_format_skips_too_big_video():
+    info = {
+        "formats": [
+            _format("audio", vcodec="none", filesize=5 * MB),
+            _format("360p", vcodec="avc1", acodec="none", filesize=10 * MB),
+            _format("1080p", vcodec="avc1", acodec="none", filesize=48 * MB),
+        ]
+    }
+    assert plan_format(info) == ("360p+audio", MEDIA_VIDEO)
+
+
+def test_plan_format_muxed_with_estimated_size():
+    info = {
+        "duration": 600,
+        "formats": [
+            _format("small", tbr=500),
+            _format("big", tbr=5000),
+        ],
+    }
+    assert plan_format(info) == ("small", MEDIA_VIDEO)
+
+
+def test_plan_format_silent_video():
+    info = {"formats": [_format("gif", acodec="none", filesize=MB)]}
+    assert plan_format(info) == ("gif", MEDIA_VIDEO)
+
+
+def test_plan_format_single_format_info():
+    assert plan_format({"url": "https://example.com/video.mp4"}) == (
+        "best",
+        MEDIA_VIDEO,
+    )
+
+
+def test_plan_format_audio_fallback():
+    info = {
+        "formats": [
+            _format("audio", vcodec="none", filesize=30 * MB),
+            _format("360p", vcodec="avc1", acodec="none", filesize=100 * MB),
+        ]
+    }
+    assert plan_format(info, allow_audio=True) == ("audio", MEDIA_AUDIO)
+
+
+def test_plan_format_audio_prefers_native_codec():
+    info = {
+        "formats": [
+            _format("m4a", vcodec="none", acodec="mp4a.40.2", filesize=20 * MB),
+            _format("opus", vcodec="none", acodec="opus", filesize=25 * MB),
+            _format("360p", vcodec="avc1", acodec="none", filesize=100 * MB),
+        ]
+    }
+    assert plan_format(info, allow_audio=True) == ("m4a", MEDIA_AUDIO)
+
+
+def test_get_native_audio_codec():
+    assert get_native_audio_codec({"acodec": "mp4a.40.2"}) == "m4a"
+    assert get_native_audio_codec({"acodec": "mp3"}) == "mp3"
+    assert get_native_audio_codec({"acodec": "opus"}) is None
+    assert get_native_audio_codec({}) is None
+
+
+def test_plan_format_reject():
+    info = {
+        "formats": [
+            _format("audio", vcodec="none", filesize=60 * MB),
+            _format("360p", vcodec="avc1", acodec="none", filesize=100 * MB),
+        ]
+    }
+    with pytest.raises(UploadIsTooBig):
+        plan_format(info, allow_audio=True)
+
+
+def test_split_ranges():
+    assert split_ranges(10, 3) == [(0, 3), (4, 7), (8, 9)]
+    assert split_ranges(4, 4) == [(0, 0), (1, 1), (2, 2), (3, 3)]
+
+
+async def test_download_file_by_ranges(httpx_mock: HTTPXMock):
+    url = "https://example.com/video.mp4"
+    content = bytes(range(256)) * 4
+    httpx_mock.add_response(
+        url=url,
+        method="HEAD",
+        headers={
+            "content-type": "video/mp4",
+            "content-length": str(len(content)),
+            "accept-ranges": "bytes",
+        },
+    )
+    for start, end in split_ranges(len(content), 4):
+        httpx_mock.add_response(
+            url=url,
+            method="GET",
+            status_code=206,
+            match_headers={"Range": f"bytes={start}-{end}"},
+            content=content[start : end + 1],
+        )
+    filename = await download_file(url, chunks=4, range_min_size_mb=0)
+    try:
+        with open(filename, "rb") as file:
+            assert file.read() == content
+    finally:
+        remove_file(filename)
+
+
+@pytest.mark.httpx_mock(assert_all_responses_were_requested=False)
+async def test_download_file_ranges_ignored(httpx_mock: HTTPXMock):
+    url = "https://example.com/video.mp4"
+    content = b"0123456789"
+    httpx_mock.add_response(
+        url=url,
+        method="HEAD",
+        headers={
+            "content-type": "video/mp4",
+            "content-length": str(len(content)),
+            "accept-ranges": "bytes",
+        },
+    )
+    # both range requests and the single stream fallback get the whole file
+    for _ in range(3):
+        httpx_mock.add_response(url=url, method="GET", content=content)
+    filename = await download_file(url, chunks=2, range_min_size_mb=0)
+    try:
+        with open(filename, "rb") as file:
+            assert file.read() == content
+    finally:
+        remove_file(filename)
+
+
+async def test_download_file_reuses_fresh_source(httpx_mock: HTTPXMock, source_store):
+    url = "https://example.com/video.mp4"
+    headers = {"content-type": "video/mp4", "etag": '"v1"'}
+    httpx_mock.add_response(url=url, method="HEAD", headers=headers)
+    httpx_mock.add_response(url=url, method="GET", headers=headers, content=b"video")
+    httpx_mock.add_response(url=url, method="HEAD", headers=headers)
+    first = await download_file(url)
+    second = await download_file(url)
+    try:
+        with open(second, "rb") as file:
+            assert file.read() == b"video"
+        assert len(httpx_mock.get_requests(method="GET")) == 1
+        assert source_store.lookup(url).etag == '"v1"'
+    finally:
+        remove_file(first)
+        remove_file(second)
+
+
+async def test_download_file_refreshes_stale_source(
+    httpx_mock: HTTPXMock, source_store
+):
+    url = "https://example.com/video.mp4"
+    for version in (b"v1", b"v2"):
+        headers = {"content-type": "video/mp4", "etag": version.decode()}
+        httpx_mock.add_response(url=url, method="HEAD", headers=headers)
+        httpx_mock.add_response(url=url, method="GET", headers=headers, content=version)
+    first = await download_file(url)
+    second = await download_file(url)
+    try:
+        with open(second, "rb") as file:
+            assert file.read() == b"v2"
+    finally:
+        remove_file(first)
+        remove_file(second)
+
+
+async def test_download_file_revalidates_without_head(
+    httpx_mock: HTTPXMock, source_store
+):
+    url = "https://example.com/video.mp4"
+    source_store.add_bytes(url, b"video", etag='"v1"')
+    httpx_mock.add_response(url=url, method="HEAD", status_code=405)
+    httpx_mock.add_response(
+        url=url,
+        method="GET",
+        status_code=304,
+        match_headers={"If-None-Match": '"v1"'},
+    )
+    filename = await download_file(url)
+    try:
+        with open(filename, "rb") as file:
+            assert file.read() == b"video"
+    finally:
+        remove_file(filename)
+
+
+async def test_download_image_revalidates_source(httpx_mock: HTTPXMock, source_store):
+    url = "https://example.com/image.jpg"
+    httpx_mock.add_response(
+        url=url,
+        headers={"content-type": "image/jpeg", "last-modified": "yesterday"},
+        content=b"image",
+    )
+    httpx_mock.add_response(
+        url=url, status_code=304, match_headers={"If-Modified-Since": "yesterday"}
+    )
+    async with httpx.AsyncClient() as client:
+        assert await download_image(client, url) == b"image"
+        assert await download_image(client, url) == b"image"
+
+
+async def test_download_file_deadline_removes_partial_file(
+    httpx_mock: HTTPXMock, tmp_path, mocker
+):
+    url = "https://example.com/video.mp4"
+    filename = tmp_path / "video.mp4"
+    mocker.patch("scraper._generate_filename", return_value=str(filename))
+
+    async def stall(request):
+        filename.write_bytes(b"partial")
+        await asyncio.sleep(10)
+
+    httpx_mock.add_response(
+        url=url, method="HEAD", headers={"content-type": "video/mp4"}
+    )
+    httpx_mock.add_callback(stall, url=url, method="GET")
+    with pytest.raises(DeadlineExceeded):
+        await download_file(url, deadline=Deadline(0.2))
+    assert not filename.exists()
+
+
+def _stuck_worker(pid_file, temp_dir):
+    with open(pid_file, "w") as file:
+        file.write(f"{os.getpid()} {temp_dir}")
+    time.sleep(30)
+
+
+async def test_run_in_worker_kills_stuck_worker(tmp_path):
+    pid_file = tmp_path / "pid"
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        await _run_in_worker(_stuck_worker, str(pid_file), Deadline(1))
+    assert time.monotonic() - started < 10
+    pid, temp_dir = pid_file.read_text().split()
+    assert not os.path.exists(temp_dir)
+    for _ in range(50):
+        if not os.path.exists(f"/proc/{pid}"):
+            break
+        await asyncio.sleep(0.1)
+    assert not os.path.exists(f"/proc/{pid}")
+
+
+async def test_run_ydl_reuses_extracted_info(mocker):
+    ydl_info_cache.clear()
+    info = {"id": "abc", "title": "clip"}
+    seen = []
+
+    async def run_in_worker(func, url, deadline=None):
+        seen.append(func.keywords["info"])
+        return ("clip.mp4", "clip"), info
+
+    mocker.patch("scraper._run_in_worker", side_effect=run_in_worker)
+    url = "https://www.youtube.com/watch?v=abc"
+    assert await _run_ydl(object, url) == ("clip.mp4", "clip")
+    assert await _run_ydl(object, url) == ("clip.mp4", "clip")
+    assert seen == [None, info]
+
+
+async def test_run_ydl_forgets_info_of_failed_download(mocker):
+    ydl_info_cache.clear()
+    url = "https://www.youtube.com/watch?v=abc"
+    ydl_info_cache.set(url, {"id": "abc"})
+    mocker.patch("scraper._run_in_worker", side_effect=ScraperException("expired"))
+    with pytest.raises(ScraperException):
+        await _run_ydl(object, url)
+    assert url not in ydl_info_cache
+
+
+def _worker_pid(url, temp_dir):
+    return os.getpid()
+
+
+async def test_run_in_worker_reuses_warm_worker():
+    pid = await _run_in_worker(_worker_pid, "url")
+    assert await _run_in_worker(_worker_pid, "url") == pid
+    with pytest.raises(DeadlineExceeded):
+        await _run_in_worker(_stuck_worker, os.devnull, Deadline(0.5))
+    # the stuck call got the warm worker, it is killed and never reused
+    new_pid = await _run_in_worker(_worker_pid, "url")
+    assert new_pid != pid
+    assert await _run_in_worker(_worker_pid, "url") == new_pid
+
+
+def test_extract_links():
+    text = (
+        f"{BOT_NAME} look https://example.com/a.mp4, and (https://example.com/b.jpg)"
+        " again https://example.com/a.mp4 or not a link http://"
+    )
+    assert extract_links(text) == [
+        "https://example.com/a.mp4",
+        "https://example.com/b.jpg",
+    ]
+    assert extract_links(None) == []
@@ -0,0 +1,86 @@
+import os
+
+from sources import (
+    Source,
+    SourceStore,
+    get_conditional_headers,
+    hash_file,
+    is_fresh,
+)
+
+
+def write(path, content):
+    with open(path, "wb") as file:
+        file.write(content)
+    return str(path)
+
+
+def test_add_and_checkout(tmp_path):
+    store = SourceStore(str(tmp_path / "store"), 1024)
+    original = write(tmp_path / "video.mp4", b"video")
+    source = store.add("https://example.com/video", original, etag='"1"')
+    assert source.sha256 == hash_file(original)
+    assert source.name == "video.mp4"
+    os.remove(original)
+    assert store.lookup("https://example.com/video") == source
+    filename = store.checkout(source, str(tmp_path / "copy.mp4"))
+    with open(filename, "rb") as file:
+        assert file.read() == b"video"
+    os.remove(filename)
+    assert store.read(source) == b"video"
+
+
+def test_checkout_keeps_name(tmp_path):
+    store = SourceStore(str(tmp_path / "store"), 1024)
+    source = store.add("key", write(tmp_path / "song.m4a", b"audio"))
+    filename = store.checkout(source)
+    try:
+        assert filename.endswith("-song.m4a")
+    finally:
+        os.remove(filename)
+
+
+def test_same_content_is_stored_once(tmp_path):
+    store = SourceStore(str(tmp_path / "store"), 1024)
+    first = store.add_bytes("https://a.com/1", b"same")
+    second = store.add_bytes("https://b.com/2", b"same")
+    assert first.sha256 == second.sha256
+    assert store.size == 4
+
+
+def test_evicts_least_recently_used_bytes(tmp_path):
+    store = SourceStore(str(tmp_path / "store"), 10)
+    old = store.add_bytes("old", b"1234")
+    used = store.add_bytes("used", b"5678")
+    store.read(used)
+    store.add_bytes("new", b"9012")
+    assert store.lookup("old") is None
+    assert store.lookup("used") == used
+    assert store.size == 8
+    assert not os.path.exists(store._path(old.sha256))
+
+
+def test_lookup_forgets_missing_blobs(tmp_path):
+    store = SourceStore(str(tmp_path / "store"), 1024)
+    source = store.add_bytes("key", b"content")
+    os.remove(store._path(source.sha256))
+    assert store.lookup("key") is None
+    assert store.size == 0
+
+
+def test_is_fresh():
+    source = Source("sha", "name", '"1"', "yesterday")
+    assert is_fresh(source, {"etag": '"1"'})
+    assert not is_fresh(source, {"etag": '"2"', "last-modified": "yesterday"})
+    assert not is_fresh(source, {})
+    source = Source("sha", "name", None, "yesterday")
+    assert is_fresh(source, {"last-modified": "yesterday"})
+    assert not is_fresh(source, {"last-modified": "today"})
+
+
+def test_get_conditional_headers():
+    source = Source("sha", "name", '"1"', "yesterday")
+    assert get_conditional_headers(source) == {
+        "If-None-Match": '"1"',
+        "If-Modified-Since": "yesterday",
+    }
@@ -0,0 +1,70 @@
+import time
+
+import pytest
+
+from utils import (
+    CMDException,
+    Deadline,
+    DeadlineExceeded,
+    get_timeout,
+    run_command,
+    timeouts,
+)
+
+
+def is_running(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            return "zombie" not in status.read()
+    except FileNotFoundError:
+        return False
+
+
+async def test_run_command_output():
+    assert await run_command("echo", "hello") == "hello\n"
+
+
+async def test_run_command_pins_exited_process(mocker):
+    setaffinity = mocker.patch("os.sched_setaffinity", side_effect=ProcessLookupError)
+    assert await run_command("echo", "hello", cpus=(0,)) == "hello\n"
+    assert setaffinity.call_args.args[1] == (0,)
+
+
+async def test_run_command_error():
+    with pytest.raises(CMDException):
+        await run_command("sh", "-c", "exit 3")
+
+
+async def test_run_command_timeout_kills_process_group(tmp_path):
+    pid_file = tmp_path / "pid"
+    before = timeouts["sh"]
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        await run_command(
+            "sh", "-c", f"sleep 30 & echo $! > {pid_file}; wait", timeout=0.5
+        )
+    assert time.monotonic() - started < 5
+    assert timeouts["sh"] == before + 1
+    child_pid = int(pid_file.read_text())
+    for _ in range(50):
+        if not is_running(child_pid):
+            break
+        time.sleep(0.1)
+    assert not is_running(child_pid)
+
+
+def test_deadline():
+    deadline = Deadline(60)
+    assert 59 < deadline.remaining() <= 60
+    assert not deadline.expired
+    deadline.check("download")
+    assert get_timeout(deadline) <= 60
+    assert get_timeout(None) is None
+
+
+def test_deadline_expired():
+    deadline = Deadline(0)
+    assert deadline.expired
+    assert deadline.remaining() == 0
+    with pytest.raises(DeadlineExceeded, match="download"):
+        deadline.check("download")
@@ -1,23 +1,93 @@
 import asyncio
 import logging
+import os
+import signal
+import time
+from collections import Counter
 
-from cache import AsyncLRU
+from caching import cached
 
 logger = logging.getLogger(__name__)
 
 
+# stage -> number of jobs that ran out of time there
+timeouts = Counter()
+
+
 class CMDException(Exception):
     pass
 
 
-async def run_command(cmd: str, *args) -> str:
+class DeadlineExceeded(Exception):
+    pass
+
+
+def deadline_exceeded(stage: str) -> DeadlineExceeded:
+    timeouts[stage] += 1
+    return DeadlineExceeded(f"Job ran out of time while in {stage}")
+
+
+class Deadline:
+    def __init__(self, budget_sec: float):
+        self.budget_sec = budget_sec
+        self.expires_at = time.monotonic() + budget_sec
+
+    def __repr__(self) -> str:
+        return f"Deadline({self.budget_sec}s, {self.remaining():.1f}s left)"
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def check(self, stage: str) -> None:
+        if self.expired:
+            raise deadline_exceeded(stage)
+
+
+def get_timeout(deadline: Deadline | None) -> float | None:
+    return deadline.remaining() if deadline else None
+
+
+def kill_process_group(pid: int) -> None:
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+async def run_command(
+    cmd: str,
+    *args,
+    decode: bool = True,
+    timeout: float | None = None,
+    cpus: tuple[int, ...] | None = None,
+) -> str | bytes:
     process = await asyncio.create_subprocess_exec(
         cmd,
         *args,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
+        # own process group, so children of the command die with it
+        start_new_session=True,
     )
-    stdout, stderr = await process.communicate()
+    if cpus:
+        # ffmpeg starts its worker threads after probing, they inherit this
+        try:
+            os.sched_setaffinity(process.pid, cpus)
+        except ProcessLookupError:
+            # short commands may be gone already, there is nothing to pin
+            pass
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except BaseException as exc:
+        kill_process_group(process.pid)
+        await process.wait()
+        if isinstance(exc, TimeoutError):
+            raise deadline_exceeded(os.path.basename(cmd)) from exc
+        raise
     if process.returncode is not None and process.returncode != 0:
         logger.error(
             'Command "%s" return code is %d\n%s',
@@ -26,12 +96,25 @@ async def run_command(cmd: str, *args) -> str:
             stderr.decode(),
         )
         raise CMDException
+    if not decode:
+        return stdout
     if stdout:
         return stdout.decode()
     return ""
 
 
-@AsyncLRU(maxsize=32)
+async def gather_or_cancel(coros) -> list:
+    tasks = [asyncio.create_task(coro) for coro in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+@cached(maxsize=32)
 async def which(cmd: str) -> str:
     cmd_path = await run_command("which", cmd)
     return cmd_path.strip()